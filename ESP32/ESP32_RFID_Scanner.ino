@@ -33,6 +33,7 @@ struct TempAccess {
   char uid[11];        // RFID UID (reduced from 17 to 11 - typical RFID UIDs are 8-10 chars)
   char name[32];       // User name (reduced from 32 to 21)
   bool isActive;       // Whether this slot is active
+  unsigned long activeFromMs;  // millis() at which a pre-warmed grant starts (0 = now)
 };
 
 // Increased capacity with memory optimization
@@ -54,6 +55,29 @@ const unsigned long REGISTER_INTERVAL = 300000;  // Register room every 5 minute
 const size_t JSON_BUFFER_SIZE = 1024;
 const size_t LARGE_JSON_BUFFER_SIZE = 2048;
 
+// Buffered access log upload: local decisions are queued with a per-device
+// sequence number and sent to /api/esp32/access_log in one batch
+struct PendingLog {
+  char uid[11];
+  bool granted;
+  unsigned long seq;
+  unsigned long atMillis;
+};
+
+const int MAX_PENDING_LOGS = 32;
+PendingLog pendingLogs[MAX_PENDING_LOGS];
+int pendingLogCount = 0;
+unsigned long logSeq = 0;
+unsigned long lastLogFlush = 0;
+const unsigned long LOG_FLUSH_INTERVAL = 10000;  // Retry buffered logs every 10 seconds
+const size_t LOG_JSON_BUFFER_SIZE = 4096;
+
+// Allowlist delta sync: ask the server for changes since the last version
+unsigned long allowlistVersion = 0;
+unsigned long lastAllowlistSync = 0;
+const unsigned long ALLOWLIST_SYNC_INTERVAL = 30000;  // 30 seconds
+const size_t SYNC_JSON_BUFFER_SIZE = 8192;
+
 void setup() {
   Serial.begin(115200);
   while (!Serial);
@@ -67,6 +91,9 @@ void setup() {
   // Initialize hardware
   initializeHardware();
 
+  // Continue the access log sequence across reboots
+  logSeq = preferences.getULong("log_seq", 0);
+
   // Initialize SPI and RFID
   SPI.begin();
   mfrc522.PCD_Init();
@@ -83,6 +110,10 @@ void setup() {
   // Initialize temporary user storage
   initializeTempStorage();
 
+  // Load the current allowlist for this room
+  syncAllowlist();
+  lastAllowlistSync = millis();
+
   // System ready
   signalReady();
   Serial.println("\n🚪 Room Access System Ready!");
@@ -105,11 +136,23 @@ void loop() {
     lastServerRegister = millis();
   }
 
+  // Periodic allowlist sync (a 304 when nothing changed)
+  if (millis() - lastAllowlistSync > ALLOWLIST_SYNC_INTERVAL) {
+    syncAllowlist();
+    lastAllowlistSync = millis();
+  }
+
   // Handle door timing
   if (doorIsOpen && millis() - doorOpenTime > DOOR_OPEN_DURATION) {
     closeDoor();
   }
 
+  // Upload access logs buffered while the server was unreachable
+  if (pendingLogCount > 0 && millis() - lastLogFlush > LOG_FLUSH_INTERVAL) {
+    flushPendingLogs();
+    lastLogFlush = millis();
+  }
+
   // Handle serial commands
   handleSerialCommands();
 
@@ -149,6 +192,32 @@ void setupWebServer() {
     
     JsonObject jsonObj = json.as<JsonObject>();
     
+    // Batch removal: {"rfid_uids": [...]} -> one response for all UIDs
+    if (jsonObj.containsKey("rfid_uids")) {
+      DynamicJsonDocument responseDoc(LARGE_JSON_BUFFER_SIZE);
+      JsonArray removedArray = responseDoc.createNestedArray("removed");
+      JsonArray notFoundArray = responseDoc.createNestedArray("not_found");
+      
+      for (JsonVariant value : jsonObj["rfid_uids"].as<JsonArray>()) {
+        String rfid_uid = value.as<String>();
+        if (removeTempUserByUID(rfid_uid)) {
+          removedArray.add(rfid_uid);
+        } else {
+          notFoundArray.add(rfid_uid);
+        }
+      }
+      
+      responseDoc["success"] = true;
+      String response;
+      serializeJson(responseDoc, response);
+      request->send(200, "application/json", response);
+      
+      if (removedArray.size() > 0) {
+        signalUserRemoved();
+      }
+      return;
+    }
+    
     if (!jsonObj.containsKey("rfid_uid")) {
       request->send(400, "application/json", "{\"success\":false,\"message\":\"Missing rfid_uid\"}");
       return;
@@ -173,6 +242,30 @@ void setupWebServer() {
     }
   }));
 
+  // API endpoint to pre-load upcoming reservations: {"users": [{"rfid_uid", "name", "starts_in_ms"}]}
+  server.addHandler(new AsyncCallbackJsonWebHandler("/api/add_users", [](AsyncWebServerRequest *request, JsonVariant &json) {
+    if (!json.is<JsonObject>() || !json["users"].is<JsonArray>()) {
+      request->send(400, "application/json", "{\"success\":false,\"message\":\"Missing users\"}");
+      return;
+    }
+    
+    DynamicJsonDocument responseDoc(LARGE_JSON_BUFFER_SIZE);
+    JsonArray addedArray = responseDoc.createNestedArray("added");
+    
+    for (JsonObject user : json["users"].as<JsonArray>()) {
+      String rfid_uid = user["rfid_uid"].as<String>();
+      unsigned long startsInMs = user["starts_in_ms"] | 0UL;
+      if (addTempUser(rfid_uid, user["name"] | "Unknown", startsInMs)) {
+        addedArray.add(rfid_uid);
+      }
+    }
+    
+    responseDoc["success"] = true;
+    String response;
+    serializeJson(responseDoc, response);
+    request->send(200, "application/json", response);
+  }));
+
   // Optimized API endpoint to get current temp users status
   server.on("/api/status", HTTP_GET, [](AsyncWebServerRequest *request) {
     DynamicJsonDocument doc(LARGE_JSON_BUFFER_SIZE);
@@ -334,16 +427,17 @@ void processRFIDCard() {
   // Step 1: Check ESP's temporary table first (optimized search)
   if (checkTempAccess(cardUID)) {
     Serial.println("✅ Access granted from ESP table");
-    grantAccess(cardUID);
+    grantAccess(cardUID, true);
     return;
   }
 
   Serial.println("❓ Card not found in ESP table, checking server...");
 
   // Step 2: Check server for active reservation
+  // (the server already logged its own decision)
   if (checkServerReservation(cardUID)) {
     Serial.println("✅ Active reservation found, access granted");
-    grantAccess(cardUID);
+    grantAccess(cardUID, false);
   } else {
     Serial.println("❌ No active reservation found, access denied");
     denyAccess(cardUID);
@@ -367,6 +461,11 @@ String getCardUID() {
 bool checkTempAccess(const String& uid) {
   for (int i = 0; i < MAX_TEMP_USERS; i++) {
     if (tempUsers[i].isActive && uid.equals(tempUsers[i].uid)) {
+      // Pre-warmed grant whose reservation has not started yet
+      if (tempUsers[i].activeFromMs != 0 && (long)(millis() - tempUsers[i].activeFromMs) < 0) {
+        Serial.printf("⏳ Found in ESP table but not active yet: %s\n", tempUsers[i].name);
+        return false;
+      }
       Serial.printf("💾 Found in ESP table: %s (Permanent access)\n", tempUsers[i].name);
       return true;
     }
@@ -374,6 +473,52 @@ bool checkTempAccess(const String& uid) {
   return false;
 }
 
+void syncAllowlist() {
+  if (WiFi.status() != WL_CONNECTED) {
+    return;
+  }
+
+  HTTPClient http;
+  String url = String(serverURL) + "/api/esp32/sync?room=" + room + "&version=" + String(allowlistVersion);
+  http.begin(url);
+  http.setTimeout(httpTimeout);
+
+  int responseCode = http.GET();
+
+  if (responseCode == 304) {
+    serverConnected = true;
+  } else if (responseCode == 200) {
+    DynamicJsonDocument doc(SYNC_JSON_BUFFER_SIZE);
+
+    if (deserializeJson(doc, http.getStream()) == DeserializationError::Ok) {
+      if (doc["full"] | false) {
+        // Full snapshot: replace the whole table
+        initializeTempStorage();
+        for (JsonObject user : doc["users"].as<JsonArray>()) {
+          addTempUser(user["rfid_uid"].as<String>(), user["name"] | "Unknown", 0);
+        }
+      } else {
+        for (JsonVariant uid : doc["removed"].as<JsonArray>()) {
+          removeTempUserByUID(uid.as<String>());
+        }
+        for (JsonObject user : doc["added"].as<JsonArray>()) {
+          addTempUser(user["rfid_uid"].as<String>(), user["name"] | "Unknown", 0);
+        }
+      }
+
+      allowlistVersion = doc["version"] | allowlistVersion;
+      serverConnected = true;
+      Serial.printf("🔄 Allowlist synced to version %lu\n", allowlistVersion);
+    } else {
+      Serial.println("❌ Failed to parse allowlist sync response");
+    }
+  } else {
+    Serial.printf("⚠️ Allowlist sync failed - HTTP %d\n", responseCode);
+  }
+
+  http.end();
+}
+
 bool checkServerReservation(const String& uid) {
   if (WiFi.status() != WL_CONNECTED) {
     Serial.println("⚠️ No WiFi connection, cannot check server");
@@ -414,7 +559,7 @@ bool checkServerReservation(const String& uid) {
         
         // If server says to cache user, add them to ESP permanent table
         if (cacheUser) {
-          addTempUser(uid, userName);
+          addTempUser(uid, userName, 0);
           Serial.println("💾 User added to ESP permanent access table");
         }
         
@@ -439,14 +584,18 @@ bool checkServerReservation(const String& uid) {
   return false;
 }
 
-void addTempUser(const String& uid, const String& name) {
+bool addTempUser(const String& uid, const String& name, unsigned long startsInMs) {
   Serial.printf("💾 Adding user to ESP permanent table: %s (%s)\n", name.c_str(), uid.c_str());
   
   // Check if user already exists (optimized search)
   for (int i = 0; i < MAX_TEMP_USERS; i++) {
     if (tempUsers[i].isActive && uid.equals(tempUsers[i].uid)) {
+      // An immediate grant overrides a pending pre-warmed one
+      if (startsInMs == 0) {
+        tempUsers[i].activeFromMs = 0;
+      }
       Serial.printf("⚠️ User already exists in table: %s\n", name.c_str());
-      return;
+      return true;
     }
   }
   
@@ -455,7 +604,7 @@ void addTempUser(const String& uid, const String& name) {
   
   if (slotIndex == -1) {
     Serial.println("⚠️ ESP temp table full! Cannot add new user.");
-    return;
+    return false;
   }
   
   // Copy UID and name with bounds checking
@@ -467,9 +616,15 @@ void addTempUser(const String& uid, const String& name) {
   
   // Set as active (permanent until removed by server)
   tempUsers[slotIndex].isActive = true;
+  tempUsers[slotIndex].activeFromMs = startsInMs ? millis() + startsInMs : 0;
+  // millis() + startsInMs may wrap to 0, which would mean "active now"
+  if (startsInMs && tempUsers[slotIndex].activeFromMs == 0) {
+    tempUsers[slotIndex].activeFromMs = 1;
+  }
   
   Serial.printf("✅ User added to ESP permanent table (slot %d)\n", slotIndex);
   Serial.printf("📊 Active temp users: %d/%d\n", getActiveTempUserCount(), MAX_TEMP_USERS);
+  return true;
 }
 
 // Optimized function to find empty slot
@@ -520,7 +675,7 @@ int getActiveTempUserCount() {
   return count;
 }
 
-void grantAccess(const String& uid) {
+void grantAccess(const String& uid, bool decidedLocally) {
   Serial.printf("🚪 GRANTING ACCESS for card: %s\n", uid.c_str());
   
   // Visual and audio feedback
@@ -535,8 +690,10 @@ void grantAccess(const String& uid) {
   delay(1000);
   digitalWrite(LED_GREEN, LOW);
   
-  // Log access to server
-  logAccessToServer(uid, true);
+  // Log locally decided access to server
+  if (decidedLocally) {
+    logAccessToServer(uid, true);
+  }
 }
 
 void denyAccess(const String& uid) {
@@ -550,9 +707,6 @@ void denyAccess(const String& uid) {
     digitalWrite(LED_RED, LOW);
     delay(200);
   }
-  
-  // Log access to server
-  logAccessToServer(uid, false);
 }
 
 void openDoor() {
@@ -569,8 +723,26 @@ void closeDoor() {
 }
 
 void logAccessToServer(const String& uid, bool granted) {
-  if (WiFi.status() != WL_CONNECTED) {
-    return; // Silently fail if no connection
+  // Drop the oldest entry when the buffer is full
+  if (pendingLogCount == MAX_PENDING_LOGS) {
+    memmove(&pendingLogs[0], &pendingLogs[1], sizeof(PendingLog) * (MAX_PENDING_LOGS - 1));
+    pendingLogCount--;
+  }
+
+  PendingLog& entry = pendingLogs[pendingLogCount++];
+  strncpy(entry.uid, uid.c_str(), sizeof(entry.uid) - 1);
+  entry.uid[sizeof(entry.uid) - 1] = '\0';
+  entry.granted = granted;
+  entry.seq = ++logSeq;
+  entry.atMillis = millis();
+  preferences.putULong("log_seq", logSeq);
+
+  flushPendingLogs();
+}
+
+void flushPendingLogs() {
+  if (pendingLogCount == 0 || WiFi.status() != WL_CONNECTED) {
+    return; // Keep buffered until the connection is back
   }
 
   HTTPClient http;
@@ -579,20 +751,32 @@ void logAccessToServer(const String& uid, bool granted) {
   http.setTimeout(httpTimeout);
   http.addHeader("Content-Type", "application/json");
 
-  DynamicJsonDocument doc(JSON_BUFFER_SIZE);
-  doc["rfid_uid"] = uid;
+  DynamicJsonDocument doc(LOG_JSON_BUFFER_SIZE);
   doc["room"] = room;
-  doc["access_granted"] = granted;
   doc["mac_address"] = WiFi.macAddress();
   doc["ip_address"] = WiFi.localIP().toString();
 
+  // No real-time clock: send each event's age so the server can date it
+  unsigned long now = millis();
+  JsonArray events = doc.createNestedArray("events");
+  for (int i = 0; i < pendingLogCount; i++) {
+    JsonObject event = events.createNestedObject();
+    event["rfid_uid"] = pendingLogs[i].uid;
+    event["access_granted"] = pendingLogs[i].granted;
+    event["seq"] = pendingLogs[i].seq;
+    event["age_ms"] = now - pendingLogs[i].atMillis;
+  }
+
   String payload;
   serializeJson(doc, payload);
   
   int responseCode = http.POST(payload);
   
   if (responseCode == 200) {
-    Serial.println("✅ Access logged successfully");
+    Serial.printf("✅ %d access log(s) uploaded\n", pendingLogCount);
+    pendingLogCount = 0;
+  } else {
+    Serial.printf("⚠️ Access log upload failed (%d), %d event(s) buffered\n", responseCode, pendingLogCount);
   }
   
   http.end();
@@ -1,25 +1,158 @@
 from flask import (
     Flask, request, jsonify, render_template,
-    session, redirect, url_for, flash, send_from_directory
+    session, redirect, url_for, flash, send_from_directory, Response
 )
 from functools import wraps
-from flask_socketio import SocketIO, emit
+import click
+from flask_socketio import SocketIO, emit, join_room
 from flask_cors import CORS
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
 import threading
+import queue
+import atexit
 import time
 import requests
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait
 import csv
+import io
+import hashlib
+import hmac
+import gzip
+import shutil
+import tempfile
+import json
+import base64
+import heapq
+import itertools
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager
 from uuid import uuid4
 
+try:
+    import numpy as np
+except ImportError:  # analytics endpoints report 503 without it
+    np = None
+
 
 app = Flask(__name__)
 
 # Database configuration
 DATABASE = 'database.db'
+# NACS_DATABASE points the server (or the benchmark suite) at another file
+DB_PATH = os.path.abspath(os.environ.get('NACS_DATABASE') or os.path.join(os.path.dirname(__file__), DATABASE))
+
+# SQLite connection tuning (applied once per pooled connection)
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 20000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_POOL_MAX_IDLE = 10
+
+# Access log writer (group commit of access_logs rows)
+ACCESS_LOG_FLUSH_INTERVAL_MS = 200
+ACCESS_LOG_BATCH_SIZE = 200
+ACCESS_LOG_QUEUE_SIZE = 10000
+# A failed batch is retried this many times (with backoff) before its events
+# are written one by one
+ACCESS_LOG_WRITE_RETRIES = 5
+
+# Largest number of events accepted by one /api/esp32/access_log upload
+ACCESS_LOG_MAX_UPLOAD = 500
+
+# Access log partitions: access_logs keeps the current month plus
+# ACCESS_LOG_HOT_MONTHS full months; older months are moved into one gzipped
+# SQLite file per month under ACCESS_LOG_ARCHIVE_DIR and deleted after
+# ACCESS_LOG_ARCHIVE_MONTHS months (None keeps them forever)
+ACCESS_LOG_HOT_MONTHS = 3
+ACCESS_LOG_ARCHIVE_MONTHS = None
+ACCESS_LOG_ARCHIVE_DIR = os.path.join(os.path.dirname(DB_PATH), 'access_log_archive')
+ACCESS_LOG_ARCHIVE_INTERVAL = 6 * 3600
+ACCESS_LOG_ARCHIVE_CACHE = 2
+
+# Access rollups: distinct users per room and day are estimated with a
+# HyperLogLog sketch of 2**HLL_PRECISION one-byte registers (~3% error)
+HLL_PRECISION = 10
+ANALYTICS_DEFAULT_DAYS = 30
+
+# Cache expiry scheduler: full resync from esp32_cache as a safety net
+EXPIRY_RESYNC_INTERVAL = 300
+
+# ESP32 fan-out: (connect, read) timeout per device request, worker threads
+# shared by all devices and overall deadline for one cleanup pass
+ESP32_REQUEST_TIMEOUT = (3, 5)
+ESP32_FANOUT_WORKERS = 8
+ESP32_FANOUT_DEADLINE = 15
+
+# Per-room allowlist delta sync: how often time-driven changes (windows
+# starting or ending) are picked up, and how many versions of change history
+# are kept per room before devices fall back to a full snapshot
+ALLOWLIST_REFRESH_INTERVAL = 30
+ALLOWLIST_CHANGES_RETAINED = 1000
+
+# Users inserted by another process (the `flask import-users` command) are
+# picked up by the running server within USER_SYNC_INTERVAL seconds
+USER_SYNC_INTERVAL = 15
+
+# /metrics histogram buckets (seconds): HTTP requests and their DB time,
+# and one pass of a background worker
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_WORKER_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0)
+# /metrics needs an admin session or `Authorization: Bearer <NACS_METRICS_TOKEN>`
+# (for Prometheus); without the variable only logged-in admins can read it
+METRICS_TOKEN = os.environ.get('NACS_METRICS_TOKEN')
+
+# Query tracing: statements slower than QUERY_SLOW_MS are logged (once per
+# fingerprint) with their EXPLAIN QUERY PLAN; at most QUERY_FINGERPRINTS_MAX
+# distinct fingerprints are tracked (the rest are counted as '<other>')
+QUERY_SLOW_MS = 100
+QUERY_FINGERPRINTS_MAX = 1000
+
+# check_access keeps its last ACCESS_TRACE_SIZE decisions in memory;
+# per-room/card diagnostics default to DIAGNOSTICS_DEFAULT_MINUTES
+ACCESS_TRACE_SIZE = 5000
+DIAGNOSTICS_DEFAULT_MINUTES = 60
+
+# Door cache pre-warm: push grants starting within PREWARM_LOOKAHEAD to the
+# room's device ahead of time, checking every PREWARM_INTERVAL seconds
+PREWARM_LOOKAHEAD = timedelta(minutes=10)
+PREWARM_INTERVAL = 60
+
+# Admin dashboard push: at most one coalesced update per interval, and at
+# most DASHBOARD_MAX_EVENTS events of one kind per update (beyond that the
+# dashboard is told to reload that table instead)
+DASHBOARD_PUSH_INTERVAL = 1.0
+DASHBOARD_MAX_EVENTS = 200
+DASHBOARD_ROOM = 'admins'
+
+# Dashboard statistics are kept as counters updated by the write paths and
+# recounted from the tables every STATS_RECONCILE_INTERVAL seconds
+STATS_RECONCILE_INTERVAL = 300
+
+# Admin list endpoints return pages of PAGE_SIZE_DEFAULT rows (at most
+# PAGE_SIZE_MAX) with an opaque cursor for the next page
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 500
+
+# Exports stream rows from a live cursor EXPORT_BATCH_SIZE rows at a time
+EXPORT_BATCH_SIZE = 500
+
+# Most requests one bulk approve/deny call may change
+BULK_DECISION_MAX = 5000
+
+# Bulk user import: largest accepted file and rows per insert transaction
+USER_IMPORT_MAX_ROWS = 20000
+USER_IMPORT_CHUNK_SIZE = 500
+
+# Recurring reservations are expanded into occurrences for the current week
+# (plus a day, so lookahead across Sunday midnight stays cached); a single
+# rule may span at most RECURRING_MAX_DAYS
+RECURRING_CACHE_DAYS = 8
+RECURRING_MAX_DAYS = 366
 
 app.secret_key = 'NACS'
 
@@ -35,7 +168,7 @@ logger = logging.getLogger(__name__)
 
 def init_database():
     """Initialize the SQLite database with required tables"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # Users table - stores all users with their roles
@@ -139,129 +272,2667 @@ def init_database():
         )
         print("✅ Sample users added to database")
 
-    cursor.execute('SELECT COUNT(*) FROM users_reg')
-    if cursor.fetchone()[0] == 0:
-        sample_users = [
-            ('EA20B1CC', '6630406711', 'Apichet', 'Thamraksa', 'Apichet Thamraksa','apichet.t@kkumail.com', 'student'),
-            ('631FBF15', '6630406712', 'Testing', 'Name', 'Testing Name', 'test@kkumail.com', 'student'),
-            ('C3228B12', '6630406713', 'Testing', 'Name2', 'Testing Name2', 'test@kku.ac.th', 'admin'),
-        ]
-        
-        cursor.executemany(
-            'INSERT INTO users_reg (uuid, user_id, first_name, last_name, name, email, role) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            sample_users
-        )
-        print("✅ Sample users added to database")
-    
+    cursor.execute('SELECT COUNT(*) FROM users_reg')
+    if cursor.fetchone()[0] == 0:
+        sample_users = [
+            ('EA20B1CC', '6630406711', 'Apichet', 'Thamraksa', 'Apichet Thamraksa','apichet.t@kkumail.com', 'student'),
+            ('631FBF15', '6630406712', 'Testing', 'Name', 'Testing Name', 'test@kkumail.com', 'student'),
+            ('C3228B12', '6630406713', 'Testing', 'Name2', 'Testing Name2', 'test@kku.ac.th', 'admin'),
+        ]
+        
+        cursor.executemany(
+            'INSERT INTO users_reg (uuid, user_id, first_name, last_name, name, email, role) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            sample_users
+        )
+        print("✅ Sample users added to database")
+    
+
+    conn.commit()
+    run_migrations(conn)
+    conn.close()
+    print("✅ Database initialized successfully")
+
+# ================== SCHEMA MIGRATIONS ==================
+
+def _dedupe_esp32_cache(cursor):
+    """Keep only the newest cache row per (room, rfid_uid) so it can be made unique"""
+    cursor.execute('''
+        DELETE FROM esp32_cache
+        WHERE id NOT IN (SELECT MAX(id) FROM esp32_cache GROUP BY room, rfid_uid)
+    ''')
+
+# Ordered list of (version, description, steps). A step is either a SQL
+# statement or a callable taking a cursor. Never edit an applied migration,
+# append a new one instead.
+MIGRATIONS = [
+    (1, 'Index users_reg lookups', [
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_uuid ON users_reg(uuid)',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_user_id ON users_reg(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_name ON users_reg(name)',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_active_uuid ON users_reg(uuid) WHERE is_deleted = 0',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_active_user_id ON users_reg(user_id) WHERE is_deleted = 0',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_active_email ON users_reg(email) WHERE is_deleted = 0',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_active_created_at ON users_reg(created_at) WHERE is_deleted = 0',
+    ]),
+    (2, 'Index requests lookups', [
+        'CREATE INDEX IF NOT EXISTS idx_requests_uid_room_access ON requests(uid, room, access, start_time, end_time)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_timestamp ON requests(timestamp)',
+    ]),
+    (3, 'Index access_logs by time', [
+        'CREATE INDEX IF NOT EXISTS idx_access_logs_timestamp ON access_logs(timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_access_logs_room_timestamp ON access_logs(room, timestamp)',
+    ]),
+    (4, 'Index esp32_cache and make (room, rfid_uid) unique', [
+        'CREATE INDEX IF NOT EXISTS idx_esp32_cache_room_status ON esp32_cache(room, expired_status)',
+        'CREATE INDEX IF NOT EXISTS idx_esp32_cache_expires_at ON esp32_cache(expires_at)',
+        _dedupe_esp32_cache,
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_esp32_cache_room_uid ON esp32_cache(room, rfid_uid)',
+    ]),
+    (5, 'Track device id and sequence number on access_logs', [
+        'ALTER TABLE access_logs ADD COLUMN device_id TEXT',
+        'ALTER TABLE access_logs ADD COLUMN device_seq INTEGER',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_access_logs_device_seq ON access_logs(device_id, device_seq) WHERE device_seq IS NOT NULL',
+    ]),
+    (6, 'Versioned per-room allowlists for ESP32 delta sync', [
+        '''CREATE TABLE IF NOT EXISTS room_versions (
+            room TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS room_allowlist (
+            room TEXT NOT NULL,
+            rfid_uid TEXT NOT NULL,
+            name TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (room, rfid_uid)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS room_allowlist_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            rfid_uid TEXT NOT NULL,
+            op TEXT NOT NULL CHECK(op IN ('add', 'remove')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_room_allowlist_changes_room_version ON room_allowlist_changes(room, version)',
+    ]),
+    (7, 'Index the filtered, keyset-paginated admin lists', [
+        'CREATE INDEX IF NOT EXISTS idx_requests_room_timestamp ON requests(room, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_uid_timestamp ON requests(uid, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_pending_timestamp ON requests(timestamp) WHERE access = FALSE AND approved_by IS NULL',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_created_at ON users_reg(created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_reg_role_created_at ON users_reg(role, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_access_logs_uid_timestamp ON access_logs(rfid_uid, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_esp32_cache_room_expires_at ON esp32_cache(room, expires_at)',
+    ]),
+    (8, 'Add hourly access rollups and daily distinct-user sketches', [
+        '''CREATE TABLE IF NOT EXISTS access_rollups_hourly (
+            hour TEXT NOT NULL,
+            room TEXT NOT NULL,
+            access_granted BOOLEAN NOT NULL,
+            access_type TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, room, access_granted, access_type)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS access_rollups_users_daily (
+            day TEXT NOT NULL,
+            room TEXT NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (day, room)
+        ) WITHOUT ROWID''',
+        lambda cursor: rollup_access_logs(cursor, 0),
+    ]),
+    (9, 'Add an optional per-room booking capacity', [
+        'ALTER TABLE rooms ADD COLUMN capacity INTEGER',
+    ]),
+    (10, 'Add recurring reservation rules', [
+        '''CREATE TABLE IF NOT EXISTS recurring_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT NOT NULL,
+            name TEXT NOT NULL,
+            room TEXT NOT NULL,
+            weekdays TEXT NOT NULL,
+            start_clock TEXT NOT NULL,
+            end_clock TEXT NOT NULL,
+            first_date TEXT NOT NULL,
+            last_date TEXT NOT NULL,
+            interval_weeks INTEGER NOT NULL DEFAULT 1,
+            exceptions TEXT NOT NULL DEFAULT '[]',
+            access BOOLEAN DEFAULT FALSE,
+            approved_by TEXT,
+            approved_at TIMESTAMP,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_recurring_requests_last_date ON recurring_requests(last_date)',
+        'CREATE INDEX IF NOT EXISTS idx_recurring_requests_uid ON recurring_requests(uid, timestamp)',
+    ]),
+    (11, 'Add auto-approval policies and migrate rooms.auto_approve', [
+        '''CREATE TABLE IF NOT EXISTS approval_policies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT,
+            role TEXT,
+            weekdays TEXT,
+            window_start TEXT,
+            window_end TEXT,
+            max_duration_minutes INTEGER,
+            max_active_per_user INTEGER,
+            action TEXT NOT NULL DEFAULT 'approve' CHECK (action IN ('approve', 'deny')),
+            priority INTEGER NOT NULL DEFAULT 100,
+            enabled BOOLEAN NOT NULL DEFAULT 1,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''INSERT INTO approval_policies (room, action, description)
+           SELECT room, 'approve', 'Migrated from rooms.auto_approve'
+           FROM rooms WHERE auto_approve = 1''',
+    ]),
+]
+
+def get_schema_version(conn):
+    """Return the highest applied migration version (0 for a fresh database)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+def run_migrations(conn):
+    """Apply pending migrations in order, each in its own transaction"""
+    current = get_schema_version(conn)
+    applied = 0
+
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"❌ Migration {version} ({description}) failed: {str(e)}")
+            raise
+
+        applied += 1
+        print(f"✅ Applied migration {version}: {description}")
+
+    if applied:
+        # Refresh planner statistics so the new indexes are actually used
+        conn.execute('ANALYZE')
+        conn.commit()
+
+    return applied
+
+# ================== METRICS ==================
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Monotonic counter with one series per label tuple"""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_format_labels(self.labels, values)} {value}' for values, value in series)
+        return lines
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect and a dict lookup"""
+
+    def __init__(self, name, description, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # [per-bucket counts (last one is +Inf), sum]
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        with self._lock:
+            series = sorted((values, list(counts), total) for values, (counts, total) in self._series.items())
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                labels = _format_labels(self.labels, values, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, values)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, values)} {cumulative}')
+        return lines
+
+class Gauge:
+    """Gauge read at scrape time: collect() yields (label values, value)"""
+
+    def __init__(self, name, description, labels, collect):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge']
+        lines.extend(f'{self.name}{_format_labels(self.labels, values)} {value}'
+                     for values, value in sorted(self.collect()))
+        return lines
+
+class MetricsRegistry:
+    """Metrics exposed on /metrics in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def gauge(self, name, description, labels, collect):
+        return self._add(Gauge(name, description, labels, collect))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"❌ Failed to collect metric {metric.name}: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+http_request_seconds = metrics.histogram(
+    'nacs_http_request_duration_seconds', 'HTTP request latency by route and status',
+    ('method', 'route', 'status'))
+http_request_db_seconds = metrics.histogram(
+    'nacs_http_request_db_seconds', 'Time spent in SQLite calls while handling one HTTP request',
+    ('method', 'route'))
+worker_loop_seconds = metrics.histogram(
+    'nacs_worker_loop_duration_seconds', 'Duration of one pass of a background worker',
+    ('worker',), METRICS_WORKER_BUCKETS)
+esp32_fanout_total = metrics.counter(
+    'nacs_esp32_fanout_total', 'ESP32 device calls per room by operation and outcome',
+    ('room', 'operation', 'outcome'))
+
+# Per-room fan-out status -> outcome label
+FANOUT_OUTCOMES = {'ok': 'success', 'partial': 'failure', 'error': 'failure', 'timeout': 'timeout'}
+
+# Per-thread clocks: when the current HTTP request started and how long its
+# SQLite calls have taken so far
+class _Clock(threading.local):
+    started = None
+    seconds = 0.0
+
+_request_clock = _Clock()
+_db_clock = _Clock()
+
+@app.before_request
+def start_request_clock():
+    _request_clock.started = time.perf_counter()
+    _db_clock.seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe latency and DB time (streamed bodies are timed up to the first byte)"""
+    started = _request_clock.started
+    if started is not None:
+        _request_clock.started = None
+        # Each access through the request proxy costs microseconds: resolve it once
+        req = request._get_current_object()
+        rule = req.url_rule
+        route = rule.rule if rule is not None else '<unmatched>'
+        http_request_seconds.observe(time.perf_counter() - started, req.method, route, response.status_code)
+        http_request_db_seconds.observe(_db_clock.seconds, req.method, route)
+    return response
+
+# ================== QUERY TRACING ==================
+
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SQL_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SQL_SPACE = re.compile(r'\s+')
+_SQL_EXPLAINABLE = re.compile(r'\s*(?:SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE)
+
+def sql_fingerprint(sql):
+    """Normalize a statement: literals become ?, placeholder lists (?, ...)"""
+    sql = _SQL_STRING.sub('?', sql)
+    sql = _SQL_NUMBER.sub('?', sql)
+    sql = _SQL_PLACEHOLDER_LIST.sub('(?, ...)', sql)
+    return _SQL_SPACE.sub(' ', sql).strip()
+
+def blank_params(params):
+    """Same shape as params with every value NULL (enough for EXPLAIN QUERY PLAN)"""
+    if isinstance(params, dict):
+        return dict.fromkeys(params)
+    if isinstance(params, (list, tuple)):
+        return (None,) * len(params)
+    return ()
+
+def is_full_scan(plan):
+    """True when an EXPLAIN QUERY PLAN reads a whole table or index"""
+    return any(step.startswith('SCAN ') and step != 'SCAN CONSTANT ROW' for step in plan)
+
+class QueryTracer:
+    """Per-fingerprint timing of every statement run on a pooled connection.
+
+    record() is called after each execute; it adds the time to the thread's
+    DB clock and to the statement's fingerprint stats. The first time a
+    fingerprint takes longer than slow_ms its EXPLAIN QUERY PLAN is captured
+    and logged. Only queries and DML are explained, and with NULLs in place of
+    the parameters, so no card UIDs or names are kept. Fingerprints are
+    memoized per SQL string, so the regexes run once per distinct statement text.
+    """
+
+    def __init__(self, slow_ms=QUERY_SLOW_MS, max_fingerprints=QUERY_FINGERPRINTS_MAX):
+        self.slow = slow_ms / 1000
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        self._stats = {}
+        self.since = datetime.now()
+
+    def _fingerprint(self, sql):
+        fingerprint = self._fingerprints.get(sql)
+        if fingerprint is None:
+            fingerprint = sql_fingerprint(sql)
+            if len(self._fingerprints) >= self.max_fingerprints * 4:
+                # SQL built with f-strings can have unbounded distinct texts
+                self._fingerprints.clear()
+            self._fingerprints[sql] = fingerprint
+        return fingerprint
+
+    def record(self, conn, sql, params, seconds, many=False):
+        _db_clock.seconds += seconds
+        fingerprint = self._fingerprint(sql)
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    fingerprint, sql, params = '<other>', None, None
+                    stats = self._stats.get(fingerprint)
+                if stats is None:
+                    if sql is not None and not _SQL_EXPLAINABLE.match(sql):
+                        # DDL, PRAGMAs and transaction control have no query plan
+                        sql = None
+                    if many:
+                        params = params[0] if isinstance(params, (list, tuple)) and params else None
+                    stats = self._stats[fingerprint] = {
+                        'count': 0, 'total': 0.0, 'max': 0.0, 'slow': 0,
+                        'sql': sql, 'params': blank_params(params), 'plan': None
+                    }
+            stats['count'] += 1
+            stats['total'] += seconds
+            if seconds > stats['max']:
+                stats['max'] = seconds
+            if seconds < self.slow:
+                return
+            stats['slow'] += 1
+            if stats['plan'] is not None or stats['sql'] is None:
+                return
+            stats['plan'] = []
+
+        plan = self.capture_plan(conn, stats)
+        logger.warning(f"🐢 Slow query ({seconds * 1000:.1f} ms): {fingerprint}\n"
+                       + '\n'.join(f'    {step}' for step in plan))
+
+    def capture_plan(self, conn, stats):
+        """Explain a fingerprint's statement and keep the plan in its stats"""
+        plan = self.explain(conn, stats['sql'], stats['params'])
+        with self._lock:
+            stats['plan'] = plan
+        return plan
+
+    def plan(self, conn, fingerprint):
+        """The fingerprint's plan, capturing it now if it was never slow"""
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None or stats['sql'] is None:
+                return None
+            if stats['plan'] is not None:
+                return stats['plan']
+            stats['plan'] = []
+        return self.capture_plan(conn, stats)
+
+    @staticmethod
+    def explain(conn, sql, params):
+        """EXPLAIN QUERY PLAN details for one statement (never raises)"""
+        try:
+            # Straight to sqlite3 so the EXPLAIN itself is not traced
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.Error as e:
+            return [f'(plan unavailable: {e})']
+
+    def top(self, limit=20, order='total'):
+        """Fingerprints sorted by total, mean or max time, or by count"""
+        with self._lock:
+            rows = [(fingerprint, dict(stats)) for fingerprint, stats in self._stats.items()]
+        key = {
+            'count': lambda item: item[1]['count'],
+            'max': lambda item: item[1]['max'],
+            'mean': lambda item: item[1]['total'] / item[1]['count'],
+        }.get(order, lambda item: item[1]['total'])
+        rows.sort(key=key, reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.since = datetime.now()
+
+query_tracer = QueryTracer()
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor whose statements are traced like PooledConnection.execute"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_tracer.record(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            query_tracer.record(self.connection, sql, parameters, time.perf_counter() - started, many=True)
+
+# ================== DATABASE CONNECTION POOL ==================
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to its pool.
+
+    Every statement is timed by the query tracer, which also adds it to the
+    calling thread's DB clock for /metrics. Timing covers the statement's
+    first step (all of it for writes, sorts and aggregates); rows fetched
+    afterwards are not timed.
+    """
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_tracer.record(self, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            query_tracer.record(self, sql, parameters, time.perf_counter() - started, many=True)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _db_clock.seconds += time.perf_counter() - started
+
+    def close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is None:
+            super().close()
+        else:
+            pool._release(self)
+
+    def _really_close(self):
+        sqlite3.Connection.close(self)
+
+class ConnectionPool:
+    """Pool of reusable SQLite connections configured once with tuned pragmas.
+
+    Connections are handed out by acquire() and returned by conn.close(), so
+    existing code keeps its usual open/close pattern. A connection that is
+    garbage collected while still checked out is counted as leaked.
+    """
+
+    def __init__(self, path, max_idle=DB_POOL_MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._reused = 0
+        self._closed = 0
+        self._leaked = 0
+        self._in_use = 0
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            factory=PooledConnection
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def acquire(self):
+        """Check out a connection, reusing an idle one when available"""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None:
+                self._reused += 1
+            self._in_use += 1
+
+        if conn is None:
+            try:
+                conn = self._open()
+            except Exception:
+                with self._lock:
+                    self._in_use -= 1
+                raise
+            with self._lock:
+                self._opened += 1
+
+        conn.row_factory = sqlite3.Row
+        conn._pool = self
+        conn._finalizer = weakref.finalize(conn, self._on_leak)
+        return conn
+
+    def _release(self, conn):
+        conn._finalizer.detach()
+        conn._pool = None
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn._really_close()
+            with self._lock:
+                self._in_use -= 1
+                self._closed += 1
+            return
+
+        with self._lock:
+            self._in_use -= 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._closed += 1
+        conn._really_close()
+
+    def _on_leak(self):
+        with self._lock:
+            self._in_use -= 1
+            self._leaked += 1
+        logger.warning("⚠️ Database connection was garbage collected without close()")
+
+    def close_all(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+            self._closed += len(idle)
+        for conn in idle:
+            conn._really_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'opened': self._opened,
+                'reused': self._reused,
+                'closed': self._closed,
+                'leaked': self._leaked,
+                'in_use': self._in_use,
+                'idle': len(self._idle)
+            }
+
+db_pool = ConnectionPool(DB_PATH)
+
+def get_db_connection():
+    """Get database connection (from the pool; close() returns it)"""
+    return db_pool.acquire()
+
+# Authentication functions
+def login_required(f):
+    """Decorator to require authentication for routes"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'admin_user' not in session:
+            return redirect(url_for('admin_login'))
+        
+        # Check session timeout
+        if 'login_time' in session:
+            login_time = datetime.fromisoformat(session['login_time'])
+            if datetime.now() - login_time > SESSION_TIMEOUT:
+                session.clear()
+                flash('Session expired. Please login again.', 'error')
+                return redirect(url_for('admin_login'))
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+# API authentication decorator (for AJAX requests)
+def api_login_required(f):
+    """Decorator for API endpoints that require authentication"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'admin_user' not in session:
+            return jsonify({'error': 'Authentication required'}), 401
+        
+        # Check session timeout
+        if 'login_time' in session:
+            login_time = datetime.fromisoformat(session['login_time'])
+            if datetime.now() - login_time > SESSION_TIMEOUT:
+                session.clear()
+                return jsonify({'error': 'Session expired'}), 401
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# ================== AUTHORIZATION INDEX ==================
+
+def parse_db_datetime(value):
+    """Parse a stored timestamp ('2025-06-10T14:50:00' or '2025-06-10 14:50:00')"""
+    if 'T' in value:
+        return datetime.fromisoformat(value.replace('T', ' '))
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+class IntervalIndex:
+    """Static interval tree over (start, end, ...) tuples.
+
+    Intervals are sorted by start and an implicit segment tree keeps the
+    maximum end of every subrange, so overlap and point queries visit only
+    the O(log n) nodes on the search path plus the k matches. The index is
+    immutable; owners rebuild it when the underlying rows change.
+    """
+
+    def __init__(self, intervals=()):
+        self.intervals = sorted(intervals, key=lambda interval: interval[:2])
+        self.starts = [interval[0] for interval in self.intervals]
+        size = 1
+        while size < len(self.intervals):
+            size *= 2
+        tree = [datetime.min] * (2 * size)
+        for i, interval in enumerate(self.intervals):
+            tree[size + i] = interval[1]
+        for node in range(size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self._size = size
+        self._max_end = tree
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _collect(self, hi, after, inclusive):
+        """Intervals among the first `hi` (by start) whose end is after `after`"""
+        found = []
+        stack = [(1, 0, self._size)] if hi > 0 else []
+        while stack:
+            node, lo, node_hi = stack.pop()
+            if lo >= hi:
+                continue
+            end = self._max_end[node]
+            if end < after or (end == after and not inclusive):
+                continue
+            if node >= self._size:
+                found.append(self.intervals[node - self._size])
+                continue
+            mid = (lo + node_hi) // 2
+            stack.append((2 * node + 1, mid, node_hi))
+            stack.append((2 * node, lo, mid))
+        return found
+
+    def overlapping(self, start, end):
+        """Intervals sharing time with [start, end); back-to-back ones do not overlap"""
+        return self._collect(bisect_left(self.starts, end), start, False)
+
+    def at(self, moment):
+        """Intervals with start <= moment <= end"""
+        return self._collect(bisect_right(self.starts, moment), moment, True)
+
+    def starting_between(self, start, end):
+        """Intervals whose start lies in [start, end]"""
+        return self.intervals[bisect_left(self.starts, start):bisect_right(self.starts, end)]
+
+    def peak(self, start, end):
+        """Largest number of intervals in use at the same time within [start, end)"""
+        events = []
+        for interval in self.overlapping(start, end):
+            events.append((max(interval[0], start), 1))
+            events.append((min(interval[1], end), -1))
+        # At equal times the -1 sorts first, so a booking ending at 10:00
+        # does not stack with one starting at 10:00
+        events.sort()
+        peak = current = 0
+        for _, delta in events:
+            current += delta
+            peak = max(peak, current)
+        return peak
+
+class AuthorizationIndex:
+    """In-memory view of users_reg and approved requests used by check_access.
+
+    Users are keyed by RFID uuid, approved request windows by (uid, room) and
+    held in an IntervalIndex so the active window is found without a scan.
+    Occurrences of approved recurring rules come from recurring_schedule.
+    Every write path that touches users_reg or requests must call one of the
+    refresh_* methods after its commit.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users = {}
+        self._grants = {}
+        self._room_uids = {}
+        self._listeners = []
+        self._built = False
+        self._max_user_id = 0
+
+    def add_listener(self, callback):
+        """Call callback(rooms) after the index changes (rooms=None means all)"""
+        self._listeners.append(callback)
+
+    def _notify(self, rooms):
+        for callback in self._listeners:
+            try:
+                callback(rooms)
+            except Exception as e:
+                logger.error(f"❌ Authorization index listener failed: {str(e)}")
+
+    def build(self):
+        """Load all active users and all approved, not yet ended requests"""
+        users = {}
+        grants = {}
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT id, uuid, name, role
+                FROM users_reg
+                WHERE is_deleted = 0
+                ORDER BY id
+            ''').fetchall()
+            for row in rows:
+                users.setdefault(row['uuid'], dict(row))
+            max_user_id = rows[-1]['id'] if rows else 0
+
+            rows = conn.execute('''
+                SELECT id, uid, room, start_time, end_time, timestamp
+                FROM requests
+                WHERE access = 1
+                AND datetime(end_time) >= datetime(?)
+            ''', (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchall()
+            for row in rows:
+                grants.setdefault((row['uid'], row['room']), []).append(row)
+        finally:
+            conn.close()
+
+        room_uids = {}
+        for uid, room in grants:
+            room_uids.setdefault(room, set()).add(uid)
+
+        with self._lock:
+            self._users = users
+            self._grants = {key: self._make_windows(rows) for key, rows in grants.items()}
+            self._room_uids = room_uids
+            self._max_user_id = max(self._max_user_id, max_user_id)
+            self._built = True
+
+        logger.info(f"Authorization index built: {len(users)} users, {len(grants)} user/room grants")
+        self._notify(None)
+
+    def _ensure_built(self):
+        if not self._built:
+            self.build()
+
+    @staticmethod
+    def _make_windows(rows):
+        """Turn request rows into an IntervalIndex of window tuples"""
+        windows = []
+        for row in rows:
+            try:
+                start = parse_db_datetime(row['start_time'])
+                end = parse_db_datetime(row['end_time'])
+            except ValueError:
+                continue
+            windows.append((start, end, row['timestamp'] or '', row['id'],
+                            row['start_time'], row['end_time']))
+        return IntervalIndex(windows)
+
+    def refresh_user(self, *uuids):
+        """Reload the given uuids from users_reg"""
+        if not self._built:
+            return
+        uuids = set(u for u in uuids if u)
+        conn = get_db_connection()
+        try:
+            for uuid in uuids:
+                row = conn.execute('''
+                    SELECT id, uuid, name, role
+                    FROM users_reg
+                    WHERE uuid = ? AND is_deleted = 0
+                    ORDER BY id
+                    LIMIT 1
+                ''', (uuid,)).fetchone()
+                with self._lock:
+                    if row:
+                        self._users[uuid] = dict(row)
+                    else:
+                        self._users.pop(uuid, None)
+        finally:
+            conn.close()
+
+        with self._lock:
+            rooms = {room for uid, room in self._grants if uid in uuids}
+        if rooms:
+            self._notify(rooms)
+
+    def sync_new_users(self):
+        """Load users_reg rows added since the last look that no write path reported.
+
+        Rows inserted by this process were already added by refresh_user; what
+        is left came from another process (the import-users command). Returns
+        the newly seen users.
+        """
+        if not self._built:
+            return []
+        with self._lock:
+            after = self._max_user_id
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT id, uuid, name, role
+                FROM users_reg
+                WHERE id > ? AND is_deleted = 0
+                ORDER BY id
+            ''', (after,)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return []
+
+        with self._lock:
+            new = [dict(row) for row in rows if row['uuid'] not in self._users]
+            for user in new:
+                self._users.setdefault(user['uuid'], user)
+            self._max_user_id = max(self._max_user_id, rows[-1]['id'])
+            uids = {user['uuid'] for user in new}
+            rooms = {room for uid, room in self._grants if uid in uids}
+        if rooms:
+            self._notify(rooms)
+        return new
+
+    def refresh_grants(self, uid, room):
+        """Reload the approved request windows of one user in one room"""
+        self.refresh_grants_many([(uid, room)])
+
+    def refresh_grants_many(self, pairs):
+        """Reload several (uid, room) pairs and notify listeners once for all their rooms"""
+        if not self._built:
+            return
+        pairs = set(pairs)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn = get_db_connection()
+        try:
+            loaded = {
+                (uid, room): conn.execute('''
+                    SELECT id, uid, room, start_time, end_time, timestamp
+                    FROM requests
+                    WHERE uid = ? AND room = ? AND access = 1
+                    AND datetime(end_time) >= datetime(?)
+                ''', (uid, room, now)).fetchall()
+                for uid, room in pairs
+            }
+        finally:
+            conn.close()
+
+        with self._lock:
+            for (uid, room), rows in loaded.items():
+                if rows:
+                    self._grants[(uid, room)] = self._make_windows(rows)
+                    self._room_uids.setdefault(room, set()).add(uid)
+                else:
+                    self._grants.pop((uid, room), None)
+                    self._room_uids.get(room, set()).discard(uid)
+        if pairs:
+            self._notify({room for _, room in pairs})
+
+    def refresh_request(self, request_id):
+        """Reload the grants affected by a single request row"""
+        if not self._built:
+            return
+        conn = get_db_connection()
+        try:
+            row = conn.execute('SELECT uid, room FROM requests WHERE id = ?', (request_id,)).fetchone()
+        finally:
+            conn.close()
+        if row:
+            self.refresh_grants(row['uid'], row['room'])
+
+    def grants_changed(self, rooms):
+        """Tell listeners that grants kept outside the index (recurring rules) changed"""
+        if self._built:
+            self._notify(rooms)
+
+    def get_user(self, uuid):
+        """Return the user record for a card uuid, or None"""
+        self._ensure_built()
+        with self._lock:
+            return self._users.get(uuid)
+
+    def find_active_grant(self, uid, room, at=None):
+        """Return the most recently submitted approved request covering `at`"""
+        self._ensure_built()
+        at = (at or datetime.now()).replace(microsecond=0)
+        with self._lock:
+            entry = self._grants.get((uid, room))
+            best = max(entry.at(at), key=lambda window: window[2:4], default=None) if entry else None
+        if best is None:
+            return recurring_schedule.active_grant(uid, room, at)
+        return {'id': best[3], 'start_time': best[4], 'end_time': best[5]}
+
+    def upcoming_grants(self, start, end):
+        """Approved windows starting in [start, end], as (uid, room, user, grant)"""
+        self._ensure_built()
+        upcoming = []
+        with self._lock:
+            for (uid, room), windows in self._grants.items():
+                user = self._users.get(uid)
+                if not user:
+                    continue
+                for window in windows.starting_between(start, end):
+                    upcoming.append((uid, room, user, {
+                        'id': window[3],
+                        'start': window[0],
+                        'start_time': window[4],
+                        'end_time': window[5]
+                    }))
+            for uid, room, grant in recurring_schedule.upcoming(start, end):
+                user = self._users.get(uid)
+                if user:
+                    upcoming.append((uid, room, user, grant))
+        return upcoming
+
+    def rooms(self):
+        """Rooms that have at least one approved, not yet ended request"""
+        self._ensure_built()
+        with self._lock:
+            rooms = {room for room, uids in self._room_uids.items() if uids}
+        return rooms | recurring_schedule.rooms()
+
+    def active_allowlist(self, room, at=None):
+        """Map uid -> {'name', 'expires_at'} of users allowed in room at `at`"""
+        self._ensure_built()
+        at = (at or datetime.now()).replace(microsecond=0)
+        allowed = {}
+        with self._lock:
+            for uid in set(self._room_uids.get(room, ())) | recurring_schedule.occupants(room, at):
+                user = self._users.get(uid)
+                grant = self.find_active_grant(uid, room, at) if user else None
+                if grant:
+                    allowed[uid] = {'name': user['name'], 'expires_at': grant['end_time']}
+        return allowed
+
+auth_index = AuthorizationIndex()
+
+# ================== RESERVATION INDEX ==================
+
+class ReservationIndex:
+    """Per-room IntervalIndex of pending and approved requests that have not ended.
+
+    Answers overlap, capacity and "who is booked now" questions without
+    scanning requests. Rooms are reloaded through the authorization index
+    listener, which every request write path already triggers.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rooms = {}
+        self._built = False
+        # Held by submit_request across check, insert and refresh so two
+        # submissions cannot both take the last free slot
+        self.booking_lock = threading.Lock()
+
+    def _load(self, room=None):
+        """Return {room: IntervalIndex} for one room or for all of them"""
+        sql = '''
+            SELECT id, uid, name, room, start_time, end_time, access, approved_by
+            FROM requests
+            WHERE (access = 1 OR approved_by IS NULL)
+            AND datetime(end_time) >= datetime(?)
+        '''
+        params = [datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
+        if room is not None:
+            sql += ' AND room = ?'
+            params.append(room)
+        intervals = {}
+        conn = get_db_connection()
+        try:
+            for row in conn.execute(sql, params):
+                try:
+                    start = parse_db_datetime(row['start_time'])
+                    end = parse_db_datetime(row['end_time'])
+                except ValueError:
+                    continue
+                intervals.setdefault(row['room'], []).append((start, end, {
+                    'id': row['id'],
+                    'uid': row['uid'],
+                    'name': row['name'],
+                    'start_time': row['start_time'],
+                    'end_time': row['end_time'],
+                    'status': request_state(row['access'], row['approved_by'])
+                }))
+        finally:
+            conn.close()
+        return {name: IntervalIndex(rows) for name, rows in intervals.items()}
+
+    def build(self):
+        rooms = self._load()
+        with self._lock:
+            self._rooms = rooms
+            self._built = True
+        logger.info(f"Reservation index built: {sum(len(i) for i in rooms.values())} reservations in {len(rooms)} rooms")
+
+    def refresh_rooms(self, rooms=None):
+        """Reload the given rooms (None = rebuild everything)"""
+        if rooms is None:
+            self.build()
+            return
+        if not self._built:
+            return
+        for room in rooms:
+            loaded = self._load(room)
+            with self._lock:
+                self._rooms[room] = loaded.get(room, IntervalIndex())
+
+    def _index(self, room):
+        if not self._built:
+            # The auth index builds us through its listener; build directly
+            # if it was already built before we were registered
+            auth_index._ensure_built()
+            if not self._built:
+                self.build()
+        with self._lock:
+            return self._rooms.get(room) or IntervalIndex()
+
+    def _overlapping(self, room, start, end):
+        return self._index(room).overlapping(start, end) + recurring_schedule.reservations(room, start, end)
+
+    def overlapping(self, room, start, end):
+        """Reservations (one-off and recurring occurrences) in room sharing time with [start, end)"""
+        return [interval[2] for interval in self._overlapping(room, start, end)]
+
+    def booked_at(self, room, at=None):
+        """Reservations in room covering `at` (default now)"""
+        at = (at or datetime.now()).replace(microsecond=0)
+        intervals = self._index(room).at(at) + recurring_schedule.reservations(room, at)
+        return [interval[2] for interval in intervals]
+
+    def peak(self, room, start, end):
+        """Most reservations held at the same time in room within [start, end)"""
+        return IntervalIndex(self._overlapping(room, start, end)).peak(start, end)
+
+    def held_by(self, room, uid):
+        """Approved, not yet ended bookings uid holds in room (one-off and recurring occurrences)"""
+        held = sum(1 for interval in self._index(room).intervals
+                   if interval[2]['uid'] == uid and interval[2]['status'] == 'approved')
+        return held + recurring_schedule.held_by(room, uid)
+
+reservation_index = ReservationIndex()
+auth_index.add_listener(reservation_index.refresh_rooms)
+
+# ================== RECURRING RESERVATIONS ==================
+
+def parse_recurring_rule(data):
+    """Validate a recurring reservation body into the recurring_requests columns.
+
+    Expects weekdays (0 = Monday .. 6 = Sunday), start_time/end_time as
+    HH:MM on the same day, start_date/end_date as YYYY-MM-DD, and optional
+    interval_weeks (2 = every other week) and exceptions (skipped dates).
+    Raises ValueError with a message for the client.
+    """
+    weekdays = data.get('weekdays')
+    if (not isinstance(weekdays, list) or not weekdays
+            or not all(isinstance(d, int) and not isinstance(d, bool) and 0 <= d <= 6 for d in weekdays)):
+        raise ValueError('weekdays must be a non-empty list of 0 (Monday) .. 6 (Sunday)')
+    try:
+        start_clock = datetime.strptime(str(data.get('start_time', '')).strip(), '%H:%M').time()
+        end_clock = datetime.strptime(str(data.get('end_time', '')).strip(), '%H:%M').time()
+        first_date = datetime.strptime(str(data.get('start_date', '')).strip(), '%Y-%m-%d').date()
+        last_date = datetime.strptime(str(data.get('end_date', '')).strip(), '%Y-%m-%d').date()
+        exceptions = sorted({datetime.strptime(str(d).strip(), '%Y-%m-%d').date() for d in data.get('exceptions') or []})
+    except (TypeError, ValueError):
+        raise ValueError('Invalid time format: use HH:MM for times and YYYY-MM-DD for dates')
+    interval_weeks = data.get('interval_weeks', 1)
+    if isinstance(interval_weeks, bool) or not isinstance(interval_weeks, int) or not 1 <= interval_weeks <= 52:
+        raise ValueError('interval_weeks must be an integer between 1 and 52')
+    if start_clock >= end_clock:
+        raise ValueError('เวลาจองสิ้นสุดต้องอยู่หลังเวลาจองเริ่มต้น')
+    if last_date < first_date:
+        raise ValueError('วันที่สิ้นสุดต้องไม่อยู่ก่อนวันที่เริ่มต้น')
+    if (last_date - first_date).days >= RECURRING_MAX_DAYS:
+        raise ValueError(f'A recurring reservation may span at most {RECURRING_MAX_DAYS} days')
+    return {
+        'weekdays': ','.join(str(d) for d in sorted(set(weekdays))),
+        'start_clock': start_clock.strftime('%H:%M'),
+        'end_clock': end_clock.strftime('%H:%M'),
+        'first_date': first_date.isoformat(),
+        'last_date': last_date.isoformat(),
+        'interval_weeks': interval_weeks,
+        'exceptions': json.dumps([d.isoformat() for d in exceptions])
+    }
+
+def load_recurring_rule(row):
+    """Turn a recurring_requests row into the dict the schedule evaluates"""
+    return {
+        'id': row['id'],
+        'uid': row['uid'],
+        'name': row['name'],
+        'room': row['room'],
+        'weekdays': {int(d) for d in row['weekdays'].split(',')},
+        'start_clock': datetime.strptime(row['start_clock'], '%H:%M').time(),
+        'end_clock': datetime.strptime(row['end_clock'], '%H:%M').time(),
+        'first_date': datetime.strptime(row['first_date'], '%Y-%m-%d').date(),
+        'last_date': datetime.strptime(row['last_date'], '%Y-%m-%d').date(),
+        'interval_weeks': row['interval_weeks'],
+        'exceptions': {datetime.strptime(d, '%Y-%m-%d').date() for d in json.loads(row['exceptions'])},
+        'status': request_state(row['access'], row['approved_by']),
+        'timestamp': row['timestamp'] or ''
+    }
+
+def recurring_occurrences(rule, start, end):
+    """Yield (start, end) of each occurrence of a rule that touches [start, end]"""
+    day = max(rule['first_date'], start.date())
+    last = min(rule['last_date'], end.date())
+    anchor = rule['first_date'] - timedelta(days=rule['first_date'].weekday())
+    while day <= last:
+        if (day.weekday() in rule['weekdays'] and day not in rule['exceptions']
+                and (day - anchor).days // 7 % rule['interval_weeks'] == 0):
+            occurrence_start = datetime.combine(day, rule['start_clock'])
+            occurrence_end = datetime.combine(day, rule['end_clock'])
+            if occurrence_start <= end and occurrence_end >= start:
+                yield occurrence_start, occurrence_end
+        day += timedelta(days=1)
+
+class RecurringSchedule:
+    """Recurring reservations kept as one rule row each and evaluated lazily.
+
+    Pending and approved rules that have not ended are held in memory. The
+    first query for a room expands that room's rules into an IntervalIndex
+    covering the current week; the cache is dropped when the week rolls over
+    and per room when one of its rules changes. Windows outside the cached
+    week are evaluated straight from the rules.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rules = {}
+        self._week = None
+        self._rooms = {}
+        self._built = False
+
+    def build(self):
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT * FROM recurring_requests
+                WHERE (access = 1 OR approved_by IS NULL)
+                AND last_date >= ?
+            ''', (datetime.now().strftime('%Y-%m-%d'),)).fetchall()
+        finally:
+            conn.close()
+        rules = {row['id']: load_recurring_rule(row) for row in rows}
+        with self._lock:
+            self._rules = rules
+            self._rooms = {}
+            self._built = True
+        logger.info(f"Recurring schedule built: {len(rules)} rules")
+
+    def refresh_rule(self, rule_id):
+        """Reload one rule after a write and notify the authorization index listeners"""
+        if not self._built:
+            self.build()
+        conn = get_db_connection()
+        try:
+            row = conn.execute('SELECT * FROM recurring_requests WHERE id = ?', (rule_id,)).fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            old = self._rules.pop(rule_id, None)
+            rooms = {old['room']} if old else set()
+            if row and request_state(row['access'], row['approved_by']) != 'denied':
+                self._rules[rule_id] = load_recurring_rule(row)
+                rooms.add(row['room'])
+            for room in rooms:
+                self._rooms.pop(room, None)
+        if rooms:
+            auth_index.grants_changed(rooms)
+
+    def _index(self, room, start, end):
+        """IntervalIndex of room's occurrences, from the week cache when it covers [start, end]"""
+        if not self._built:
+            self.build()
+        today = datetime.now().date()
+        week = today - timedelta(days=today.weekday())
+        window_start = datetime.combine(week, datetime.min.time())
+        window_end = window_start + timedelta(days=RECURRING_CACHE_DAYS)
+        with self._lock:
+            if week != self._week:
+                self._week = week
+                self._rooms = {}
+            if window_start <= start and end < window_end:
+                if room not in self._rooms:
+                    self._rooms[room] = IntervalIndex(self._expand(room, window_start, window_end))
+                return self._rooms[room]
+            return IntervalIndex(self._expand(room, start, end))
+
+    def _expand(self, room, start, end):
+        occurrences = []
+        for rule in self._rules.values():
+            if rule['room'] != room:
+                continue
+            for occurrence_start, occurrence_end in recurring_occurrences(rule, start, end):
+                occurrences.append((occurrence_start, occurrence_end, rule['timestamp'], rule['id'],
+                                    occurrence_start.isoformat(), occurrence_end.isoformat(),
+                                    rule['uid'], rule['status'], rule['name']))
+        return occurrences
+
+    @staticmethod
+    def _grant(occurrence):
+        return {
+            'id': occurrence[3],
+            'recurring': True,
+            'start': occurrence[0],
+            'start_time': occurrence[4],
+            'end_time': occurrence[5]
+        }
+
+    def active_grant(self, uid, room, at):
+        """The approved occurrence covering `at` for uid in room, or None"""
+        matches = [o for o in self._index(room, at, at).at(at) if o[6] == uid and o[7] == 'approved']
+        if not matches:
+            return None
+        return self._grant(max(matches, key=lambda o: o[2:4]))
+
+    def occupants(self, room, at):
+        """UIDs holding an approved occurrence in room at `at`"""
+        return {o[6] for o in self._index(room, at, at).at(at) if o[7] == 'approved'}
+
+    def rooms(self):
+        """Rooms that have at least one approved rule"""
+        if not self._built:
+            self.build()
+        with self._lock:
+            return {rule['room'] for rule in self._rules.values() if rule['status'] == 'approved'}
+
+    def upcoming(self, start, end):
+        """Approved occurrences starting in [start, end], as (uid, room, grant)"""
+        upcoming = []
+        for room in self.rooms():
+            for o in self._index(room, start, end).starting_between(start, end):
+                if o[7] == 'approved':
+                    upcoming.append((o[6], room, self._grant(o)))
+        return upcoming
+
+    def reservations(self, room, start, end=None):
+        """Occurrences in room as (start, end, record) sharing time with [start, end)
+        or, without end, covering `start`"""
+        index = self._index(room, start, end or start)
+        occurrences = index.at(start) if end is None else index.overlapping(start, end)
+        return [(o[0], o[1], {
+            'id': o[3],
+            'recurring': True,
+            'uid': o[6],
+            'name': o[8],
+            'start_time': o[4],
+            'end_time': o[5],
+            'status': o[7]
+        }) for o in occurrences]
+
+    def held_by(self, room, uid, after=None):
+        """Approved occurrences of uid's rules in room that have not ended"""
+        if not self._built:
+            self.build()
+        after = after or datetime.now()
+        with self._lock:
+            rules = [rule for rule in self._rules.values()
+                     if rule['room'] == room and rule['uid'] == uid and rule['status'] == 'approved']
+        return sum(1 for rule in rules
+                   for _, occurrence_end in recurring_occurrences(
+                       rule, after, datetime.combine(rule['last_date'], rule['end_clock']))
+                   if occurrence_end > after)
+
+    def next_occurrence(self, rule, after=None):
+        """Start of the first occurrence ending after `after`, or None"""
+        after = after or datetime.now()
+        end = datetime.combine(rule['last_date'], rule['end_clock'])
+        for occurrence_start, occurrence_end in recurring_occurrences(rule, after, end):
+            if occurrence_end > after:
+                return occurrence_start
+        return None
+
+recurring_schedule = RecurringSchedule()
+
+# ================== APPROVAL POLICIES ==================
+
+APPROVAL_POLICY_FIELDS = ('room', 'role', 'weekdays', 'window_start', 'window_end', 'max_duration_minutes',
+                          'max_active_per_user', 'action', 'priority', 'enabled', 'description')
+
+def parse_approval_policy(data):
+    """Validate a policy body into approval_policies columns; raises ValueError.
+
+    Every condition is optional (missing = matches anything): room, role,
+    weekdays (0 = Monday .. 6 = Sunday), window_start/window_end (HH:MM the
+    booking must fit in), max_duration_minutes and max_active_per_user
+    (approved, not yet ended bookings the user may already hold in the room).
+    """
+    policy = {}
+    for field in ('room', 'role', 'description'):
+        value = str(data.get(field) or '').strip()
+        policy[field] = value or None
+    if policy['role'] is not None and policy['role'] not in ('student', 'teacher', 'admin'):
+        raise ValueError('role must be student, teacher or admin')
+
+    weekdays = data.get('weekdays')
+    if weekdays is not None:
+        if (not isinstance(weekdays, list) or not weekdays
+                or not all(isinstance(d, int) and not isinstance(d, bool) and 0 <= d <= 6 for d in weekdays)):
+            raise ValueError('weekdays must be a non-empty list of 0 (Monday) .. 6 (Sunday)')
+        weekdays = ','.join(str(d) for d in sorted(set(weekdays)))
+    policy['weekdays'] = weekdays
+
+    window = [data.get('window_start'), data.get('window_end')]
+    if any(w is not None for w in window):
+        try:
+            window = [datetime.strptime(str(w).strip(), '%H:%M').strftime('%H:%M') for w in window]
+        except ValueError:
+            raise ValueError('window_start and window_end must both be HH:MM')
+        if window[0] >= window[1]:
+            raise ValueError('window_end must be after window_start')
+    policy['window_start'], policy['window_end'] = window
+
+    for field, minimum in (('max_duration_minutes', 1), ('max_active_per_user', 0)):
+        value = data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < minimum):
+            raise ValueError(f'{field} must be an integer of at least {minimum}')
+        policy[field] = value
+
+    policy['action'] = data.get('action', 'approve')
+    if policy['action'] not in ('approve', 'deny'):
+        raise ValueError('action must be approve or deny')
+    policy['priority'] = data.get('priority', 100)
+    if isinstance(policy['priority'], bool) or not isinstance(policy['priority'], int):
+        raise ValueError('priority must be an integer')
+    policy['enabled'] = bool(data.get('enabled', True))
+    return policy
+
+def approval_policy_json(row):
+    policy = dict(row)
+    policy['weekdays'] = [int(d) for d in row['weekdays'].split(',')] if row['weekdays'] else None
+    policy['enabled'] = bool(row['enabled'])
+    return policy
+
+class PolicyEngine:
+    """Auto-approval policies compiled for request intake.
+
+    Enabled approval_policies rows are compiled once into weekday bitmasks
+    and minute-of-day windows, ordered by priority (then room- and
+    role-specific before wildcard, then id). The candidate list of each
+    (room, role) pair is memoized, so deciding a request needs no database
+    round trip. The first matching policy decides; a request nothing matches
+    is left pending for an admin. Room capacities are cached alongside.
+    rebuild() runs after every policy or capacity change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._policies = []
+        self._candidates = {}
+        self._capacity = {}
+        self._built = False
+
+    @staticmethod
+    def _compile(row):
+        def minute(clock):
+            hours, minutes = clock.split(':')
+            return int(hours) * 60 + int(minutes)
+        return {
+            'id': row['id'],
+            'room': row['room'],
+            'role': row['role'],
+            'weekdays': sum(1 << int(d) for d in row['weekdays'].split(',')) if row['weekdays'] else None,
+            'window': (minute(row['window_start']), minute(row['window_end'])) if row['window_start'] else None,
+            'max_duration': row['max_duration_minutes'],
+            'max_active': row['max_active_per_user'],
+            'action': row['action'],
+            'priority': row['priority']
+        }
+
+    def rebuild(self):
+        conn = get_db_connection()
+        try:
+            policies = [self._compile(row) for row in conn.execute(
+                'SELECT * FROM approval_policies WHERE enabled = 1')]
+            capacity = {row['room']: row['capacity'] for row in conn.execute(
+                'SELECT room, capacity FROM rooms WHERE capacity IS NOT NULL')}
+        finally:
+            conn.close()
+        policies.sort(key=lambda p: (p['priority'], p['room'] is None, p['role'] is None, p['id']))
+        with self._lock:
+            self._policies = policies
+            self._candidates = {}
+            self._capacity = capacity
+            self._built = True
+        logger.info(f"Approval policies compiled: {len(policies)} enabled")
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def for_room(self, room):
+        """Enabled policies that can decide requests for room, in evaluation order"""
+        self._ensure_built()
+        with self._lock:
+            policies = [p for p in self._policies if p['room'] in (None, room)]
+        return [{'id': p['id'], 'role': p['role'], 'action': p['action'], 'room_specific': p['room'] is not None}
+                for p in policies]
+
+    def capacity(self, room):
+        """Bookings room may hold at once, or None for unlimited"""
+        self._ensure_built()
+        return self._capacity.get(room)
+
+    def _candidates_for(self, room, role):
+        with self._lock:
+            candidates = self._candidates.get((room, role))
+            if candidates is None:
+                candidates = [p for p in self._policies
+                              if p['room'] in (None, room) and p['role'] in (None, role)]
+                self._candidates[(room, role)] = candidates
+            return candidates
+
+    def decide(self, room, role, start, end, held=0):
+        """Return (action, policy_id) with action 'approve', 'deny' or 'manual'"""
+        self._ensure_built()
+        weekdays = 0
+        day = start.date()
+        while day <= end.date() and weekdays != 0x7f:
+            weekdays |= 1 << day.weekday()
+            day += timedelta(days=1)
+        same_day = start.date() == end.date()
+        start_minute = start.hour * 60 + start.minute
+        end_minute = end.hour * 60 + end.minute
+        duration = (end - start).total_seconds() / 60
+
+        for policy in self._candidates_for(room, role):
+            if policy['weekdays'] is not None and weekdays & ~policy['weekdays']:
+                continue
+            if policy['window'] is not None and not (
+                    same_day and policy['window'][0] <= start_minute and end_minute <= policy['window'][1]):
+                continue
+            if policy['max_duration'] is not None and duration > policy['max_duration']:
+                continue
+            if policy['max_active'] is not None and held >= policy['max_active']:
+                continue
+            return policy['action'], policy['id']
+        return 'manual', None
+
+policy_engine = PolicyEngine()
+
+# ================== ROOM ALLOWLIST SYNC ==================
+
+class AllowlistSync:
+    """Per-room allowlists with a version that only ever goes up.
+
+    A room's allowlist is the set of users the authorization index would
+    grant right now. refresh() recomputes it and, when it differs from the
+    stored one, bumps the room version and records the added/removed UIDs in
+    room_allowlist_changes, so a device that knows version N can be sent
+    just the changes since N.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._lists = {}
+        self._versions = {}
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        conn = get_db_connection()
+        try:
+            for row in conn.execute('SELECT room, version FROM room_versions'):
+                self._versions[row['room']] = row['version']
+            for row in conn.execute('SELECT room, rfid_uid, name, expires_at FROM room_allowlist'):
+                self._lists.setdefault(row['room'], {})[row['rfid_uid']] = (row['name'], row['expires_at'])
+        finally:
+            conn.close()
+        self._loaded = True
+
+    def version(self, room):
+        with self._lock:
+            self._ensure_loaded()
+            return self._versions.get(room, 0)
+
+    def refresh(self, rooms=None):
+        """Recompute the allowlist of the given rooms (None = every room)"""
+        with self._lock:
+            self._ensure_loaded()
+            if rooms is None:
+                rooms = auth_index.rooms() | set(self._lists)
+            now = datetime.now()
+
+            for room in rooms:
+                desired = {
+                    uid: (entry['name'], entry['expires_at'])
+                    for uid, entry in auth_index.active_allowlist(room, now).items()
+                }
+                current = self._lists.get(room, {})
+                added = [uid for uid, entry in desired.items() if current.get(uid) != entry]
+                removed = [uid for uid in current if uid not in desired]
+                if not added and not removed:
+                    continue
+
+                version = self._versions.get(room, 0) + 1
+                conn = get_db_connection()
+                try:
+                    conn.execute('''
+                        INSERT INTO room_versions (room, version, updated_at)
+                        VALUES (?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(room) DO UPDATE SET version = excluded.version, updated_at = excluded.updated_at
+                    ''', (room, version))
+                    conn.executemany(
+                        'INSERT INTO room_allowlist_changes (room, version, rfid_uid, op) VALUES (?, ?, ?, ?)',
+                        [(room, version, uid, 'add') for uid in added] +
+                        [(room, version, uid, 'remove') for uid in removed]
+                    )
+                    conn.executemany(
+                        'DELETE FROM room_allowlist WHERE room = ? AND rfid_uid = ?',
+                        [(room, uid) for uid in removed]
+                    )
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO room_allowlist (room, rfid_uid, name, expires_at) VALUES (?, ?, ?, ?)',
+                        [(room, uid, desired[uid][0], desired[uid][1]) for uid in added]
+                    )
+                    conn.execute(
+                        'DELETE FROM room_allowlist_changes WHERE room = ? AND version <= ?',
+                        (room, version - ALLOWLIST_CHANGES_RETAINED)
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+
+                self._lists[room] = desired
+                self._versions[room] = version
+                logger.info(f"Allowlist {room} v{version}: +{len(added)} -{len(removed)}")
+
+    def changes_since(self, room, since):
+        """Return (version, payload); payload is None when `since` is current"""
+        with self._lock:
+            self._ensure_loaded()
+            current_version = self._versions.get(room, 0)
+            current = dict(self._lists.get(room, {}))
+
+        if since == current_version:
+            return current_version, None
+
+        def entry(uid):
+            name, expires_at = current[uid]
+            return {'rfid_uid': uid, 'name': name, 'expires_at': expires_at}
+
+        full = since <= 0 or since > current_version
+        if not full:
+            conn = get_db_connection()
+            try:
+                oldest = conn.execute(
+                    'SELECT MIN(version) FROM room_allowlist_changes WHERE room = ?', (room,)
+                ).fetchone()[0]
+                rows = conn.execute('''
+                    SELECT rfid_uid, op FROM room_allowlist_changes
+                    WHERE room = ? AND version > ? AND version <= ?
+                    ORDER BY version, id
+                ''', (room, since, current_version)).fetchall()
+            finally:
+                conn.close()
+            # History older than `since` was pruned: send everything
+            full = oldest is None or oldest > since + 1
+
+        if full:
+            return current_version, {
+                'full': True,
+                'users': [entry(uid) for uid in sorted(current)]
+            }
+
+        last_op = {}
+        for row in rows:
+            last_op[row['rfid_uid']] = row['op']
+        return current_version, {
+            'full': False,
+            'added': [entry(uid) for uid, op in last_op.items() if op == 'add' and uid in current],
+            'removed': [uid for uid, op in last_op.items() if op == 'remove' and uid not in current]
+        }
+
+allowlist_sync = AllowlistSync()
+auth_index.add_listener(allowlist_sync.refresh)
+
+
+# ================== ACCESS LOG WRITER ==================
+
+def utc_timestamp():
+    """Current UTC time formatted like SQLite CURRENT_TIMESTAMP"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class AccessLogWriter:
+    """Background group-commit writer for access_logs and the swipe path's other writes"""
+
+    def __init__(self, flush_interval_ms=ACCESS_LOG_FLUSH_INTERVAL_MS,
+                 batch_size=ACCESS_LOG_BATCH_SIZE, max_queue=ACCESS_LOG_QUEUE_SIZE,
+                 synchronous=False):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._pending_lock = threading.Lock()
+        self._room_touches = {}
+        self._cache_grants = {}
+
+    def start(self):
+        """Start the writer thread (no-op in synchronous mode)"""
+        if self.synchronous or (self._thread and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='access-log-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def log(self, rfid_uid, room, access_granted, access_type, notes=None, timestamp=None):
+        """Record one access attempt"""
+        event = (rfid_uid, room, bool(access_granted), access_type, notes,
+                 timestamp or utc_timestamp(), None, None)
+
+        if self.running and not self.synchronous:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                logger.warning("⚠️ Access log queue full, writing inline")
+
+        self.write_batch([event])
+
+    def touch_room(self, room, mac_address):
+        """Mark a device online/seen now, written with the next batch"""
+        with self._pending_lock:
+            self._room_touches[(room, mac_address)] = utc_timestamp()
+
+    def cache_grant(self, room, rfid_uid, name, expires_at):
+        """Record a user cached on a door, written with the next batch"""
+        with self._pending_lock:
+            self._cache_grants[(room, rfid_uid)] = (name, expires_at)
+
+    def _take_pending(self):
+        with self._pending_lock:
+            touches, self._room_touches = self._room_touches, {}
+            grants, self._cache_grants = self._cache_grants, {}
+        return touches, grants
+
+    def _restore_pending(self, touches, grants):
+        # Put back writes from a failed transaction unless newer ones arrived
+        with self._pending_lock:
+            for key, value in touches.items():
+                self._room_touches.setdefault(key, value)
+            for key, value in grants.items():
+                self._cache_grants.setdefault(key, value)
+
+    def write_batch(self, events):
+        """Insert events in one transaction and return how many were new.
+
+        Each event is (rfid_uid, room, access_granted, access_type, notes,
+        timestamp, device_id, device_seq); events whose (device_id,
+        device_seq) pair is already stored are skipped. Pending room touches
+        and cache grants are written in the same transaction.
+        """
+        touches, grants = self._take_pending()
+        if not events and not touches and not grants:
+            return 0
+        inserted = 0
+        came_online = set()
+        touched_rooms = {}
+        conn = get_db_connection()
+        try:
+            # IMMEDIATE so no other writer can add rows between reading the
+            # last id and rolling up everything after it
+            conn.execute('BEGIN IMMEDIATE')
+            if events:
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM access_logs').fetchone()[0]
+                before = conn.total_changes
+                conn.executemany('''
+                    INSERT OR IGNORE INTO access_logs
+                        (rfid_uid, room, access_granted, access_type, notes, timestamp, device_id, device_seq)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', events)
+                inserted = conn.total_changes - before
+                if inserted:
+                    rollup_access_logs(conn, last_id)
+            if touches:
+                for room, mac in touches:
+                    came_online.update(row[0] for row in conn.execute('''
+                        SELECT id FROM rooms
+                        WHERE (room = ? OR mac_address = ?) AND COALESCE(status, '') != 'online'
+                    ''', (room, mac)))
+                conn.executemany('''
+                    UPDATE rooms SET last_seen = ?, status = 'online'
+                    WHERE room = ? OR mac_address = ?
+                ''', [(seen, room, mac) for (room, mac), seen in touches.items()])
+                if dashboard_notifier.listening:
+                    for room, mac in touches:
+                        for row in conn.execute('SELECT * FROM rooms WHERE room = ? OR mac_address = ?', (room, mac)):
+                            touched_rooms[row['id']] = row
+            if grants:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO esp32_cache (room, rfid_uid, name, expires_at)
+                    VALUES (?, ?, ?, ?)
+                ''', [(room, uid, name, expires_at) for (room, uid), (name, expires_at) in grants.items()])
+            conn.commit()
+        except Exception:
+            self._restore_pending(touches, grants)
+            raise
+        finally:
+            conn.close()
+
+        if came_online:
+            stats_counters.adjust(online_rooms=len(came_online))
+        for row in touched_rooms.values():
+            dashboard_notifier.publish('rooms', room_json(row))
+        for room, uid in grants:
+            dashboard_notifier.publish('cache', {'action': 'added', 'room': room, 'rfid_uid': uid})
+        if not events:
+            return 0
+
+        if inserted == len(events):
+            stats_counters.record_access(event[5] for event in events)
+            if dashboard_notifier.listening:
+                for event in events:
+                    user = auth_index.get_user(event[0]) or {}
+                    dashboard_notifier.publish('access', {
+                        'rfid_uid': event[0],
+                        'room': event[1],
+                        'access_granted': event[2],
+                        'access_type': event[3],
+                        'timestamp': event[5],
+                        'notes': event[4],
+                        'user_name': user.get('name'),
+                        'user_role': user.get('role')
+                    })
+        elif inserted:
+            stats_counters.recount_today()
+            # Which events were duplicates is unknown here: reload the feed
+            dashboard_notifier.resync('access')
+        return inserted
+
+    def flush(self):
+        """Block until every queued event has been written"""
+        if self.running:
+            self._queue.join()
+
+    def stop(self, timeout=10):
+        """Drain the queue and stop the writer thread"""
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                with worker_loop_seconds.time('access_log_writer'):
+                    self._write_with_retry(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_with_retry(self, batch):
+        for attempt in range(ACCESS_LOG_WRITE_RETRIES):
+            try:
+                self.write_batch(batch)
+                return
+            except Exception as e:
+                logger.warning(f"⚠️ Writing {len(batch)} access log events failed "
+                               f"(attempt {attempt + 1}/{ACCESS_LOG_WRITE_RETRIES}): {str(e)}")
+                time.sleep(min(0.5 * 2 ** attempt, 5))
+
+        # Keep every event that can be written; only a poisoned one is lost
+        for event in batch:
+            try:
+                self.write_batch([event])
+            except Exception as e:
+                logger.error(f"❌ Dropped access log event {event}: {str(e)}")
+
+access_log_writer = AccessLogWriter()
+atexit.register(access_log_writer.stop)
+
+# ================== ACCESS LOG ARCHIVE ==================
+
+ACCESS_LOG_COLUMNS = ('id, rfid_uid, room, access_granted, access_type, timestamp, notes, '
+                      'device_id, device_seq')
+
+def month_start(value, offset=0):
+    """First day of value's month shifted by offset months, as a datetime"""
+    index = value.year * 12 + value.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def month_bounds(month):
+    """Return the [start, end) timestamps of a 'YYYY-MM' partition"""
+    start = datetime.strptime(month, '%Y-%m')
+    fmt = '%Y-%m-%d %H:%M:%S'
+    return start.strftime(fmt), month_start(start, 1).strftime(fmt)
+
+class AccessLogArchive:
+    """Monthly partitions of access_logs stored as gzipped SQLite files.
+
+    access_logs stays the hot partition. archive_due() moves whole months out
+    of it: rows are copied into the month's file first (INSERT OR IGNORE, so
+    a retried or merged run is harmless), the file is compressed, and only
+    then are the rows deleted from the hot table. Archived months are queried
+    by decompressing them into a small cache and ATTACHing them; a copy stays
+    pinned while it is attached, so eviction never deletes it under a reader.
+    """
+
+    def __init__(self, directory, hot_months, archive_months=None, cache_size=ACCESS_LOG_ARCHIVE_CACHE):
+        self.directory = directory
+        self.hot_months = hot_months
+        self.archive_months = archive_months
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = {}
+        # Decompressed copies currently attached somewhere, and the ones
+        # evicted meanwhile (deleted when their last reader detaches)
+        self._pins = {}
+        self._evicted = set()
+
+    def path(self, month):
+        return os.path.join(self.directory, f'access_logs_{month}.db.gz')
+
+    def partitions(self):
+        """Archived months, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        months = [name[len('access_logs_'):-len('.db.gz')] for name in os.listdir(self.directory)
+                  if name.startswith('access_logs_') and name.endswith('.db.gz')]
+        return sorted(months, reverse=True)
+
+    def describe(self):
+        """Partition list for the admin API"""
+        return [{'month': month, 'bytes': os.path.getsize(self.path(month))} for month in self.partitions()]
+
+    def cutoff(self, now=None):
+        """Rows older than this timestamp belong in the archive"""
+        now = now or datetime.now(timezone.utc)
+        return month_start(now, -self.hot_months).strftime('%Y-%m-%d %H:%M:%S')
+
+    def archive_due(self, now=None):
+        """Move every month older than the hot window out of access_logs.
+
+        Returns {month: rows_moved}. Serialized, safe to call at any time.
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = get_db_connection()
+            try:
+                months = [row[0] for row in conn.execute(
+                    'SELECT DISTINCT substr(timestamp, 1, 7) FROM access_logs WHERE timestamp < ?',
+                    (self.cutoff(now),)
+                )]
+            finally:
+                conn.close()
+
+            moved = {}
+            for month in months:
+                moved[month] = self._archive_month(month)
+                logger.info(f"📦 Archived {moved[month]} access log rows for {month}")
+            self._purge_expired(now)
+            return moved
+
+    def _archive_month(self, month):
+        start, end = month_bounds(month)
+        work_path = os.path.join(self.directory, f'.access_logs_{month}.db')
+        if os.path.exists(self.path(month)):
+            with gzip.open(self.path(month), 'rb') as src, open(work_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+        conn = get_db_connection()
+        try:
+            conn.execute('ATTACH DATABASE ? AS part', (work_path,))
+            try:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS part.access_logs (
+                        id INTEGER PRIMARY KEY,
+                        rfid_uid TEXT NOT NULL,
+                        room TEXT NOT NULL,
+                        access_granted BOOLEAN NOT NULL,
+                        access_type TEXT NOT NULL,
+                        timestamp TIMESTAMP NOT NULL,
+                        notes TEXT,
+                        device_id TEXT,
+                        device_seq INTEGER
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS part.idx_access_logs_timestamp ON access_logs(timestamp)')
+                conn.execute('CREATE INDEX IF NOT EXISTS part.idx_access_logs_room_timestamp ON access_logs(room, timestamp)')
+                conn.execute('CREATE INDEX IF NOT EXISTS part.idx_access_logs_uid_timestamp ON access_logs(rfid_uid, timestamp)')
+                # Same predicate as the hot table's index (migration 5); files
+                # written before it matched had the index on device_id
+                conn.execute('DROP INDEX IF EXISTS part.idx_access_logs_device_seq')
+                conn.execute('''
+                    CREATE UNIQUE INDEX part.idx_access_logs_device_seq
+                    ON access_logs(device_id, device_seq) WHERE device_seq IS NOT NULL
+                ''')
+                # Rows the writer adds after this point (late device uploads)
+                # get higher ids and stay in the hot table until the next run
+                conn.execute('BEGIN IMMEDIATE')
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM main.access_logs').fetchone()[0]
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO part.access_logs ({ACCESS_LOG_COLUMNS})
+                    SELECT {ACCESS_LOG_COLUMNS} FROM main.access_logs
+                    WHERE timestamp >= ? AND timestamp < ? AND id <= ?
+                ''', (start, end, last_id))
+                conn.commit()
+            finally:
+                conn.execute('DETACH DATABASE part')
+
+            # The month is durable in its own file before it leaves the hot table
+            tmp_path = self.path(month) + '.tmp'
+            with open(work_path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, self.path(month))
+            self._drop_cached(month)
+
+            cursor = conn.execute('DELETE FROM access_logs WHERE timestamp >= ? AND timestamp < ? AND id <= ?',
+                                  (start, end, last_id))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+            if os.path.exists(work_path):
+                os.remove(work_path)
+
+    def _purge_expired(self, now=None):
+        if self.archive_months is None:
+            return
+        now = now or datetime.now(timezone.utc)
+        oldest = month_start(now, -(self.hot_months + self.archive_months)).strftime('%Y-%m')
+        for month in self.partitions():
+            if month < oldest:
+                os.remove(self.path(month))
+                self._drop_cached(month)
+                logger.info(f"🗑️ Deleted access log archive for {month} (past retention)")
+
+    @contextmanager
+    def attached(self, conn, month):
+        """ATTACH a decompressed copy of an archived month as `part` for the block"""
+        path = self._pin(month)
+        try:
+            conn.execute('ATTACH DATABASE ? AS part', (path,))
+            try:
+                yield
+            finally:
+                conn.execute('DETACH DATABASE part')
+        finally:
+            self._unpin(path)
+
+    def _pin(self, month):
+        """Path of a decompressed copy of month, kept on disk until _unpin()"""
+        with self._lock:
+            mtime = os.path.getmtime(self.path(month))
+            cached = self._cache.pop(month, None)
+            if cached and cached[0] == mtime and os.path.exists(cached[1]):
+                path = cached[1]
+                self._cache[month] = cached
+            else:
+                if cached:
+                    self._discard(cached[1])
+                fd, path = tempfile.mkstemp(prefix=f'access_logs_{month}_', suffix='.db')
+                with gzip.open(self.path(month), 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                self._cache[month] = (mtime, path)
+                while len(self._cache) > self.cache_size:
+                    oldest = next(iter(self._cache))
+                    self._discard(self._cache.pop(oldest)[1])
+            self._pins[path] = self._pins.get(path, 0) + 1
+            return path
+
+    def _unpin(self, path):
+        with self._lock:
+            self._pins[path] -= 1
+            if not self._pins[path]:
+                del self._pins[path]
+                if path in self._evicted:
+                    self._evicted.discard(path)
+                    self._remove_file(path)
+
+    def _drop_cached(self, month):
+        # Called with the lock held
+        cached = self._cache.pop(month, None)
+        if cached:
+            self._discard(cached[1])
+
+    def _discard(self, path):
+        # Called with the lock held
+        if path in self._pins:
+            self._evicted.add(path)
+        else:
+            self._remove_file(path)
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def fetch_page(self, select_sql, filters, params, limit, cursor=None, since=None, until=None):
+        """Keyset page over access_logs and every archived month, newest first.
+
+        select_sql must read from '{access_logs} al'. The hot table is read
+        first; when it runs out the page continues into archived months (each
+        ATTACHed in turn), so the whole history behaves like one table.
+        """
+        order = [('al.timestamp', 'timestamp'), ('al.id', 'id')]
+        conn = get_db_connection()
+        try:
+            rows, next_cursor = fetch_page(conn, select_sql.format(access_logs='main.access_logs'),
+                                           filters, params, order, limit, cursor)
+            if next_cursor:
+                return rows, next_cursor
+
+            position = decode_cursor(cursor, 2)[0] if cursor else None
+            for month in self.partitions():
+                start, end = month_bounds(month)
+                if (since and end <= since) or (until and start >= until) or (position and start > position):
+                    continue
+                if len(rows) >= limit:
+                    # The page is full but this older month may still hold rows
+                    return rows, encode_cursor(rows[-1][key] for _, key in order)
+                page_cursor = encode_cursor(rows[-1][key] for _, key in order) if rows else cursor
+                with self.attached(conn, month):
+                    more, next_cursor = fetch_page(conn, select_sql.format(access_logs='part.access_logs'),
+                                                   filters, params, order, limit - len(rows), page_cursor)
+                rows.extend(more)
+                if next_cursor:
+                    return rows, next_cursor
+
+            return rows, None
+        finally:
+            conn.close()
+
+    def iter_rows(self, select_sql, filters, params, since=None, until=None):
+        """Yield matching rows oldest first: archived months, then the hot table.
+
+        select_sql must read from '{access_logs} al'. Rows come from a live
+        cursor in batches, so memory stays flat however many rows match.
+        """
+        where = (' WHERE ' + ' AND '.join(filters)) if filters else ''
+        order_by = ' ORDER BY al.timestamp, al.id'
+        conn = get_db_connection()
+        try:
+            for month in reversed(self.partitions()):
+                start, end = month_bounds(month)
+                if (since and end <= since) or (until and start >= until):
+                    continue
+                with self.attached(conn, month):
+                    cursor = None
+                    try:
+                        cursor = conn.execute(select_sql.format(access_logs='part.access_logs') + where + order_by, params)
+                        yield from iter_rows(cursor)
+                    finally:
+                        # DETACH fails while a statement on the file is still open
+                        if cursor is not None:
+                            cursor.close()
+
+            cursor = conn.execute(select_sql.format(access_logs='main.access_logs') + where + order_by, params)
+            try:
+                yield from iter_rows(cursor)
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+access_log_archive = AccessLogArchive(ACCESS_LOG_ARCHIVE_DIR, ACCESS_LOG_HOT_MONTHS, ACCESS_LOG_ARCHIVE_MONTHS)
+
+# ================== ACCESS ROLLUPS ==================
+
+def hll_add(registers, value):
+    """Add a value to a HyperLogLog sketch (bytearray of 2**HLL_PRECISION registers)"""
+    digest = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+    bits = 64 - HLL_PRECISION
+    index = digest >> bits
+    rank = bits - (digest & ((1 << bits) - 1)).bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+def hll_estimate(registers):
+    """Estimate distinct counts for a 2-D uint8 array of sketches, one per row"""
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=1)
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    # Linear counting is more accurate for small cardinalities
+    small = (raw <= 2.5 * m) & (zeros > 0)
+    return np.where(small, m * np.log(m / np.maximum(zeros, 1)), raw)
+
+def rollup_access_logs(cursor, after_id):
+    """Fold access_logs rows with id > after_id into the rollup tables.
+
+    Runs inside the caller's transaction, so rollups always match the rows
+    that were actually inserted (duplicates skipped by INSERT OR IGNORE never
+    reach them). Hours and days are UTC, like access_logs.timestamp.
+    """
+    cursor.execute('''
+        INSERT INTO access_rollups_hourly (hour, room, access_granted, access_type, attempts)
+        SELECT substr(timestamp, 1, 13) || ':00:00', room, access_granted, access_type, COUNT(*)
+        FROM access_logs
+        WHERE id > ?
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT(hour, room, access_granted, access_type)
+        DO UPDATE SET attempts = attempts + excluded.attempts
+    ''', (after_id,))
+
+    sketches = {}
+    rows = cursor.execute(
+        'SELECT substr(timestamp, 1, 10), room, rfid_uid FROM access_logs WHERE id > ?', (after_id,)
+    ).fetchall()
+    for day, room, rfid_uid in rows:
+        key = (day, room)
+        if key not in sketches:
+            row = cursor.execute(
+                'SELECT sketch FROM access_rollups_users_daily WHERE day = ? AND room = ?', key
+            ).fetchone()
+            sketches[key] = bytearray(row[0]) if row else bytearray(1 << HLL_PRECISION)
+        hll_add(sketches[key], rfid_uid)
+    cursor.executemany(
+        'INSERT OR REPLACE INTO access_rollups_users_daily (day, room, sketch) VALUES (?, ?, ?)',
+        [(day, room, bytes(sketch)) for (day, room), sketch in sketches.items()]
+    )
+
+
+# ================== CACHE EXPIRY SCHEDULER ==================
 
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized successfully")
+class ExpiryScheduler:
+    """Marks esp32_cache rows offline exactly when they expire.
 
-def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    Pending expires_at deadlines are kept in a min-heap; the worker thread
+    sleeps until the earliest one, expires every due row with one set-based
+    UPDATE and then calls on_expired so removal starts right away. Writers
+    that add cache rows call schedule(); a periodic resync from the table
+    catches anything added behind the scheduler's back.
+    """
 
-# Authentication functions
-def login_required(f):
-    """Decorator to require authentication for routes"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'admin_user' not in session:
-            return redirect(url_for('admin_login'))
-        
-        # Check session timeout
-        if 'login_time' in session:
-            login_time = datetime.fromisoformat(session['login_time'])
-            if datetime.now() - login_time > SESSION_TIMEOUT:
-                session.clear()
-                flash('Session expired. Please login again.', 'error')
-                return redirect(url_for('admin_login'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
+    def __init__(self, on_expired=None, resync_interval=EXPIRY_RESYNC_INTERVAL):
+        self.on_expired = on_expired
+        self.resync_interval = resync_interval
+        self._heap = []
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
 
-# API authentication decorator (for AJAX requests)
-def api_login_required(f):
-    """Decorator for API endpoints that require authentication"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'admin_user' not in session:
-            return jsonify({'error': 'Authentication required'}), 401
-        
-        # Check session timeout
-        if 'login_time' in session:
-            login_time = datetime.fromisoformat(session['login_time'])
-            if datetime.now() - login_time > SESSION_TIMEOUT:
-                session.clear()
-                return jsonify({'error': 'Session expired'}), 401
-        
-        return f(*args, **kwargs)
-    return decorated_function
+    def schedule(self, expires_at):
+        """Register a deadline (datetime or stored timestamp string)"""
+        if isinstance(expires_at, str):
+            try:
+                expires_at = parse_db_datetime(expires_at)
+            except ValueError:
+                expires_at = datetime.now()
+        with self._cond:
+            if expires_at in self._scheduled:
+                return
+            self._scheduled.add(expires_at)
+            heapq.heappush(self._heap, expires_at)
+            if self._heap[0] == expires_at:
+                self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def resync(self):
+        """Reload the deadlines of every cache row that is still online"""
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT DISTINCT expires_at FROM esp32_cache
+                WHERE expired_status = 'online'
+            ''').fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            self.schedule(row['expires_at'])
+
+    def expire_due(self, now=None):
+        """Mark every due non-admin cache row offline; returns rows changed"""
+        now = now or datetime.now()
+        conn = get_db_connection()
+        try:
+            result = conn.execute('''
+                UPDATE esp32_cache
+                SET expired_status = 'offline'
+                WHERE expired_status = 'online'
+                AND (julianday(expires_at) < julianday(?) OR julianday(expires_at) IS NULL)
+                AND name NOT IN (SELECT name FROM users_reg WHERE role = 'admin')
+            ''', (now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],))
+            conn.commit()
+            return result.rowcount
+        finally:
+            conn.close()
 
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='cache-expiry', daemon=True)
+        self._thread.start()
 
-def background_tasks(update_interval=10, cleanup_interval=10):
-    """Start background threads for updating expired statuses and cleaning up expired cache"""
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
 
-    def update_expired_status_worker():
-        """Thread to update esp32_cache expired_status periodically"""
+    def _run(self):
+        next_resync = 0
         while True:
             try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                cache_entries = cursor.execute('''
-                                               SELECT ec.id, ec.name, users_reg.role, ec.expires_at
-                                               FROM esp32_cache ec
-                                               JOIN users_reg ON ec.name = users_reg.name
-                                               ''').fetchall()
-                current_time = datetime.now()
-
-                for entry in cache_entries:
-                    end_time_str = entry['expires_at']
-                    try:
-                        if 'T' in end_time_str:
-                            end_time = datetime.fromisoformat(end_time_str.replace('T', ' '))
-                        else:
-                            end_time = datetime.strptime(end_time_str, '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        end_time = datetime.min
-
-                    expired_status = 'offline' if current_time > end_time else 'online'
-
-                    if entry['role'] != 'admin':
-                        cursor.execute('''
-                            UPDATE esp32_cache
-                            SET expired_status = ?
-                            WHERE id = ?
-                        ''', (expired_status, entry['id']))
+                if time.monotonic() >= next_resync:
+                    self.resync()
+                    next_resync = time.monotonic() + self.resync_interval
 
-                conn.commit()
-                conn.close()
-                time.sleep(update_interval)
+                with self._cond:
+                    while not self._stopping:
+                        now = datetime.now()
+                        if self._heap and self._heap[0] < now:
+                            break
+                        timeout = next_resync - time.monotonic()
+                        if self._heap:
+                            # Wake just after the deadline so the strict comparison holds
+                            timeout = min(timeout, (self._heap[0] - now).total_seconds() + 0.01)
+                        if timeout <= 0:
+                            break
+                        self._cond.wait(timeout)
+                    if self._stopping:
+                        return
+
+                    now = datetime.now()
+                    while self._heap and self._heap[0] < now:
+                        self._scheduled.discard(heapq.heappop(self._heap))
+
+                with worker_loop_seconds.time('cache_expiry'):
+                    expired = self.expire_due(now)
+                if expired:
+                    logger.info(f"⏰ {expired} cache entries expired")
+                    dashboard_notifier.publish('cache', {'action': 'expired', 'count': expired})
+                    if self.on_expired:
+                        self.on_expired()
 
             except Exception as e:
-                logger.error(f"❌ Error in expired status updater: {str(e)}")
+                logger.error(f"❌ Error in cache expiry scheduler: {str(e)}")
                 time.sleep(5)
 
+cleanup_requested = threading.Event()
+expiry_scheduler = ExpiryScheduler(on_expired=cleanup_requested.set)
+
+# ================== STATISTICS COUNTERS ==================
+
+def request_state(access, approved_by):
+    """Classify a request row the way the dashboard counts it"""
+    if access:
+        return 'approved'
+    if approved_by is None:
+        return 'pending'
+    return 'denied'
+
+class StatsCounters:
+    """Dashboard statistics maintained incrementally by the write paths"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._roles = {}
+        self._counts = {
+            'total_requests': 0,
+            'approved_requests': 0,
+            'pending_requests': 0,
+            'total_recurring_requests': 0,
+            'approved_recurring_requests': 0,
+            'pending_recurring_requests': 0,
+            'total_rooms': 0,
+            'online_rooms': 0,
+            'today_access_attempts': 0,
+        }
+        self._today = None
+        self._cache_deadlines = {}
+        self._cache_heap = []
+        self.reconciled_at = None
+
+    def adjust(self, **deltas):
+        """Apply counter deltas, e.g. adjust(total_requests=1, pending_requests=1)"""
+        with self._lock:
+            for key, delta in deltas.items():
+                self._counts[key] = self._counts.get(key, 0) + delta
+
+    def adjust_role(self, role, delta):
+        with self._lock:
+            self._roles[role] = self._roles.get(role, 0) + delta
+
+    def request_changed(self, old_state, new_state, kind='requests'):
+        """Move one request between states ('approved', 'pending', 'denied', None for new).
+
+        kind is 'requests' for one-off requests or 'recurring_requests' for rules.
+        """
+        deltas = {}
+        if old_state is None:
+            deltas[f'total_{kind}'] = 1
+        if old_state != new_state:
+            for state, delta in ((old_state, -1), (new_state, 1)):
+                if state in ('approved', 'pending'):
+                    deltas[f'{state}_{kind}'] = delta
+        self.adjust(**deltas)
+
+    def record_access(self, timestamps):
+        """Count newly stored access log rows (UTC CURRENT_TIMESTAMP strings)"""
+        with self._lock:
+            self._roll_day()
+            today = self._today
+            self._counts['today_access_attempts'] += sum(1 for ts in timestamps if ts and ts[:10] == today)
+
+    def recount_today(self):
+        """Recount today's access attempts (after a batch with skipped duplicates)"""
+        conn = get_db_connection()
+        try:
+            with self._lock:
+                self._roll_day()
+                self._counts['today_access_attempts'] = self._count_today(conn, self._today)
+        finally:
+            conn.close()
+
+    def track_cache(self, entries):
+        """Track (room, rfid_uid, expires_at) rows written to esp32_cache"""
+        with self._lock:
+            for room, rfid_uid, expires_at in entries:
+                try:
+                    deadline = parse_db_datetime(expires_at)
+                except (TypeError, ValueError):
+                    continue
+                self._cache_deadlines[(room, rfid_uid)] = deadline
+                heapq.heappush(self._cache_heap, (deadline, room, rfid_uid))
+
+    def snapshot(self):
+        """Return the current statistics (reconciling first if never done)"""
+        if self.reconciled_at is None:
+            self.reconcile()
+        with self._lock:
+            self._roll_day()
+            self._age_cache()
+
+            stats = {f'total_{role}s': count for role, count in self._roles.items() if count}
+            stats.update(self._counts)
+            stats['active_cache_entries'] = len(self._cache_deadlines)
+            return stats
+
+    def reconcile(self):
+        """Recount every statistic from the tables"""
+        conn = get_db_connection()
+        try:
+            now = datetime.now()
+            today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+            roles = {row['role']: row['count'] for row in conn.execute(
+                'SELECT role, COUNT(*) AS count FROM users_reg WHERE is_deleted = 0 GROUP BY role')}
+            requests_row = conn.execute('''
+                SELECT COUNT(*) AS total,
+                       COALESCE(SUM(access = TRUE), 0) AS approved,
+                       COALESCE(SUM(access = FALSE AND approved_by IS NULL), 0) AS pending
+                FROM requests
+            ''').fetchone()
+            recurring_row = conn.execute('''
+                SELECT COUNT(*) AS total,
+                       COALESCE(SUM(access = TRUE), 0) AS approved,
+                       COALESCE(SUM(access = FALSE AND approved_by IS NULL), 0) AS pending
+                FROM recurring_requests
+            ''').fetchone()
+            rooms_row = conn.execute('''
+                SELECT COUNT(*) AS total, COALESCE(SUM(status = 'online'), 0) AS online
+                FROM rooms
+            ''').fetchone()
+            today_count = self._count_today(conn, today)
+            cache_deadlines = {}
+            for row in conn.execute('SELECT room, rfid_uid, expires_at FROM esp32_cache'):
+                try:
+                    deadline = parse_db_datetime(row['expires_at'])
+                except (TypeError, ValueError):
+                    # Unparseable rows are left to the expiry scheduler
+                    continue
+                if deadline >= now:
+                    cache_deadlines[(row['room'], row['rfid_uid'])] = deadline
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._roles = roles
+            self._counts.update({
+                'total_requests': requests_row['total'],
+                'approved_requests': requests_row['approved'],
+                'pending_requests': requests_row['pending'],
+                'total_recurring_requests': recurring_row['total'],
+                'approved_recurring_requests': recurring_row['approved'],
+                'pending_recurring_requests': recurring_row['pending'],
+                'total_rooms': rooms_row['total'],
+                'online_rooms': rooms_row['online'],
+                'today_access_attempts': today_count,
+            })
+            self._today = today
+            self._cache_deadlines = cache_deadlines
+            self._cache_heap = [(deadline, room, uid) for (room, uid), deadline in cache_deadlines.items()]
+            heapq.heapify(self._cache_heap)
+            self.reconciled_at = datetime.now()
+
+    def active_cache_by_room(self):
+        """Count of unexpired cache entries per room"""
+        if self.reconciled_at is None:
+            self.reconcile()
+        with self._lock:
+            self._age_cache()
+            counts = {}
+            for room, _ in self._cache_deadlines:
+                counts[room] = counts.get(room, 0) + 1
+            return counts
+
+    def _age_cache(self):
+        # Called with the lock held
+        now = datetime.now()
+        heap = self._cache_heap
+        while heap and heap[0][0] < now:
+            deadline, room, rfid_uid = heapq.heappop(heap)
+            if self._cache_deadlines.get((room, rfid_uid)) == deadline:
+                del self._cache_deadlines[(room, rfid_uid)]
+
+    def _roll_day(self):
+        # Called with the lock held
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        if today != self._today:
+            self._today = today
+            self._counts['today_access_attempts'] = 0
+
+    @staticmethod
+    def _count_today(conn, today):
+        # Range on the raw column so idx_access_logs_timestamp is used
+        tomorrow = (datetime.strptime(today, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        return conn.execute(
+            'SELECT COUNT(*) FROM access_logs WHERE timestamp >= ? AND timestamp < ?',
+            (today, tomorrow)
+        ).fetchone()[0]
+
+stats_counters = StatsCounters()
+
+
+def background_tasks(cleanup_interval=60):
+    """Start the cache expiry scheduler and the cache cleanup worker.
+
+    Cleanup runs as soon as the scheduler expires entries; cleanup_interval
+    only bounds how long failed removals wait before being retried.
+    """
+
+    def allowlist_refresh_worker():
+        """Thread to pick up reservations that started or ended since the last refresh"""
+        while True:
+            try:
+                time.sleep(ALLOWLIST_REFRESH_INTERVAL)
+                with worker_loop_seconds.time('allowlist_refresh'):
+                    allowlist_sync.refresh()
+            except Exception as e:
+                logger.error(f"❌ Error in allowlist refresher: {str(e)}")
+
+    def prewarm_worker():
+        """Thread to push upcoming reservations to door caches ahead of time"""
+        while True:
+            try:
+                with worker_loop_seconds.time('cache_prewarm'):
+                    prewarm_door_caches()
+            except Exception as e:
+                logger.error(f"❌ Error in cache pre-warm worker: {str(e)}")
+            time.sleep(PREWARM_INTERVAL)
+
+    def log_archive_worker():
+        """Thread to move old access log months into compressed archives"""
+        while True:
+            try:
+                with worker_loop_seconds.time('log_archive'):
+                    access_log_archive.archive_due()
+            except Exception as e:
+                logger.error(f"❌ Error in access log archiver: {str(e)}")
+            time.sleep(ACCESS_LOG_ARCHIVE_INTERVAL)
+
+    def user_sync_worker():
+        """Thread to pick up users another process (import-users) added to users_reg"""
+        while True:
+            try:
+                time.sleep(USER_SYNC_INTERVAL)
+                with worker_loop_seconds.time('user_sync'):
+                    new_users = auth_index.sync_new_users()
+                for role in {user['role'] for user in new_users}:
+                    stats_counters.adjust_role(role, sum(1 for user in new_users if user['role'] == role))
+                if new_users:
+                    logger.info(f"👥 Picked up {len(new_users)} users added outside the server")
+                    dashboard_notifier.resync('users')
+            except Exception as e:
+                logger.error(f"❌ Error in user sync: {str(e)}")
+
+    def stats_reconcile_worker():
+        """Thread to recount the dashboard statistics from the tables"""
+        while True:
+            try:
+                time.sleep(STATS_RECONCILE_INTERVAL)
+                with worker_loop_seconds.time('stats_reconcile'):
+                    stats_counters.reconcile()
+            except Exception as e:
+                logger.error(f"❌ Error in stats reconciler: {str(e)}")
+
     def cleanup_cache_worker():
-        """Thread to remove expired users periodically"""
+        """Thread to remove expired users when entries expire (and retry periodically)"""
         while True:
             try:
-                print("🔄 Running periodic cache cleanup...")
-                cleanup_expired_cache_entries()
-                time.sleep(cleanup_interval)
+                cleanup_requested.wait(cleanup_interval)
+                cleanup_requested.clear()
+                with worker_loop_seconds.time('cache_cleanup'):
+                    cleanup_expired_cache_entries()
             except Exception as e:
                 print(f"❌ Error in cleanup worker: {str(e)}")
                 time.sleep(5)
 
-    # Start both threads
-    threading.Thread(target=update_expired_status_worker, daemon=True).start()
+    expiry_scheduler.start()
     threading.Thread(target=cleanup_cache_worker, daemon=True).start()
+    threading.Thread(target=allowlist_refresh_worker, daemon=True).start()
+    threading.Thread(target=prewarm_worker, daemon=True).start()
+    threading.Thread(target=stats_reconcile_worker, daemon=True).start()
+    threading.Thread(target=user_sync_worker, daemon=True).start()
+    threading.Thread(target=log_archive_worker, daemon=True).start()
 
-    print("✅ Background tasks started: expired status updater and cache cleaner")
+    print("✅ Background tasks started: cache expiry scheduler, cache cleaner, allowlist refresher, user sync, cache pre-warm, stats reconciler and log archiver")
 
 def get_cache_with_expired_status():
     """Helper function to get cache entries with expired_status field"""
@@ -319,7 +2990,63 @@ def get_cache_with_expired_status():
         logger.error(f"Error in get_cache_with_expired_status: {str(e)}")
         return []
 
-def send_remove_user_to_esp32(room_ip, rfid_uid):
+# ================== ESP32 DEVICE FAN-OUT ==================
+
+_device_sessions = {}
+_device_sessions_lock = threading.Lock()
+
+class DeviceCallExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that counts submitted calls still waiting for a worker"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counts_lock = threading.Lock()
+        self._submitted = 0
+        self._started = 0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._counts_lock:
+            self._submitted += 1
+        future = super().submit(self._call, fn, *args, **kwargs)
+        # A call cancelled before it started never reaches _call
+        future.add_done_callback(lambda f: f.cancelled() and self._mark_started())
+        return future
+
+    def _call(self, fn, *args, **kwargs):
+        self._mark_started()
+        return fn(*args, **kwargs)
+
+    def _mark_started(self):
+        with self._counts_lock:
+            self._started += 1
+
+    def waiting(self):
+        with self._counts_lock:
+            return self._submitted - self._started
+
+esp32_executor = DeviceCallExecutor(max_workers=ESP32_FANOUT_WORKERS, thread_name_prefix='esp32-fanout')
+_cleanup_lock = threading.Lock()
+
+def get_device_session(room_ip):
+    """Keep-alive HTTP session for one ESP32 device"""
+    with _device_sessions_lock:
+        session = _device_sessions.get(room_ip)
+        if session is None:
+            session = requests.Session()
+            _device_sessions[room_ip] = session
+        return session
+
+def device_timeout(deadline):
+    """ESP32_REQUEST_TIMEOUT cut down to what is left before deadline (a
+    time.monotonic() value), or None once it has passed"""
+    if deadline is None:
+        return ESP32_REQUEST_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return None
+    return tuple(min(part, remaining) for part in ESP32_REQUEST_TIMEOUT)
+
+def send_remove_user_to_esp32(room_ip, rfid_uid, timeout=ESP32_REQUEST_TIMEOUT):
     """Send remove user request to ESP32"""
     try:
         url = f"http://{room_ip}/api/remove_user"
@@ -328,11 +3055,10 @@ def send_remove_user_to_esp32(room_ip, rfid_uid):
             "action": "remove_expired"
         }
         
-        response = requests.post(url, json=payload, timeout=5)
+        response = get_device_session(room_ip).post(url, json=payload, timeout=timeout)
         
-        print(f"response request status: {response.status_code}")
-
-        if response.status_code == 200:
+        # 404 means the device no longer has the user, which is what we wanted
+        if response.status_code in (200, 404):
             print(f"✅ Successfully sent remove request to {room_ip} for UID {rfid_uid}")
             return True
         else:
@@ -343,58 +3069,295 @@ def send_remove_user_to_esp32(room_ip, rfid_uid):
         print(f"❌ Error sending remove request to {room_ip}: {str(e)}")
         return False
 
+def send_remove_users_to_esp32(room_ip, rfid_uids, deadline=None):
+    """Remove several users from one ESP32 in a single request.
+
+    Returns the list of UIDs the device confirmed are gone (removed or not
+    present). Falls back to one request per UID for firmware that does not
+    understand the `rfid_uids` batch field. No request outlives deadline (a
+    time.monotonic() value); UIDs not reached by then are left for the next pass.
+    """
+    timeout = device_timeout(deadline)
+    if timeout is None:
+        return []
+    url = f"http://{room_ip}/api/remove_user"
+    session = get_device_session(room_ip)
+    response = session.post(url, json={
+        "rfid_uids": rfid_uids,
+        "action": "remove_expired"
+    }, timeout=timeout)
+
+    if response.status_code == 200:
+        data = response.json()
+        if 'removed' in data or 'not_found' in data:
+            confirmed = set(data.get('removed', [])) | set(data.get('not_found', []))
+            return [uid for uid in rfid_uids if uid in confirmed]
+
+    if response.status_code in (200, 400):
+        # Older firmware: only accepts a single rfid_uid per request
+        removed = []
+        for position, uid in enumerate(rfid_uids):
+            timeout = device_timeout(deadline)
+            if timeout is None:
+                print(f"⏱️ Fan-out deadline reached for {room_ip}, {len(rfid_uids) - position} UID(s) left for the next pass")
+                break
+            if send_remove_user_to_esp32(room_ip, uid, timeout):
+                removed.append(uid)
+        return removed
+
+    raise requests.exceptions.HTTPError(f"HTTP {response.status_code}")
+
 def cleanup_expired_cache_entries():
-    """Clean up expired cache entries and notify ESP32 devices"""
-    try:
-        conn = get_db_connection()
-        
-        # Find all expired entries that are still marked as active
-        expired_entries = conn.execute('''
-            SELECT ec.*, r.ip_address, r.status as room_status, r.id as room_id
-            FROM esp32_cache ec
-            JOIN rooms r ON ec.room = r.room
-            WHERE expired_status = 'offline'
-            AND room_status = 'online'
-            AND r.ip_address IS NOT NULL
-            ORDER BY ec.room, ec.expires_at
-        ''').fetchall()
-        
-        if expired_entries:
-            print(f"🧹 Found {len(expired_entries)} expired cache entries to clean up")
+    """Clean up expired cache entries and notify ESP32 devices.
+
+    Expired UIDs are grouped per room and each room gets one batched remove
+    request; rooms are contacted concurrently and the whole pass is bounded by
+    ESP32_FANOUT_DEADLINE. Only UIDs a device confirmed are deleted from the
+    database. Returns a per-room report.
+    """
+    report = {}
+    with _cleanup_lock:
+        try:
+            conn = get_db_connection()
+            
+            # Find all expired entries that are still marked as active
+            expired_entries = conn.execute('''
+                SELECT ec.*, r.ip_address, r.status as room_status, r.id as room_id
+                FROM esp32_cache ec
+                JOIN rooms r ON ec.room = r.room
+                WHERE expired_status = 'offline'
+                AND room_status = 'online'
+                AND r.ip_address IS NOT NULL
+                ORDER BY ec.room, ec.expires_at
+            ''').fetchall()
+            conn.close()
             
+            if not expired_entries:
+                return report
+
+            print(f"🧹 Found {len(expired_entries)} expired cache entries to clean up")
+
+            by_room = {}
             for entry in expired_entries:
+                room_ip, uids = by_room.setdefault(entry['room'], (entry['ip_address'], []))
+                uids.append(entry['rfid_uid'])
 
-                cache_id = entry['id']
-                rfid_uid = entry['rfid_uid']
-                room = entry['room']
-                room_ip = entry['ip_address']
-                name = entry['name']
-                
-                print(f"📤 Sending remove request to ESP32 {room} ({room_ip}) for user {name} ({rfid_uid})")
-                
-                # Send remove request to ESP32
-                success = send_remove_user_to_esp32(room_ip, rfid_uid)
-                
-                if success:
-                    # Update the database to mark as cleaned up
-                    conn.execute('''DELETE
+            deadline = time.monotonic() + ESP32_FANOUT_DEADLINE
+            futures = {}
+            for room, (room_ip, uids) in by_room.items():
+                print(f"📤 Sending remove request to ESP32 {room} ({room_ip}) for {len(uids)} user(s)")
+                futures[esp32_executor.submit(send_remove_users_to_esp32, room_ip, uids, deadline)] = room
+
+            done, not_done = wait(futures, timeout=ESP32_FANOUT_DEADLINE)
+            for future in not_done:
+                # Calls still queued give their worker back; running ones stop at the deadline
+                future.cancel()
+
+            confirmed = []
+            for future, room in futures.items():
+                room_ip, uids = by_room[room]
+                outcome = {'ip_address': room_ip, 'requested': uids, 'removed': [], 'status': 'ok'}
+                if future in not_done:
+                    outcome['status'] = 'timeout'
+                else:
+                    try:
+                        outcome['removed'] = future.result()
+                        if len(outcome['removed']) < len(uids):
+                            outcome['status'] = 'partial'
+                    except Exception as e:
+                        outcome['status'] = 'error'
+                        outcome['error'] = str(e)
+                confirmed.extend((room, uid) for uid in outcome['removed'])
+                report[room] = outcome
+                esp32_fanout_total.inc(room, 'remove', FANOUT_OUTCOMES[outcome['status']])
+
+                if outcome['status'] != 'ok':
+                    print(f"❌ Cleanup for room {room} ({room_ip}): {outcome['status']} "
+                          f"{len(outcome['removed'])}/{len(uids)} removed")
+
+            if confirmed:
+                conn = get_db_connection()
+                conn.executemany('''DELETE
                                  FROM esp32_cache
-                                 WHERE rfid_uid = ?
+                                 WHERE room = ?
+                                 AND rfid_uid = ?
                                  AND expired_status = 'offline'
-                                 ''', (rfid_uid,))
-                    
-                    print(f"✅ Removed cache entry id:{cache_id}")
-                else:
-                    print(f"❌ Failed to clean up cache entry id:{rfid_uid} success : {success}")
-        
-        conn.commit()
+                                 ''', confirmed)
+                conn.commit()
+                conn.close()
+                for room, uid in confirmed:
+                    dashboard_notifier.publish('cache', {'action': 'removed', 'room': room, 'rfid_uid': uid})
+            
+            print(f"🧹 Cache cleanup completed: {len(confirmed)}/{len(expired_entries)} entries removed "
+                  f"across {len(by_room)} room(s)")
+            
+        except Exception as e:
+            print(f"❌ Error in cleanup_expired_cache_entries: {str(e)}")
+
+    return report
+
+def send_add_users_to_esp32(room_ip, users):
+    """Push several upcoming grants to one ESP32; returns the UIDs it accepted"""
+    url = f"http://{room_ip}/api/add_users"
+    response = get_device_session(room_ip).post(url, json={"users": users}, timeout=ESP32_REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        raise requests.exceptions.HTTPError(f"HTTP {response.status_code}")
+    accepted = set(response.json().get('added', []))
+    return [user['rfid_uid'] for user in users if user['rfid_uid'] in accepted]
+
+def prewarm_door_caches(now=None, lookahead=PREWARM_LOOKAHEAD):
+    """Push approved reservations starting within `lookahead` to their doors.
+
+    Each online room gets one batched /api/add_users request with the users
+    whose window starts soon (the device activates them at `starts_in_ms`),
+    so the first swipe is served locally. Accepted grants are recorded in
+    esp32_cache and scheduled for expiry like any other cache entry. Returns
+    a per-room report.
+    """
+    now = (now or datetime.now()).replace(microsecond=0)
+    upcoming = auth_index.upcoming_grants(now, now + lookahead)
+    report = {}
+    if not upcoming:
+        return report
+
+    conn = get_db_connection()
+    try:
+        rooms = {row['room']: row['ip_address'] for row in conn.execute('''
+            SELECT room, ip_address FROM rooms
+            WHERE status = 'online' AND ip_address IS NOT NULL
+        ''')}
+        cached = {(row['room'], row['rfid_uid']): row['expires_at'] for row in conn.execute('''
+            SELECT room, rfid_uid, expires_at FROM esp32_cache
+            WHERE expired_status = 'online'
+        ''')}
+    finally:
         conn.close()
-        
-        if expired_entries:
-            print(f"🧹 Cache cleanup completed: {len(expired_entries)} entries processed")
-        
-    except Exception as e:
-        print(f"❌ Error in cleanup_expired_cache_entries: {str(e)}")
+
+    by_room = {}
+    for uid, room, user, grant in upcoming:
+        if room not in rooms or cached.get((room, uid)) == grant['end_time']:
+            continue
+        by_room.setdefault(room, {})[uid] = {
+            'rfid_uid': uid,
+            'name': user['name'],
+            'starts_in_ms': max(0, int((grant['start'] - now).total_seconds() * 1000)),
+            'expires_at': grant['end_time']
+        }
+    if not by_room:
+        return report
+
+    futures = {
+        esp32_executor.submit(send_add_users_to_esp32, rooms[room], list(users.values())): room
+        for room, users in by_room.items()
+    }
+    done, not_done = wait(futures, timeout=ESP32_FANOUT_DEADLINE)
+
+    accepted = []
+    for future, room in futures.items():
+        users = by_room[room]
+        outcome = {'ip_address': rooms[room], 'requested': list(users), 'added': [], 'status': 'ok'}
+        if future in not_done:
+            outcome['status'] = 'timeout'
+        else:
+            try:
+                outcome['added'] = future.result()
+                if len(outcome['added']) < len(users):
+                    outcome['status'] = 'partial'
+            except Exception as e:
+                outcome['status'] = 'error'
+                outcome['error'] = str(e)
+        accepted.extend((room, uid, users[uid]['name'], users[uid]['expires_at']) for uid in outcome['added'])
+        report[room] = outcome
+        esp32_fanout_total.inc(room, 'add', FANOUT_OUTCOMES[outcome['status']])
+
+    if accepted:
+        conn = get_db_connection()
+        try:
+            conn.executemany('''
+                INSERT OR REPLACE INTO esp32_cache (room, rfid_uid, name, expires_at)
+                VALUES (?, ?, ?, ?)
+            ''', accepted)
+            conn.commit()
+        finally:
+            conn.close()
+        stats_counters.track_cache((room, uid, expires_at) for room, uid, _, expires_at in accepted)
+        for room, uid, _, expires_at in accepted:
+            expiry_scheduler.schedule(expires_at)
+            dashboard_notifier.publish('cache', {'action': 'added', 'room': room, 'rfid_uid': uid})
+        print(f"🔥 Pre-warmed {len(accepted)} upcoming grant(s) across {len(report)} room(s)")
+
+    return report
+
+# ================== ACCESS DECISION TRACE ==================
+
+class AccessDecisionTrace:
+    """Fixed-size ring buffer of check_access decisions.
+
+    record() appends one dict per swipe (deque appends are atomic, so no
+    lock is taken on the hot path). Extra diagnostics (the user's latest
+    requests for the room) are only gathered for rooms or cards an admin
+    enabled, each for a limited time.
+    """
+
+    def __init__(self, size=ACCESS_TRACE_SIZE):
+        self._buffer = deque(maxlen=size)
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self._targets = {}
+
+    def record(self, **decision):
+        decision['seq'] = next(self._seq)
+        decision['at'] = time.time()
+        self._buffer.append(decision)
+
+    def diagnostics_enabled(self, room, rfid_uid):
+        if not self._targets:
+            return False
+        now = time.time()
+        for target in (('room', room), ('card', rfid_uid)):
+            until = self._targets.get(target)
+            if until is not None:
+                if until > now:
+                    return True
+                with self._lock:
+                    self._targets.pop(target, None)
+        return False
+
+    def enable(self, kind, value, minutes=DIAGNOSTICS_DEFAULT_MINUTES):
+        with self._lock:
+            self._targets[(kind, value)] = time.time() + minutes * 60
+
+    def disable(self, kind=None, value=None):
+        """Stop diagnostics for one target (or every target when kind is None)"""
+        with self._lock:
+            if kind is None:
+                self._targets.clear()
+            else:
+                self._targets.pop((kind, value), None)
+
+    def targets(self):
+        now = time.time()
+        with self._lock:
+            return [
+                {kind: value, 'until': datetime.fromtimestamp(until).isoformat(timespec='seconds')}
+                for (kind, value), until in sorted(self._targets.items()) if until > now
+            ]
+
+    def query(self, room=None, rfid_uid=None, decision=None, after=0, limit=PAGE_SIZE_DEFAULT):
+        """Newest matching decisions first (only those with seq > after)"""
+        found = []
+        for entry in reversed(list(self._buffer)):
+            if entry['seq'] <= after or len(found) >= limit:
+                break
+            if ((room and entry['room'] != room) or (rfid_uid and entry['rfid_uid'] != rfid_uid)
+                    or (decision and entry['decision'] != decision)):
+                continue
+            entry = dict(entry)
+            entry['at'] = datetime.fromtimestamp(entry['at']).isoformat(timespec='milliseconds')
+            found.append(entry)
+        return found
+
+access_trace = AccessDecisionTrace()
 
 @app.route('/')
 def Home():
@@ -422,15 +3385,40 @@ def register_esp32():
         
         conn = get_db_connection()
         
-        # Register or update ESP32 device
+        # Rows the REPLACE below will overwrite (same room or same MAC)
+        replaced = conn.execute(
+            'SELECT status FROM rooms WHERE room = ? OR mac_address = ?', (room, mac_address)
+        ).fetchall()
+        
+        # Register or update ESP32 device; a MAC moving to another room frees
+        # its old row, and an existing room keeps its settings (capacity)
+        freed = conn.execute('DELETE FROM rooms WHERE mac_address = ? AND room != ?',
+                             (mac_address, room)).rowcount
         conn.execute('''
-            INSERT OR REPLACE INTO rooms (room, mac_address, ip_address, last_seen, status)
+            INSERT INTO rooms (room, mac_address, ip_address, last_seen, status)
             VALUES (?, ?, ?, CURRENT_TIMESTAMP, 'online')
+            ON CONFLICT(room) DO UPDATE SET
+                mac_address = excluded.mac_address,
+                ip_address = excluded.ip_address,
+                last_seen = excluded.last_seen,
+                status = excluded.status
         ''', (room, mac_address, ip_address))
         
         conn.commit()
+        room_row = conn.execute('SELECT * FROM rooms WHERE room = ?', (room,)).fetchone()
         conn.close()
         
+        stats_counters.adjust(
+            total_rooms=1 - len(replaced),
+            online_rooms=1 - sum(1 for row in replaced if row['status'] == 'online')
+        )
+        if freed:
+            # The freed room's capacity is gone with its row
+            policy_engine.rebuild()
+        
+        if room_row:
+            dashboard_notifier.publish('rooms', room_json(room_row))
+        
         return jsonify({
             'success': True,
             'message': f'ESP32 registered successfully for room {room}',
@@ -444,7 +3432,11 @@ def register_esp32():
 
 @app.route('/api/esp32/check_access', methods=['POST'])
 def check_esp32_access():
-    """ESP32 checks if RFID card has access to room"""
+    """ESP32 checks if RFID card has access to room.
+
+    Each decision is recorded in access_trace (see /api/admin/access_trace).
+    """
+    started = time.perf_counter()
     try:
         # Get JSON data from request
         data = request.get_json()
@@ -475,86 +3467,56 @@ def check_esp32_access():
                 'success': False
             }), 400
         
-        print(f"[DEBUG] Checking access for RFID: {rfid_uid}, Room: {room}")
-        
-        conn = get_db_connection()
+        diagnostics = access_trace.diagnostics_enabled(room, rfid_uid)
         
-        # Update room status and last seen timestamp
+        # Update room status and last seen timestamp (written by the access
+        # log writer together with this swipe's log row)
         if mac_address:
-            room_update = conn.execute('''
-                UPDATE rooms SET last_seen = CURRENT_TIMESTAMP, status = 'online'
-                WHERE room = ? OR mac_address = ?
-            ''', (room, mac_address))
-            print(f"[DEBUG] Updated room status for {room}, rows affected: {room_update.rowcount}")
-        
-        # Check if user exists in the database
-        user = conn.execute('''
-            SELECT id, uuid, name, role 
-            FROM users_reg 
-            WHERE uuid = ?
-        ''', (rfid_uid,)).fetchone()
+            access_log_writer.touch_room(room, mac_address)
+        
+        # Check if user exists (served from the in-memory authorization index)
+        user = auth_index.get_user(rfid_uid)
         
         if not user:
-            print(f"[DEBUG] Unknown RFID card: {rfid_uid}")
             # Log the failed access attempt
-            conn.execute('''
-                INSERT INTO access_logs (rfid_uid, room, access_granted, access_type, notes)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (rfid_uid, room, False, 'denied', 'Unknown RFID card'))
-            conn.commit()
-            conn.close()
+            access_log_writer.log(rfid_uid, room, False, 'denied', 'Unknown RFID card')
+            access_trace.record(rfid_uid=rfid_uid, room=room, decision='unknown', reason='Unknown RFID card',
+                                duration_us=int((time.perf_counter() - started) * 1e6))
             
-            return jsonify({
+            response = {
                 'access_granted': False,
                 'user_name': None,
                 'message': 'Unknown RFID card',
                 'cache_user': False,
-                'success': True,
-                'debug_info': f'RFID {rfid_uid} not found in users_reg table'
-            })
-        
-        print(f"[DEBUG] Found user: {user['name']} ({user['role']})")
+                'success': True
+            }
+            if diagnostics:
+                response['debug_info'] = f'RFID {rfid_uid} not found in users_reg table'
+            return jsonify(response)
         
-        # Get current timestamp in the same format as database
-        current_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"[DEBUG] Current time: {current_timestamp}")
+        # Get current time (second precision, same as the stored timestamps)
+        current_time = datetime.now().replace(microsecond=0)
         
         # Check for valid, approved request for this user and room
-        # Using proper datetime comparison with explicit format
-        valid_request = conn.execute('''
-            SELECT r.id, r.uid, r.start_time, r.end_time, r.room, r.access, 
-                   r.approved_by, r.approved_at, u.name
-            FROM requests r
-            JOIN users_reg u ON r.uid = u.uuid
-            WHERE r.uid = ? 
-            AND r.room = ? 
-            AND r.access = 1
-            AND datetime(r.start_time) <= datetime(?)
-            AND datetime(r.end_time) >= datetime(?)
-            ORDER BY r.timestamp DESC
-            LIMIT 1
-        ''', (rfid_uid, room, current_timestamp, current_timestamp)).fetchone()
+        valid_request = auth_index.find_active_grant(rfid_uid, room, current_time)
         
         if valid_request:
-            print(f"[DEBUG] Valid request found: ID {valid_request['id']}, expires at {valid_request['end_time']}")
-            
-            # Grant access and update/add to ESP32 cache
-            conn.execute('''
-                INSERT OR REPLACE INTO esp32_cache (room, rfid_uid, name, expires_at)
-                VALUES (?, ?, ?, ?)
-            ''', (room, rfid_uid, user['name'], valid_request['end_time']))
+            # Grant access and update/add to ESP32 cache (written with the log row)
+            access_log_writer.cache_grant(room, rfid_uid, user['name'], valid_request['end_time'])
             
             # Log successful access
-            conn.execute('''
-                INSERT INTO access_logs (rfid_uid, room, access_granted, access_type, notes)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (rfid_uid, room, True, 'database', 
-                  f'Valid request found (ID: {valid_request["id"]}), cached until {valid_request["end_time"]}'))
+            kind = 'recurring request' if valid_request.get('recurring') else 'request'
+            access_log_writer.log(rfid_uid, room, True, 'database',
+                                  f'Valid {kind} found (ID: {valid_request["id"]}), cached until {valid_request["end_time"]}')
             
-            conn.commit()
-            conn.close()
+            expiry_scheduler.schedule(valid_request['end_time'])
+            stats_counters.track_cache([(room, rfid_uid, valid_request['end_time'])])
+            access_trace.record(rfid_uid=rfid_uid, room=room, decision='granted', reason=f'Valid {kind} found',
+                                user_name=user['name'], role=user['role'], request_id=valid_request['id'],
+                                expires_at=valid_request['end_time'],
+                                duration_us=int((time.perf_counter() - started) * 1e6))
             
-            return jsonify({
+            response = {
                 'access_granted': True,
                 'user_name': user['name'],
                 'user_role': user['role'],
@@ -563,48 +3525,47 @@ def check_esp32_access():
                 'expires_at': valid_request['end_time'],
                 'success': True,
                 'request_id': valid_request['id'],
-                'debug_info': f'Request valid from {valid_request["start_time"]} to {valid_request["end_time"]}'
-            })
+                'recurring': bool(valid_request.get('recurring'))
+            }
+            if diagnostics:
+                response['debug_info'] = f'Request valid from {valid_request["start_time"]} to {valid_request["end_time"]}'
+            return jsonify(response)
         else:
-            print(f"[DEBUG] No valid request found for {user['name']} in room {room}")
-            
-            # Check if there are any requests for this user/room (for debugging)
-            debug_requests = conn.execute('''
-                SELECT id, start_time, end_time, access, approved_by
-                FROM requests 
-                WHERE uid = ? AND room = ?
-                ORDER BY timestamp DESC
-                LIMIT 3
-            ''', (rfid_uid, room)).fetchall()
-            
-            debug_info = f"Found {len(debug_requests)} total requests for this user/room. "
-
-            if debug_requests:
-                for req in debug_requests:
-                    debug_info += f"ID:{req['id']} ({req['start_time']} to {req['end_time']}, approved:{req['access']}) "
-            else:
-                debug_info += "No requests found at all."
-            
-            print(f"[DEBUG] {debug_info}")
+            recent_requests = None
+            if diagnostics:
+                # The user's latest requests for this room, only while diagnostics are on
+                conn = get_db_connection()
+                try:
+                    recent_requests = [dict(row) for row in conn.execute('''
+                        SELECT id, start_time, end_time, access, approved_by
+                        FROM requests 
+                        WHERE uid = ? AND room = ?
+                        ORDER BY timestamp DESC
+                        LIMIT 3
+                    ''', (rfid_uid, room))]
+                finally:
+                    conn.close()
             
             # Log denied access
-            conn.execute('''
-                INSERT INTO access_logs (rfid_uid, room, access_granted, access_type, notes)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (rfid_uid, room, False, 'denied', 'No valid request found'))
+            access_log_writer.log(rfid_uid, room, False, 'denied', 'No valid request found')
             
-            conn.commit()
-            conn.close()
+            access_trace.record(rfid_uid=rfid_uid, room=room, decision='denied', reason='No valid request found',
+                                user_name=user['name'], role=user['role'], recent_requests=recent_requests,
+                                duration_us=int((time.perf_counter() - started) * 1e6))
             
-            return jsonify({
+            response = {
                 'access_granted': False,
                 'user_name': user['name'],
                 'user_role': user['role'],
                 'message': f'No valid request found for {user["name"]} in room {room}',
                 'cache_user': False,
-                'success': True,
-                'debug_info': debug_info
-            })
+                'success': True
+            }
+            if diagnostics:
+                response['debug_info'] = f"Found {len(recent_requests)} recent requests for this user/room: " + (
+                    ' '.join(f"ID:{req['id']} ({req['start_time']} to {req['end_time']}, approved:{req['access']})"
+                             for req in recent_requests) or 'none')
+            return jsonify(response)
         
     except sqlite3.Error as db_error:
         print(f"[ERROR] Database error: {str(db_error)}")
@@ -670,6 +3631,141 @@ def cleanup_esp32_cache():
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 500
 
+@app.route('/api/esp32/sync', methods=['GET'])
+def sync_esp32_allowlist():
+    """ESP32 fetches allowlist changes since the version it already has"""
+    room = request.args.get('room', '').strip()
+    since = request.args.get('version', 0, type=int)
+
+    if not room:
+        return jsonify({'error': 'Room name is required', 'success': False}), 400
+
+    try:
+        version, changes = allowlist_sync.changes_since(room, since)
+    except sqlite3.Error as db_error:
+        return jsonify({'error': f'Database error: {str(db_error)}', 'success': False}), 500
+
+    if changes is None:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({'success': True, 'room': room, 'version': version, **changes})
+    response.headers['ETag'] = f'"{version}"'
+    return response
+
+def parse_device_timestamp(event, received_at):
+    """Resolve the UTC time of a device event.
+
+    Accepts `timestamp` as epoch seconds/milliseconds or an ISO string (naive
+    strings are taken as UTC), or `age_ms` relative to the upload time for
+    devices without a real-time clock. Falls back to the upload time and never
+    returns a time in the future.
+    """
+    value = event.get('timestamp')
+    when = None
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            seconds = value / 1000 if value > 1e12 else value
+            when = datetime.fromtimestamp(seconds, timezone.utc)
+        elif isinstance(value, str) and value.strip():
+            when = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+            if when.tzinfo is None:
+                when = when.replace(tzinfo=timezone.utc)
+        elif event.get('age_ms') is not None:
+            when = received_at - timedelta(milliseconds=int(event['age_ms']))
+    except (ValueError, TypeError, OverflowError, OSError):
+        raise ValueError(f'Invalid timestamp: {value!r}')
+
+    if when is None or when > received_at:
+        when = received_at
+    return when.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/api/esp32/access_log', methods=['POST'])
+def ingest_esp32_access_log():
+    """ESP32 uploads one access event or a batch of buffered events"""
+    try:
+        data = request.get_json(silent=True)
+        if data is None:
+            return jsonify({'error': 'No JSON data provided', 'success': False}), 400
+
+        # Accept a single event, a bare array, or {"events": [...]} with
+        # device-level defaults (room, mac_address, device_id) in the envelope
+        envelope = {}
+        if isinstance(data, list):
+            raw_events = data
+        elif isinstance(data, dict) and isinstance(data.get('events'), list):
+            envelope = data
+            raw_events = data['events']
+        elif isinstance(data, dict):
+            raw_events = [data]
+        else:
+            return jsonify({'error': 'Expected an event object or a list of events', 'success': False}), 400
+
+        if len(raw_events) > ACCESS_LOG_MAX_UPLOAD:
+            return jsonify({
+                'error': f'Too many events in one upload (max {ACCESS_LOG_MAX_UPLOAD})',
+                'success': False
+            }), 413
+
+        received_at = datetime.now(timezone.utc)
+        events = []
+        last_seq = None
+
+        for index, raw in enumerate(raw_events):
+            if not isinstance(raw, dict):
+                return jsonify({'error': f'Event {index} is not an object', 'success': False}), 400
+
+            event = {**envelope, **raw}
+            rfid_uid = str(event.get('rfid_uid') or '').upper().strip()
+            room = str(event.get('room') or '').strip()
+            if not rfid_uid or not room:
+                return jsonify({'error': f'Event {index}: rfid_uid and room are required', 'success': False}), 400
+
+            granted = event.get('access_granted', False)
+            # Only real booleans or 0/1: bool("false") would record a grant
+            if granted not in (True, False) or isinstance(granted, float):
+                return jsonify({'error': f'Event {index}: access_granted must be true/false or 0/1',
+                                'success': False}), 400
+            granted = bool(granted)
+            access_type = event.get('access_type') or ('local' if granted else 'denied')
+            if access_type not in ('local', 'database', 'denied'):
+                return jsonify({'error': f'Event {index}: invalid access_type', 'success': False}), 400
+
+            device_id = str(event.get('device_id') or event.get('mac_address') or '').strip() or None
+            device_seq = event.get('seq')
+            if device_seq is not None:
+                try:
+                    device_seq = int(device_seq)
+                except (TypeError, ValueError):
+                    return jsonify({'error': f'Event {index}: seq must be an integer', 'success': False}), 400
+                if device_id is None:
+                    return jsonify({'error': f'Event {index}: seq requires device_id or mac_address', 'success': False}), 400
+                last_seq = device_seq if last_seq is None else max(last_seq, device_seq)
+
+            try:
+                timestamp = parse_device_timestamp(event, received_at)
+            except ValueError as ve:
+                return jsonify({'error': f'Event {index}: {str(ve)}', 'success': False}), 400
+
+            events.append((rfid_uid, room, granted, access_type,
+                           event.get('notes') or 'Reported by device', timestamp,
+                           device_id, device_seq))
+
+        inserted = access_log_writer.write_batch(events)
+
+        return jsonify({
+            'success': True,
+            'received': len(events),
+            'inserted': inserted,
+            'duplicates': len(events) - inserted,
+            'last_seq': last_seq
+        })
+
+    except sqlite3.Error as db_error:
+        logger.error(f"Database error while ingesting access logs: {str(db_error)}")
+        return jsonify({'error': f'Database error: {str(db_error)}', 'success': False}), 500
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
 # ================== STUDENT API ENDPOINTS ==================
 
 @app.route('/user/dashboard')
@@ -734,51 +3830,163 @@ def submit_request():
         start_time_iso = start_dt.isoformat()
         end_time_iso = end_dt.isoformat()
 
-        # Check auto approve_request room 
-        auto_approve_row = conn.execute('''
-            SELECT auto_approve
-            FROM rooms
-            WHERE room = ?
-        ''', (room,)).fetchone()
-
-        if auto_approve_row is not None:
-            auto_approve_value = auto_approve_row[0]
-            auto_approve = bool(auto_approve_value)
-            print('auto approve value from DB:', auto_approve_value)
-            print('auto approve bool:', auto_approve)
-        else:
-            print('Room not found or auto_approve is NULL')
-            auto_approve = False
-        
-        # Insert request
-        if auto_approve:
-            conn.execute('''
-                INSERT INTO requests (uid, name, start_time, end_time, room, access, approved_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user['uuid'], user['name'], start_time_iso, end_time_iso, room, True, 'Auto Approved'))
-        else:
-            conn.execute('''
-                INSERT INTO requests (uid, name, start_time, end_time, room)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user['uuid'], user['name'], start_time_iso, end_time_iso, room))
-        
-        conn.commit()
-        conn.close()
+        with reservation_index.booking_lock:
+            # Pending and approved bookings in this room that share time with the new one
+            overlapping = reservation_index.overlapping(room, start_dt, end_dt)
+            if any(r['uid'] == user['uuid'] for r in overlapping):
+                conn.close()
+                return jsonify({'error': 'ท่านมีการจองห้องนี้ในช่วงเวลาที่ทับซ้อนกันอยู่แล้ว', 'success': False}), 409
+            capacity = policy_engine.capacity(room)
+            if capacity is not None and reservation_index.peak(room, start_dt, end_dt) >= capacity:
+                conn.close()
+                return jsonify({'error': 'ห้องเต็มในช่วงเวลาที่เลือก', 'success': False}), 409
+            
+            # Auto-approval policies (evaluated in memory)
+            decision, policy_id = policy_engine.decide(
+                room, user['role'], start_dt, end_dt, reservation_index.held_by(room, user['uuid']))
+            
+            # Insert request
+            if decision == 'approve':
+                cursor = conn.execute('''
+                    INSERT INTO requests (uid, name, start_time, end_time, room, access, approved_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (user['uuid'], user['name'], start_time_iso, end_time_iso, room, True, 'Auto Approved'))
+            elif decision == 'deny':
+                cursor = conn.execute('''
+                    INSERT INTO requests (uid, name, start_time, end_time, room, access, approved_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (user['uuid'], user['name'], start_time_iso, end_time_iso, room, False, 'Auto Denied'))
+            else:
+                cursor = conn.execute('''
+                    INSERT INTO requests (uid, name, start_time, end_time, room)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user['uuid'], user['name'], start_time_iso, end_time_iso, room))
+            
+            conn.commit()
+            conn.close()
+            
+            # Also reloads the room in reservation_index through the listener
+            auth_index.refresh_grants(user['uuid'], room)
+        status = {'approve': 'approved', 'deny': 'denied'}.get(decision, 'pending')
+        stats_counters.request_changed(None, status)
+        publish_request_update(cursor.lastrowid)
         
         return jsonify({
             'success': True,
             'message': 'Request submitted successfully',
+            'status': status,
+            'policy_id': policy_id,
             'request_details': {
                 'name': user['name'],
                 'start_time': start_time_iso,
                 'end_time': end_time_iso,
                 'room': room
-            }
+            },
+            'conflicts': [r['id'] for r in overlapping if not r.get('recurring')],
+            'recurring_conflicts': sorted({r['id'] for r in overlapping if r.get('recurring')})
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/student/submit_recurring_request', methods=['POST'])
+def submit_recurring_request():
+    """Student submits a weekly (or every-N-weeks) room reservation as one rule"""
+    try:
+        data = request.get_json() or {}
+        user_id = str(data.get('user_id', '')).strip()
+        room = str(data.get('room', '')).strip()
+        if not user_id or not room:
+            return jsonify({'error': 'All fields are required', 'success': False}), 400
+        try:
+            rule = parse_recurring_rule(data)
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        
+        conn = get_db_connection()
+        user = conn.execute('SELECT * FROM users_reg WHERE user_id = ?', (user_id,)).fetchone()
+        if not user:
+            conn.close()
+            return jsonify({'error': 'ไม่พบรหัสประจำตัวของผู้ใช้งานในฐานข้อมูล', 'success': False}), 404
+        
+        capacity = policy_engine.capacity(room)
+        preview = load_recurring_rule(dict(rule, id=None, uid=user['uuid'], name=user['name'], room=room,
+                                           access=False, approved_by=None, timestamp=None))
+        now = datetime.now()
+        occurrences = [(s, e) for s, e in recurring_occurrences(
+            preview, now, datetime.combine(preview['last_date'], preview['end_clock'])) if s >= now]
+        if not occurrences:
+            conn.close()
+            return jsonify({'error': 'The rule has no future occurrences', 'success': False}), 400
+        
+        with reservation_index.booking_lock:
+            held = reservation_index.held_by(room, user['uuid'])
+            decisions = set()
+            for position, (start_dt, end_dt) in enumerate(occurrences):
+                # Earlier occurrences of this rule count towards max_active_per_user too
+                decisions.add(policy_engine.decide(room, user['role'], start_dt, end_dt, held + position)[0])
+                overlapping = reservation_index.overlapping(room, start_dt, end_dt)
+                if any(r['uid'] == user['uuid'] for r in overlapping):
+                    conn.close()
+                    return jsonify({'error': 'ท่านมีการจองห้องนี้ในช่วงเวลาที่ทับซ้อนกันอยู่แล้ว',
+                                    'date': start_dt.date().isoformat(), 'success': False}), 409
+                if capacity is not None and reservation_index.peak(room, start_dt, end_dt) >= capacity:
+                    conn.close()
+                    return jsonify({'error': 'ห้องเต็มในช่วงเวลาที่เลือก',
+                                    'date': start_dt.date().isoformat(), 'success': False}), 409
+            
+            # Decided automatically only when every occurrence gets the same answer
+            status = {'approve': 'approved', 'deny': 'denied'}.get(decisions.pop(), 'pending') if len(decisions) == 1 else 'pending'
+            approved_by = {'approved': 'Auto Approved', 'denied': 'Auto Denied'}.get(status)
+            cursor = conn.execute('''
+                INSERT INTO recurring_requests (uid, name, room, weekdays, start_clock, end_clock,
+                                                first_date, last_date, interval_weeks, exceptions,
+                                                access, approved_by, approved_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CASE WHEN ? IS NOT NULL THEN CURRENT_TIMESTAMP END)
+            ''', (user['uuid'], user['name'], room, rule['weekdays'], rule['start_clock'], rule['end_clock'],
+                  rule['first_date'], rule['last_date'], rule['interval_weeks'], rule['exceptions'],
+                  status == 'approved', approved_by, approved_by))
+            conn.commit()
+            conn.close()
+            recurring_schedule.refresh_rule(cursor.lastrowid)
+        stats_counters.request_changed(None, status, kind='recurring_requests')
+        publish_recurring_update(cursor.lastrowid)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Recurring request submitted successfully',
+            'id': cursor.lastrowid,
+            'status': status,
+            'occurrences': len(occurrences),
+            'first_occurrence': occurrences[0][0].isoformat()
         })
         
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 500
 
+def recurring_request_json(row):
+    """Serialize a recurring_requests row for the student and admin views"""
+    rule = load_recurring_rule(row)
+    next_start = recurring_schedule.next_occurrence(rule)
+    return {
+        'id': row['id'],
+        'uid': row['uid'],
+        'name': row['name'],
+        'room': row['room'],
+        'weekdays': sorted(rule['weekdays']),
+        'start_time': row['start_clock'],
+        'end_time': row['end_clock'],
+        'start_date': row['first_date'],
+        'end_date': row['last_date'],
+        'interval_weeks': row['interval_weeks'],
+        'exceptions': json.loads(row['exceptions']),
+        'status': rule['status'],
+        'timestamp': row['timestamp'],
+        'approved_by': row['approved_by'],
+        'approved_at': row['approved_at'],
+        'next_occurrence': next_start.isoformat() if next_start else None
+    }
+
 @app.route('/api/student/my_requests/<user_id>', methods=['GET'])
 def get_student_requests(user_id):
     """Get all requests for a specific student by user_id"""
@@ -793,6 +4001,13 @@ def get_student_requests(user_id):
             WHERE u.user_id = ?
             ORDER BY r.timestamp DESC
         ''', (user_id,)).fetchall()
+        recurring = conn.execute('''
+            SELECT rr.*
+            FROM recurring_requests rr
+            JOIN users_reg u ON rr.uid = u.uuid
+            WHERE u.user_id = ?
+            ORDER BY rr.timestamp DESC
+        ''', (user_id,)).fetchall()
         
         conn.close()
         
@@ -812,7 +4027,10 @@ def get_student_requests(user_id):
                 'approved_at': req['approved_at']
             })
         
-        return jsonify({'requests': requests_list})
+        return jsonify({
+            'requests': requests_list,
+            'recurring_requests': [recurring_request_json(row) for row in recurring]
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -824,6 +4042,7 @@ def validate_user(user_id):
         # Replace this with your actual database query
         conn = get_db_connection()
         user = conn.execute("SELECT * FROM users_reg WHERE user_id = ?", (user_id,)).fetchone()
+        conn.close()
         
         if user:
             return jsonify({
@@ -846,22 +4065,190 @@ def validate_user(user_id):
             "error": str(e)
         }), 500
 
+# ================== LIST PAGINATION ==================
+
+def encode_cursor(values):
+    """Encode the sort key of the last row on a page as an opaque cursor"""
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token, size):
+    """Decode a cursor made by encode_cursor, raising ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Invalid cursor')
+    return values
+
+def page_limit():
+    """Read ?limit=, clamped to 1..PAGE_SIZE_MAX"""
+    limit = request.args.get('limit', PAGE_SIZE_DEFAULT, type=int)
+    return max(1, min(limit, PAGE_SIZE_MAX))
+
+def parse_filter_datetime(name):
+    """Read a date/datetime query argument as a 'YYYY-MM-DD HH:MM:SS' string"""
+    value = request.args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '')).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'Invalid {name}: expected YYYY-MM-DD or an ISO datetime')
+
+def fetch_page(conn, select_sql, filters, params, order, limit, cursor=None, descending=True):
+    """Run one keyset-paginated query and return (rows, next_cursor).
+
+    order is a list of (sql_expression, row_key) pairs; the last one must be
+    unique (the id). The cursor holds the previous page's last sort key, so
+    each page is an index range scan rather than an OFFSET.
+    """
+    filters = list(filters)
+    params = list(params)
+    if cursor:
+        columns = ', '.join(expr for expr, _ in order)
+        placeholders = ', '.join('?' for _ in order)
+        filters.append(f"({columns}) {'<' if descending else '>'} ({placeholders})")
+        params.extend(decode_cursor(cursor, len(order)))
+
+    direction = 'DESC' if descending else 'ASC'
+    sql = select_sql
+    if filters:
+        sql += ' WHERE ' + ' AND '.join(filters)
+    sql += ' ORDER BY ' + ', '.join(f'{expr} {direction}' for expr, _ in order)
+    sql += ' LIMIT ?'
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][key] for _, key in order)
+    return rows, next_cursor
+
+def iter_rows(cursor, batch_size=EXPORT_BATCH_SIZE):
+    """Yield a cursor's rows, fetching batch_size at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def iter_query(select_sql, filters, params, order_by):
+    """Yield the rows of a filtered query from a live cursor (constant memory)"""
+    sql = select_sql
+    if filters:
+        sql += ' WHERE ' + ' AND '.join(filters)
+    sql += ' ORDER BY ' + order_by
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(sql, params)
+        try:
+            yield from iter_rows(cursor)
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+def request_list_filters():
+    """Filters for requests (alias r): room, status, user, since/until"""
+    filters, params = [], []
+    room = request.args.get('room', '').strip()
+    if room:
+        filters.append('r.room = ?')
+        params.append(room)
+    status = request.args.get('status', '').strip().lower()
+    if status == 'pending':
+        filters.append('r.access = FALSE AND r.approved_by IS NULL')
+    elif status == 'approved':
+        filters.append('r.access = TRUE')
+    elif status == 'denied':
+        filters.append('r.access = FALSE AND r.approved_by IS NOT NULL')
+    elif status:
+        raise ValueError('status must be pending, approved or denied')
+    user = request.args.get('user', '').strip().upper()
+    if user:
+        filters.append('r.uid = ?')
+        params.append(user)
+    since, until = parse_filter_datetime('since'), parse_filter_datetime('until')
+    if since:
+        filters.append('r.timestamp >= ?')
+        params.append(since)
+    if until:
+        filters.append('r.timestamp < ?')
+        params.append(until)
+    return filters, params
+
+def user_list_filters():
+    """Filters for users_reg: role, user (RFID UID or user id), since/until"""
+    filters, params = [], []
+    role = request.args.get('role', '').strip().lower()
+    if role:
+        filters.append('role = ?')
+        params.append(role)
+    user = request.args.get('user', '').strip().upper()
+    if user:
+        filters.append('(uuid = ? OR user_id = ?)')
+        params.extend([user, user])
+    since, until = parse_filter_datetime('since'), parse_filter_datetime('until')
+    if since:
+        filters.append('created_at >= ?')
+        params.append(since)
+    if until:
+        filters.append('created_at < ?')
+        params.append(until)
+    return filters, params
+
+def access_log_filters():
+    """Filters for access_logs (alias al); also returns since/until for partition pruning"""
+    filters, params = [], []
+    room = request.args.get('room', '').strip()
+    if room:
+        filters.append('al.room = ?')
+        params.append(room)
+    status = request.args.get('status', '').strip().lower()
+    if status in ('granted', 'denied'):
+        filters.append('al.access_granted = ?')
+        params.append(status == 'granted')
+    elif status:
+        raise ValueError('status must be granted or denied')
+    user = request.args.get('user', '').strip().upper()
+    if user:
+        filters.append('al.rfid_uid = ?')
+        params.append(user)
+    since, until = parse_filter_datetime('since'), parse_filter_datetime('until')
+    if since:
+        filters.append('al.timestamp >= ?')
+        params.append(since)
+    if until:
+        filters.append('al.timestamp < ?')
+        params.append(until)
+    return filters, params, since, until
+
 # ================== ADMIN API ENDPOINTS ==================
 
 @app.route('/api/admin/requests', methods=['GET'])
 @api_login_required
 def get_all_requests():
-    """Get all room access requests"""
+    """Get room access requests, newest first, one page at a time.
+
+    Filters: room, status (pending/approved/denied), user (RFID UID),
+    since/until (submission time, UTC). Pass next_cursor back as ?cursor=.
+    """
     try:
-        conn = get_db_connection()
-        requests = conn.execute('''
-            SELECT r.*, u.name, u.role 
-            FROM requests r
-            JOIN users_reg u ON r.uid = u.uuid
-            ORDER BY r.timestamp DESC
-        ''').fetchall()
+        filters, params = request_list_filters()
         
-        conn.close()
+        conn = get_db_connection()
+        try:
+            requests, next_cursor = fetch_page(conn, '''
+                SELECT r.*, u.name, u.role 
+                FROM requests r
+                JOIN users_reg u ON r.uid = u.uuid
+            ''', filters, params, [('r.timestamp', 'timestamp'), ('r.id', 'id')],
+                page_limit(), request.args.get('cursor'))
+        finally:
+            conn.close()
         
         requests_list = []
         for req in requests:
@@ -879,8 +4266,10 @@ def get_all_requests():
                 'approved_at': req['approved_at']
             })
         
-        return jsonify({'requests': requests_list})
+        return jsonify({'requests': requests_list, 'next_cursor': next_cursor})
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -894,6 +4283,9 @@ def approve_request(request_id):
         admin_name = data.get('admin_name', 'Admin')
         
         conn = get_db_connection()
+        previous = conn.execute(
+            'SELECT access, approved_by FROM requests WHERE id = ?', (request_id,)
+        ).fetchone()
         
         if approve:
             conn.execute('''
@@ -913,22 +4305,238 @@ def approve_request(request_id):
         conn.commit()
         conn.close()
         
+        auth_index.refresh_request(request_id)
+        if previous:
+            stats_counters.request_changed(
+                request_state(previous['access'], previous['approved_by']),
+                'approved' if approve else 'denied'
+            )
+        publish_request_update(request_id)
+        
         return jsonify({'success': True, 'message': message})
         
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 500
 
+@app.route('/api/admin/recurring_requests', methods=['GET'])
+@api_login_required
+def get_recurring_requests():
+    """List recurring reservation rules, newest first.
+
+    Filters: room, status (pending/approved/denied). Pass next_cursor back as ?cursor=.
+    """
+    try:
+        filters, params = [], []
+        room = request.args.get('room', '').strip()
+        if room:
+            filters.append('room = ?')
+            params.append(room)
+        status = request.args.get('status', '').strip().lower()
+        if status == 'pending':
+            filters.append('access = FALSE AND approved_by IS NULL')
+        elif status == 'approved':
+            filters.append('access = TRUE')
+        elif status == 'denied':
+            filters.append('access = FALSE AND approved_by IS NOT NULL')
+        elif status:
+            return jsonify({'error': 'status must be pending, approved or denied'}), 400
+        
+        conn = get_db_connection()
+        try:
+            rows, next_cursor = fetch_page(conn, 'SELECT * FROM recurring_requests', filters, params,
+                                           [('timestamp', 'timestamp'), ('id', 'id')],
+                                           page_limit(), request.args.get('cursor'))
+        finally:
+            conn.close()
+        
+        return jsonify({
+            'recurring_requests': [recurring_request_json(row) for row in rows],
+            'next_cursor': next_cursor
+        })
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/recurring_requests/<int:rule_id>/approve', methods=['PUT'])
+@api_login_required
+def approve_recurring_request(rule_id):
+    """Approve or deny a whole recurring reservation"""
+    try:
+        data = request.get_json() or {}
+        approve = bool(data.get('approve', False))
+        admin_name = data.get('admin_name', 'Admin')
+        
+        conn = get_db_connection()
+        previous = conn.execute(
+            'SELECT access, approved_by FROM recurring_requests WHERE id = ?', (rule_id,)
+        ).fetchone()
+        cursor = conn.execute('''
+            UPDATE recurring_requests
+            SET access = ?, approved_by = ?, approved_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (approve, admin_name, rule_id))
+        conn.commit()
+        conn.close()
+        
+        if cursor.rowcount == 0:
+            return jsonify({'error': 'Recurring request not found', 'success': False}), 404
+        recurring_schedule.refresh_rule(rule_id)
+        if previous:
+            stats_counters.request_changed(
+                request_state(previous['access'], previous['approved_by']),
+                'approved' if approve else 'denied',
+                kind='recurring_requests'
+            )
+        publish_recurring_update(rule_id)
+        
+        return jsonify({
+            'success': True,
+            'message': f"Recurring request {'approved' if approve else 'denied'} successfully"
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/admin/recurring_requests/<int:rule_id>/exceptions', methods=['POST'])
+@api_login_required
+def add_recurring_exceptions(rule_id):
+    """Cancel single occurrences of a recurring reservation. Body: {"dates": ["YYYY-MM-DD", ...]}"""
+    try:
+        data = request.get_json() or {}
+        try:
+            dates = {datetime.strptime(str(d).strip(), '%Y-%m-%d').date().isoformat() for d in data.get('dates') or []}
+        except ValueError:
+            return jsonify({'error': 'dates must be YYYY-MM-DD strings', 'success': False}), 400
+        if not dates:
+            return jsonify({'error': 'dates is required', 'success': False}), 400
+        
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT exceptions FROM recurring_requests WHERE id = ?', (rule_id,)).fetchone()
+            if not row:
+                conn.rollback()
+                return jsonify({'error': 'Recurring request not found', 'success': False}), 404
+            exceptions = sorted(set(json.loads(row['exceptions'])) | dates)
+            conn.execute('UPDATE recurring_requests SET exceptions = ? WHERE id = ?',
+                         (json.dumps(exceptions), rule_id))
+            conn.commit()
+        finally:
+            conn.close()
+        
+        recurring_schedule.refresh_rule(rule_id)
+        publish_recurring_update(rule_id)
+        return jsonify({'success': True, 'exceptions': exceptions})
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/admin/requests/bulk_decision', methods=['POST'])
+@api_login_required
+def bulk_decide_requests():
+    """Approve or deny many requests in one transaction.
+
+    Body: {"approve": bool, "admin_name": str, and either "ids": [...] or
+    "filter": {"room", "role", "from", "to", "pending_only" (default true)}}.
+    from/to bound the reservation window (local time). Returns the affected
+    ids; caches and dashboards are notified once for the whole batch.
+    """
+    try:
+        data = request.get_json() or {}
+        approve = data.get('approve')
+        if not isinstance(approve, bool):
+            return jsonify({'error': 'approve must be true or false', 'success': False}), 400
+        admin_name = data.get('admin_name', 'Admin')
+        ids = data.get('ids')
+        criteria = data.get('filter')
+
+        filters, params = [], []
+        if ids is not None:
+            if not isinstance(ids, list) or not all(type(i) is int for i in ids):
+                return jsonify({'error': 'ids must be a list of request ids', 'success': False}), 400
+            if len(ids) > BULK_DECISION_MAX:
+                return jsonify({'error': f'At most {BULK_DECISION_MAX} ids per call', 'success': False}), 400
+            filters.append('r.id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(ids))
+        elif isinstance(criteria, dict):
+            if criteria.get('pending_only', True):
+                filters.append('r.access = FALSE AND r.approved_by IS NULL')
+            if criteria.get('room'):
+                filters.append('r.room = ?')
+                params.append(str(criteria['room']).strip())
+            if criteria.get('role'):
+                filters.append('EXISTS (SELECT 1 FROM users_reg u WHERE u.uuid = r.uid AND u.is_deleted = 0 AND u.role = ?)')
+                params.append(str(criteria['role']).strip().lower())
+            for key, clause in (('from', 'datetime(r.start_time) >= datetime(?)'),
+                                ('to', 'datetime(r.end_time) <= datetime(?)')):
+                if criteria.get(key):
+                    try:
+                        params.append(datetime.fromisoformat(criteria[key]).strftime('%Y-%m-%d %H:%M:%S'))
+                    except (TypeError, ValueError):
+                        return jsonify({'error': f'Invalid {key}: expected an ISO datetime', 'success': False}), 400
+                    filters.append(clause)
+        else:
+            return jsonify({'error': 'Provide ids or filter', 'success': False}), 400
+
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(f'''
+                SELECT r.id, r.uid, r.room, r.access, r.approved_by
+                FROM requests r
+                WHERE {' AND '.join(filters) if filters else '1'}
+                LIMIT ?
+            ''', params + [BULK_DECISION_MAX + 1]).fetchall()
+            if len(rows) > BULK_DECISION_MAX:
+                conn.rollback()
+                return jsonify({'error': f'Filter matches more than {BULK_DECISION_MAX} requests, narrow it down', 'success': False}), 400
+
+            affected = [row['id'] for row in rows]
+            conn.execute('''
+                UPDATE requests
+                SET access = ?, approved_by = ?, approved_at = CURRENT_TIMESTAMP
+                WHERE id IN (SELECT value FROM json_each(?))
+            ''', (approve, admin_name, json.dumps(affected)))
+            conn.commit()
+        finally:
+            conn.close()
+
+        new_state = 'approved' if approve else 'denied'
+        for row in rows:
+            stats_counters.request_changed(request_state(row['access'], row['approved_by']), new_state)
+        auth_index.refresh_grants_many((row['uid'], row['room']) for row in rows)
+        if affected:
+            dashboard_notifier.resync('requests')
+
+        verb = 'approved' if approve else 'denied'
+        return jsonify({
+            'success': True,
+            'message': f'{len(affected)} request(s) {verb}',
+            'affected': len(affected),
+            'ids': affected
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
 @app.route('/api/admin/users', methods=['GET', 'POST'])
 @api_login_required
 def manage_users():
-    """Get all users or add new user"""
+    """Get users (newest first, paginated) or add new user"""
     if request.method == 'GET':
         try:
+            filters, params = user_list_filters()
+            
             conn = get_db_connection()
-            users = conn.execute('''
-                SELECT * FROM users_reg ORDER BY created_at DESC
-            ''').fetchall()
-            conn.close()
+            try:
+                users, next_cursor = fetch_page(
+                    conn, 'SELECT * FROM users_reg', filters, params,
+                    [('created_at', 'created_at'), ('id', 'id')],
+                    page_limit(), request.args.get('cursor'))
+            finally:
+                conn.close()
             
             users_list = []
             for user in users:
@@ -940,8 +4548,10 @@ def manage_users():
                     'role': user['role'],
                     'created_at': user['created_at']
                 })
-            return jsonify({'users': users_list})
+            return jsonify({'users': users_list, 'next_cursor': next_cursor})
             
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             return jsonify({'error': str(e)}), 500
     
@@ -982,57 +4592,254 @@ def manage_users():
             conn.commit()
             conn.close()
             
+            auth_index.refresh_user(uuid)
+            stats_counters.adjust_role(role, 1)
+            
             return jsonify({'success': True, 'message': 'User added successfully'})
             
         except Exception as e:
             return jsonify({'error': str(e), 'success': False}), 500
 
-@app.route('/api/admin/rooms', methods=['GET'])
+def room_json(room):
+    """Serialize a rooms row for the admin views (with the policies that decide its requests)"""
+    return {
+        'id': room['id'],
+        'room': room['room'],
+        'policies': policy_engine.for_room(room['room']),
+        'capacity': room['capacity'],
+        'mac_address': room['mac_address'],
+        'ip_address': room['ip_address'],
+        'last_seen': room['last_seen'],
+        'status': room['status'],
+        'created_at': room['created_at']
+    }
+
+@app.route('/api/admin/rooms', methods=['GET'])
+@api_login_required
+def get_rooms():
+    """Get all registered rooms"""
+    try:
+        conn = get_db_connection()
+        rooms = conn.execute('''
+            SELECT * FROM rooms ORDER BY created_at DESC
+        ''').fetchall()
+        conn.close()
+        
+        return jsonify({'rooms': [room_json(room) for room in rooms]})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/rooms/<room>/capacity', methods=['PUT'])
+@api_login_required
+def set_room_capacity(room):
+    """Set how many bookings a room may hold at once (null = unlimited)"""
+    try:
+        data = request.get_json() or {}
+        capacity = data.get('capacity')
+        if capacity is not None and (isinstance(capacity, bool) or not isinstance(capacity, int) or capacity < 1):
+            return jsonify({'error': 'capacity must be a positive integer or null', 'success': False}), 400
+        
+        conn = get_db_connection()
+        cursor = conn.execute('UPDATE rooms SET capacity = ? WHERE room = ?', (capacity, room))
+        conn.commit()
+        conn.close()
+        
+        if cursor.rowcount == 0:
+            return jsonify({'error': 'Room not found', 'success': False}), 404
+        policy_engine.rebuild()
+        return jsonify({'success': True, 'room': room, 'capacity': capacity})
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/admin/approval_policies', methods=['GET'])
+@api_login_required
+def get_approval_policies():
+    """List auto-approval policies in evaluation order"""
+    try:
+        conn = get_db_connection()
+        rows = conn.execute('''
+            SELECT * FROM approval_policies
+            ORDER BY priority, room IS NULL, role IS NULL, id
+        ''').fetchall()
+        conn.close()
+        return jsonify({'policies': [approval_policy_json(row) for row in rows]})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/approval_policies', methods=['POST'])
+@api_login_required
+def add_approval_policy():
+    """Create an auto-approval policy"""
+    try:
+        try:
+            policy = parse_approval_policy(request.get_json() or {})
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        
+        conn = get_db_connection()
+        cursor = conn.execute(
+            f"INSERT INTO approval_policies ({', '.join(APPROVAL_POLICY_FIELDS)}) "
+            f"VALUES ({', '.join('?' for _ in APPROVAL_POLICY_FIELDS)})",
+            [policy[field] for field in APPROVAL_POLICY_FIELDS])
+        conn.commit()
+        conn.close()
+        
+        policy_engine.rebuild()
+        dashboard_notifier.resync('rooms')
+        return jsonify({'success': True, 'id': cursor.lastrowid})
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/admin/approval_policies/<int:policy_id>', methods=['PUT'])
+@api_login_required
+def update_approval_policy(policy_id):
+    """Replace an auto-approval policy"""
+    try:
+        try:
+            policy = parse_approval_policy(request.get_json() or {})
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        
+        conn = get_db_connection()
+        cursor = conn.execute(
+            f"UPDATE approval_policies SET {', '.join(f'{field} = ?' for field in APPROVAL_POLICY_FIELDS)} WHERE id = ?",
+            [policy[field] for field in APPROVAL_POLICY_FIELDS] + [policy_id])
+        conn.commit()
+        conn.close()
+        
+        if cursor.rowcount == 0:
+            return jsonify({'error': 'Policy not found', 'success': False}), 404
+        policy_engine.rebuild()
+        dashboard_notifier.resync('rooms')
+        return jsonify({'success': True})
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/admin/approval_policies/<int:policy_id>', methods=['DELETE'])
 @api_login_required
-def get_rooms():
-    """Get all registered rooms"""
+def delete_approval_policy(policy_id):
+    """Delete an auto-approval policy"""
     try:
         conn = get_db_connection()
-        rooms = conn.execute('''
-            SELECT * FROM rooms ORDER BY created_at DESC
-        ''').fetchall()
+        cursor = conn.execute('DELETE FROM approval_policies WHERE id = ?', (policy_id,))
+        conn.commit()
         conn.close()
         
-        rooms_list = []
-        for room in rooms:
-            rooms_list.append({
-                'id': room['id'],
-                'room': room['room'],
-                'auto_approve': room['auto_approve'],
-                'mac_address': room['mac_address'],
-                'ip_address': room['ip_address'],
-                'last_seen': room['last_seen'],
-                'status': room['status'],
-                'created_at': room['created_at']
-            })
+        if cursor.rowcount == 0:
+            return jsonify({'error': 'Policy not found', 'success': False}), 404
+        policy_engine.rebuild()
+        dashboard_notifier.resync('rooms')
+        return jsonify({'success': True})
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.route('/api/admin/approval_policies/evaluate', methods=['GET'])
+@api_login_required
+def evaluate_approval_policies():
+    """Dry run: what would intake decide for ?room=&role=&start=&end= (and optional uid)"""
+    try:
+        room = request.args.get('room', '').strip()
+        role = request.args.get('role', '').strip()
+        start = parse_filter_datetime('start')
+        end = parse_filter_datetime('end')
+        if not room or not role or not start or not end:
+            return jsonify({'error': 'room, role, start and end are required'}), 400
+        start_dt = datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
+        end_dt = datetime.strptime(end, '%Y-%m-%d %H:%M:%S')
+        uid = request.args.get('uid', '').strip().upper()
+        held = reservation_index.held_by(room, uid) if uid else 0
+        
+        action, policy_id = policy_engine.decide(room, role, start_dt, end_dt, held)
+        return jsonify({'action': action, 'policy_id': policy_id, 'held': held})
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/rooms/<room>/reservations', methods=['GET'])
+@api_login_required
+def get_room_reservations(room):
+    """Pending and approved bookings of a room.
+
+    With start and end, returns the bookings overlapping [start, end) and
+    the peak number held at once; otherwise who is booked at start (default now).
+    """
+    try:
+        start = parse_filter_datetime('start')
+        end = parse_filter_datetime('end')
+        start_dt = datetime.strptime(start, '%Y-%m-%d %H:%M:%S') if start else datetime.now().replace(microsecond=0)
+        end_dt = datetime.strptime(end, '%Y-%m-%d %H:%M:%S') if end else None
+        if end_dt is not None and end_dt <= start_dt:
+            return jsonify({'error': 'end must be after start'}), 400
+        
+        conn = get_db_connection()
+        row = conn.execute('SELECT capacity FROM rooms WHERE room = ?', (room,)).fetchone()
+        conn.close()
+        
+        if end_dt is None:
+            reservations = reservation_index.booked_at(room, start_dt)
+            peak = len(reservations)
+        else:
+            reservations = reservation_index.overlapping(room, start_dt, end_dt)
+            peak = reservation_index.peak(room, start_dt, end_dt)
         
-        return jsonify({'rooms': rooms_list})
+        return jsonify({
+            'room': room,
+            'capacity': row['capacity'] if row else None,
+            'start': start_dt.isoformat(),
+            'end': end_dt.isoformat() if end_dt else None,
+            'peak': peak,
+            'reservations': reservations
+        })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/admin/esp32_cache', methods=['GET'])
 @api_login_required
 def get_esp32_cache_updated():
-    """Get current ESP32 cache status with expired_status field"""
+    """Get ESP32 cache status with expired_status field, soonest expiry first.
+
+    Filters: room, status (online = not yet expired, offline = expired),
+    user (RFID UID). Pass next_cursor back as ?cursor=.
+    """
     try:
-        conn = get_db_connection()
-        
-        # Get all cache entries
-        cache_entries = conn.execute('''
-            SELECT ec.*, u.role, r.ip_address, r.status as room_status 
-            FROM esp32_cache ec
-            JOIN rooms r ON ec.room = r.room
-            JOIN users_reg u ON ec.name = u.name
-            ORDER BY ec.room, ec.expires_at
-        ''').fetchall()
+        filters, params = [], []
+        room = request.args.get('room', '').strip()
+        if room:
+            filters.append('ec.room = ?')
+            params.append(room)
+        status = request.args.get('status', '').strip().lower()
+        if status in ('online', 'offline'):
+            filters.append('ec.expires_at >= ?' if status == 'online' else 'ec.expires_at < ?')
+            params.append(datetime.now().replace(microsecond=0).isoformat())
+        elif status:
+            return jsonify({'error': 'status must be online or offline'}), 400
+        user = request.args.get('user', '').strip().upper()
+        if user:
+            filters.append('ec.rfid_uid = ?')
+            params.append(user)
         
-        conn.close()
+        conn = get_db_connection()
+        try:
+            cache_entries, next_cursor = fetch_page(conn, '''
+                SELECT ec.*, u.role, r.ip_address, r.status as room_status 
+                FROM esp32_cache ec
+                JOIN rooms r ON ec.room = r.room
+                JOIN users_reg u ON ec.name = u.name
+            ''', filters, params, [('ec.expires_at', 'expires_at'), ('ec.id', 'id')],
+                page_limit(), request.args.get('cursor'), descending=False)
+        finally:
+            conn.close()
         
         cache_list = []
         for entry in cache_entries:
@@ -1072,28 +4879,31 @@ def get_esp32_cache_updated():
             })
         
         return jsonify({
-            'cache_entries': cache_list
+            'cache_entries': cache_list,
+            'next_cursor': next_cursor
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/admin/access_logs', methods=['GET'])
 def get_access_logs():
-    """Get access logs"""
+    """Get access logs, newest first, one page at a time.
+
+    Filters: room, status (granted/denied), user (RFID UID), since/until
+    (UTC). Pass next_cursor back as ?cursor=. Archived months are included.
+    """
     try:
-        limit = request.args.get('limit', 100, type=int)
+        filters, params, since, until = access_log_filters()
         
-        conn = get_db_connection()
-        logs = conn.execute('''
+        logs, next_cursor = access_log_archive.fetch_page('''
             SELECT al.*, u.name, u.role 
-            FROM access_logs al
+            FROM {access_logs} al
             LEFT JOIN users_reg u ON al.rfid_uid = u.uuid
-            ORDER BY al.timestamp DESC
-            LIMIT ?
-        ''', (limit,)).fetchall()
-        conn.close()
+        ''', filters, params, page_limit(), request.args.get('cursor'), since, until)
         
         logs_list = []
         for log in logs:
@@ -1109,59 +4919,23 @@ def get_access_logs():
                 'user_role': log['role']
             })
         
-        return jsonify({'logs': logs_list})
+        return jsonify({'logs': logs_list, 'next_cursor': next_cursor})
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def compute_admin_stats():
+    """Compute dashboard statistics (read from the incrementally kept counters)"""
+    return stats_counters.snapshot()
+
 @app.route('/api/admin/stats', methods=['GET'])
 @api_login_required
 def get_admin_stats():
     """Get dashboard statistics"""
     try:
-        conn = get_db_connection()
-        
-        # Total users by role
-        stats = {}
-        roles = conn.execute('''
-            SELECT role, COUNT(*) as count 
-            FROM users_reg 
-            GROUP BY role
-        ''').fetchall()
-        
-        for role in roles:
-            stats[f'total_{role["role"]}s'] = role['count']
-        
-        # Total requests
-        stats['total_requests'] = conn.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
-        
-        # Approved requests
-        stats['approved_requests'] = conn.execute('SELECT COUNT(*) FROM requests WHERE access = TRUE').fetchone()[0]
-        
-        # Pending requests
-        stats['pending_requests'] = conn.execute('SELECT COUNT(*) FROM requests WHERE access = FALSE AND approved_by IS NULL').fetchone()[0]
-        
-        # Total rooms
-        stats['total_rooms'] = conn.execute('SELECT COUNT(*) FROM rooms').fetchone()[0]
-        
-        # Online rooms
-        stats['online_rooms'] = conn.execute('SELECT COUNT(*) FROM rooms WHERE status = "online"').fetchone()[0]
-        
-        # Today's access attempts
-        stats['today_access_attempts'] = conn.execute('''
-            SELECT COUNT(*) FROM access_logs 
-            WHERE date(timestamp) = date('now')
-        ''').fetchone()[0]
-        
-        # Current active cache entries
-        stats['active_cache_entries'] = conn.execute('''
-            SELECT COUNT(*) FROM esp32_cache 
-            WHERE datetime(expires_at) >= datetime('now')
-        ''').fetchone()[0]
-        
-        conn.close()
-        
-        return jsonify(stats)
+        return jsonify(compute_admin_stats())
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1187,6 +4961,10 @@ def clear_all_requests():
         conn.commit()
         conn.close()
 
+        auth_index.build()
+        stats_counters.reconcile()
+        dashboard_notifier.resync('requests')
+
         return jsonify({
             'success': True,
             'message': f'Succesfully cleared {request_count} room access requests',
@@ -1226,6 +5004,8 @@ def clear_esp32_cache():
         
         conn.commit()
         conn.close()
+        stats_counters.reconcile()
+        dashboard_notifier.resync('cache')
         
         # Optionally, you might want to notify all ESP32 devices to refresh their cache
         # This could be done through a separate notification system or websockets
@@ -1321,10 +5101,11 @@ def get_esp32_cache_with_status_update():
 def manual_cleanup_cache():
     """Manually trigger cache cleanup"""
     try:
-        cleanup_expired_cache_entries()
+        report = cleanup_expired_cache_entries()
         return jsonify({
             'success': True,
-            'message': 'Cache cleanup completed successfully'
+            'message': 'Cache cleanup completed successfully',
+            'rooms': report
         })
     except Exception as e:
         return jsonify({
@@ -1332,6 +5113,411 @@ def manual_cleanup_cache():
             'message': f'Cache cleanup failed: {str(e)}'
         }), 500
 
+@app.route('/api/admin/prewarm_cache', methods=['POST'])
+@api_login_required
+def manual_prewarm_cache():
+    """Manually push upcoming reservations to door caches"""
+    try:
+        report = prewarm_door_caches()
+        return jsonify({
+            'success': True,
+            'message': 'Cache pre-warm completed successfully',
+            'rooms': report
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Cache pre-warm failed: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/db_pool', methods=['GET'])
+@api_login_required
+def get_db_pool_stats():
+    """Get database connection pool counters"""
+    return jsonify(db_pool.stats())
+
+def _queue_depths():
+    yield ('access_log_writer',), access_log_writer.queue_depth()
+    yield ('cache_expiry',), expiry_scheduler.pending()
+    yield ('dashboard_push',), dashboard_notifier.pending()
+    # Submitted device calls still waiting for a fan-out worker
+    yield ('esp32_fanout',), esp32_executor.waiting()
+
+def _room_counts():
+    stats = stats_counters.snapshot()
+    yield ('online',), stats['online_rooms']
+    yield ('offline',), stats['total_rooms'] - stats['online_rooms']
+
+metrics.gauge('nacs_queue_depth', 'Items waiting in an asynchronous queue', ('queue',), _queue_depths)
+metrics.gauge('nacs_rooms', 'Registered rooms by device status', ('status',), _room_counts)
+metrics.gauge('nacs_cache_entries_active', 'Unexpired esp32_cache entries per room', ('room',),
+              lambda: (((room,), count) for room, count in stats_counters.active_cache_by_room().items()))
+metrics.gauge('nacs_requests_pending', 'Requests waiting for an admin decision', ('kind',),
+              lambda: (((kind,), stats_counters.snapshot()[f'pending_{kind}'])
+                       for kind in ('requests', 'recurring_requests')))
+metrics.gauge('nacs_db_connections', 'Pooled database connections by state', ('state',),
+              lambda: (((state,), db_pool.stats()[state]) for state in ('in_use', 'idle')))
+
+def metrics_auth_required(f):
+    """Accept the scraper's bearer token (NACS_METRICS_TOKEN) or an admin session"""
+    session_required = api_login_required(f)
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        supplied = request.headers.get('Authorization', '').encode()
+        if METRICS_TOKEN and hmac.compare_digest(supplied, f'Bearer {METRICS_TOKEN}'.encode()):
+            return f(*args, **kwargs)
+        return session_required(*args, **kwargs)
+    return decorated_function
+
+@app.route('/metrics', methods=['GET'])
+@metrics_auth_required
+def prometheus_metrics():
+    """Metrics in the Prometheus text exposition format (for scraping)"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/admin/db_queries', methods=['GET', 'DELETE'])
+@api_login_required
+def get_query_stats():
+    """Top statements by total time (?limit=, ?order=total|mean|max|count).
+
+    Fingerprints without a captured plan get one here, so frequent full
+    scans show up even when no single run was slow. DELETE resets the stats.
+    """
+    if request.method == 'DELETE':
+        query_tracer.reset()
+        return jsonify({'success': True, 'message': 'Query statistics reset'})
+
+    limit = max(1, min(request.args.get('limit', 20, type=int), PAGE_SIZE_MAX))
+    order = request.args.get('order', 'total').strip().lower()
+    queries = []
+    conn = get_db_connection()
+    try:
+        for fingerprint, stats in query_tracer.top(limit, order):
+            plan = query_tracer.plan(conn, fingerprint)
+            queries.append({
+                'fingerprint': fingerprint,
+                'count': stats['count'],
+                'total_ms': round(stats['total'] * 1000, 3),
+                'mean_ms': round(stats['total'] / stats['count'] * 1000, 3),
+                'max_ms': round(stats['max'] * 1000, 3),
+                'slow_count': stats['slow'],
+                'plan': plan,
+                'full_scan': is_full_scan(plan or [])
+            })
+    finally:
+        conn.close()
+    return jsonify({
+        'since': query_tracer.since.isoformat(timespec='seconds'),
+        'slow_threshold_ms': QUERY_SLOW_MS,
+        'queries': queries
+    })
+
+@app.route('/api/admin/access_trace', methods=['GET'])
+@api_login_required
+def get_access_trace():
+    """Recent check_access decisions, newest first.
+
+    Filters: room, rfid_uid, decision (granted/denied/unknown), after (only
+    decisions with a higher seq, for polling), limit.
+    """
+    decision = request.args.get('decision', '').strip().lower()
+    if decision and decision not in ('granted', 'denied', 'unknown'):
+        return jsonify({'success': False, 'error': 'decision must be granted, denied or unknown'}), 400
+    return jsonify({
+        'decisions': access_trace.query(
+            room=request.args.get('room', '').strip(),
+            rfid_uid=request.args.get('rfid_uid', '').strip().upper(),
+            decision=decision,
+            after=request.args.get('after', 0, type=int),
+            limit=page_limit()
+        ),
+        'diagnostics': access_trace.targets()
+    })
+
+@app.route('/api/admin/access_trace/diagnostics', methods=['GET', 'POST', 'DELETE'])
+@api_login_required
+def manage_access_diagnostics():
+    """List, enable or disable extra check_access diagnostics for a room or card.
+
+    POST/DELETE take {"room": ...} or {"rfid_uid": ...}; POST accepts
+    "minutes" (default DIAGNOSTICS_DEFAULT_MINUTES). DELETE with neither
+    turns every diagnostic off.
+    """
+    if request.method == 'GET':
+        return jsonify({'diagnostics': access_trace.targets()})
+
+    data = request.get_json(silent=True) or {}
+    room = str(data.get('room') or '').strip()
+    rfid_uid = str(data.get('rfid_uid') or '').strip().upper()
+    if room and rfid_uid:
+        return jsonify({'success': False, 'error': 'Give either room or rfid_uid, not both'}), 400
+    kind, value = ('room', room) if room else ('card', rfid_uid) if rfid_uid else (None, None)
+
+    if request.method == 'DELETE':
+        access_trace.disable(kind, value)
+        return jsonify({'success': True, 'diagnostics': access_trace.targets()})
+
+    if kind is None:
+        return jsonify({'success': False, 'error': 'room or rfid_uid is required'}), 400
+    minutes = data.get('minutes', DIAGNOSTICS_DEFAULT_MINUTES)
+    if not isinstance(minutes, (int, float)) or isinstance(minutes, bool) or not 1 <= minutes <= 24 * 60:
+        return jsonify({'success': False, 'error': 'minutes must be between 1 and 1440'}), 400
+    access_trace.enable(kind, value, minutes)
+    logger.info(f"🔎 check_access diagnostics enabled for {kind} {value} ({minutes} min)")
+    return jsonify({'success': True, 'diagnostics': access_trace.targets()})
+
+@app.route('/api/admin/access_logs/partitions', methods=['GET'])
+@api_login_required
+def get_access_log_partitions():
+    """List archived access log months and the current hot window"""
+    return jsonify({
+        'hot_since': access_log_archive.cutoff(),
+        'archives': access_log_archive.describe()
+    })
+
+# Streaming exports
+
+EXPORT_DATASETS = {
+    'access_logs': ['id', 'timestamp', 'room', 'rfid_uid', 'user_name', 'access_granted',
+                    'access_type', 'notes', 'device_id', 'device_seq'],
+    'requests': ['id', 'timestamp', 'uid', 'name', 'room', 'start_time', 'end_time',
+                 'status', 'approved_by', 'approved_at'],
+    'users': ['id', 'uuid', 'user_id', 'first_name', 'last_name', 'name', 'email', 'role',
+              'is_deleted', 'created_at', 'updated_at'],
+}
+
+def stream_export(rows, columns, fmt):
+    """Serialize rows (in column order) as CSV or NDJSON, one chunk per batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+
+    for count, row in enumerate(rows, 1):
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+            buffer.write('\n')
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route('/api/admin/export/<dataset>', methods=['GET'])
+@api_login_required
+def export_dataset(dataset):
+    """Stream access_logs, requests or users as CSV (default) or NDJSON (?format=ndjson).
+
+    Accepts the same filters as the matching list endpoint and streams the
+    result oldest first without loading it into memory.
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({'error': f'Unknown dataset, expected one of {", ".join(EXPORT_DATASETS)}'}), 404
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+
+    try:
+        if dataset == 'access_logs':
+            filters, params, since, until = access_log_filters()
+            rows = access_log_archive.iter_rows('''
+                SELECT al.id, al.timestamp, al.room, al.rfid_uid,
+                       (SELECT u.name FROM users_reg u WHERE u.uuid = al.rfid_uid
+                        ORDER BY u.is_deleted LIMIT 1) AS user_name,
+                       al.access_granted, al.access_type, al.notes, al.device_id, al.device_seq
+                FROM {access_logs} al
+            ''', filters, params, since, until)
+        elif dataset == 'requests':
+            filters, params = request_list_filters()
+            rows = iter_query('''
+                SELECT r.id, r.timestamp, r.uid, r.name, r.room, r.start_time, r.end_time,
+                       CASE WHEN r.access THEN 'approved'
+                            WHEN r.approved_by IS NULL THEN 'pending'
+                            ELSE 'denied' END AS status,
+                       r.approved_by, r.approved_at
+                FROM requests r
+            ''', filters, params, 'r.timestamp, r.id')
+        else:
+            filters, params = user_list_filters()
+            rows = iter_query('''
+                SELECT id, uuid, user_id, first_name, last_name, name, email, role,
+                       is_deleted, created_at, updated_at
+                FROM users_reg
+            ''', filters, params, 'created_at, id')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filename = f"{dataset}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return Response(
+        stream_export(rows, EXPORT_DATASETS[dataset], fmt),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+# Analytics over the access rollups (vectorized with NumPy)
+
+ANALYTICS_METRICS = ('attempts', 'granted', 'denied')
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def analytics_window():
+    """Read since/until (UTC, default the last ANALYTICS_DEFAULT_DAYS days) and room filters"""
+    until = parse_filter_datetime('until') or utc_timestamp()
+    since = parse_filter_datetime('since') or (
+        datetime.strptime(until, '%Y-%m-%d %H:%M:%S') - timedelta(days=ANALYTICS_DEFAULT_DAYS)
+    ).strftime('%Y-%m-%d %H:%M:%S')
+    rooms = [room.strip() for room in request.args.get('room', '').split(',') if room.strip()]
+    return since, until, rooms
+
+def load_hourly_rollups(since, until, rooms, metric):
+    """Return (hours as datetime64[h], room names, room index per row, weights)"""
+    sql = 'SELECT hour, room, access_granted, attempts FROM access_rollups_hourly WHERE hour >= ? AND hour < ?'
+    params = [since[:13] + ':00:00', until]
+    if rooms:
+        sql += f" AND room IN ({', '.join('?' for _ in rooms)})"
+        params.extend(rooms)
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    hours = np.array([row[0] for row in rows], dtype='datetime64[h]')
+    names, room_index = np.unique(np.array([row[1] for row in rows], dtype=str), return_inverse=True)
+    granted = np.array([bool(row[2]) for row in rows], dtype=bool)
+    weights = np.array([row[3] for row in rows], dtype=np.int64)
+    if metric == 'granted':
+        weights = weights * granted
+    elif metric == 'denied':
+        weights = weights * ~granted
+    return hours, names, room_index, weights
+
+@app.route('/api/admin/analytics/heatmap', methods=['GET'])
+@api_login_required
+def get_access_heatmap():
+    """Hour-of-day heatmap of access attempts per room (by=room) or weekday (by=weekday).
+
+    metric: attempts, granted or denied. utc_offset (minutes) shifts the
+    hours into local time.
+    """
+    if np is None:
+        return jsonify({'error': 'Analytics needs NumPy (pip install numpy)', 'success': False}), 503
+    try:
+        by = request.args.get('by', 'room')
+        metric = request.args.get('metric', 'attempts')
+        if by not in ('room', 'weekday') or metric not in ANALYTICS_METRICS:
+            return jsonify({'error': 'by must be room or weekday and metric one of ' + ', '.join(ANALYTICS_METRICS)}), 400
+        offset = round(request.args.get('utc_offset', 0, type=int) / 60)
+        since, until, rooms = analytics_window()
+
+        hours, names, room_index, weights = load_hourly_rollups(since, until, rooms, metric)
+        hours = hours + np.timedelta64(offset, 'h')
+        days = hours.astype('datetime64[D]')
+        hour_of_day = (hours - days).astype(np.int64)
+
+        if by == 'room':
+            labels, row_index = names.tolist(), room_index
+        else:
+            # 1970-01-01 was a Thursday
+            labels, row_index = WEEKDAYS, (days.astype(np.int64) + 3) % 7
+        matrix = np.zeros((len(labels), 24), dtype=np.int64)
+        np.add.at(matrix, (row_index, hour_of_day), weights)
+
+        return jsonify({
+            'by': by,
+            'metric': metric,
+            'since': since,
+            'until': until,
+            'utc_offset_hours': offset,
+            'rows': labels,
+            'columns': list(range(24)),
+            'matrix': matrix.tolist(),
+            'totals': matrix.sum(axis=1).tolist()
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/analytics/timeseries', methods=['GET'])
+@api_login_required
+def get_access_timeseries():
+    """Per-room time series of access attempts (bucket=hour or day, UTC).
+
+    metric: attempts, granted, denied, or users (estimated distinct users,
+    day buckets only; totals are the distinct users over the whole window).
+    """
+    if np is None:
+        return jsonify({'error': 'Analytics needs NumPy (pip install numpy)', 'success': False}), 503
+    try:
+        bucket = request.args.get('bucket', 'day')
+        metric = request.args.get('metric', 'attempts')
+        if bucket not in ('hour', 'day') or metric not in ANALYTICS_METRICS + ('users',):
+            return jsonify({'error': 'bucket must be hour or day and metric one of attempts, granted, denied, users'}), 400
+        if metric == 'users' and bucket != 'day':
+            return jsonify({'error': 'metric=users needs bucket=day'}), 400
+        since, until, rooms = analytics_window()
+
+        unit = 'h' if bucket == 'hour' else 'D'
+        start = np.datetime64(since.replace(' ', 'T'), unit)
+        end = np.datetime64(until.replace(' ', 'T'), unit) + np.timedelta64(1, unit)
+        buckets = np.arange(start, end)
+
+        if metric == 'users':
+            sql = 'SELECT day, room, sketch FROM access_rollups_users_daily WHERE day >= ? AND day <= ?'
+            params = [since[:10], until[:10]]
+            if rooms:
+                sql += f" AND room IN ({', '.join('?' for _ in rooms)})"
+                params.extend(rooms)
+            conn = get_db_connection()
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+
+            names, room_index = np.unique(np.array([row[1] for row in rows], dtype=str), return_inverse=True)
+            column = (np.array([row[0] for row in rows], dtype='datetime64[D]') - start).astype(np.int64)
+            registers = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.uint8).reshape(len(rows), 1 << HLL_PRECISION)
+
+            matrix = np.zeros((len(names), len(buckets)), dtype=np.int64)
+            matrix[room_index, column] = np.rint(hll_estimate(registers)).astype(np.int64)
+            # Sketches merge by register-wise max, giving distinct users over the window
+            merged = np.zeros((len(names), 1 << HLL_PRECISION), dtype=np.uint8)
+            np.maximum.at(merged, room_index, registers)
+            totals = np.rint(hll_estimate(merged)).astype(np.int64) if len(names) else np.zeros(0, dtype=np.int64)
+        else:
+            hours, names, room_index, weights = load_hourly_rollups(since, until, rooms, metric)
+            column = (hours.astype(f'datetime64[{unit}]') - start).astype(np.int64)
+            matrix = np.zeros((len(names), len(buckets)), dtype=np.int64)
+            np.add.at(matrix, (room_index, column), weights)
+            totals = matrix.sum(axis=1)
+
+        return jsonify({
+            'bucket': bucket,
+            'metric': metric,
+            'since': since,
+            'until': until,
+            'buckets': [str(value) for value in buckets],
+            'rooms': names.tolist(),
+            'matrix': matrix.tolist(),
+            'totals': totals.tolist()
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/access_logs/archive', methods=['POST'])
+@api_login_required
+def archive_access_logs():
+    """Move access log months past the hot window into compressed archives now"""
+    try:
+        moved = access_log_archive.archive_due()
+        return jsonify({'success': True, 'archived': moved})
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
 # Authentication routes
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
@@ -1386,35 +5572,344 @@ def admin_root():
     return redirect(url_for('admin_login'))
 
 
+# ================== BULK USER IMPORT ==================
+
+USER_IMPORT_FIELDS = ('uuid', 'user_id', 'first_name', 'last_name', 'email', 'role')
+
+def parse_user_import(payload, is_csv):
+    """Turn an uploaded CSV (text) or JSON (list, or {'users': [...]}) into row dicts"""
+    if is_csv:
+        reader = csv.DictReader(io.StringIO(payload.lstrip('\ufeff')))
+        records = [{(key or '').strip().lower(): value for key, value in row.items()} for row in reader]
+    else:
+        records = payload.get('users') if isinstance(payload, dict) else payload
+        if not isinstance(records, list) or not all(isinstance(row, dict) for row in records):
+            raise ValueError('Expected a JSON list of users or {"users": [...]}')
+    if len(records) > USER_IMPORT_MAX_ROWS:
+        raise ValueError(f'At most {USER_IMPORT_MAX_ROWS} users per import')
+    return records
+
+def find_import_conflicts(conn, rows):
+    """(row number, field) for rows whose uuid, user_id or email is already active in users_reg"""
+    # NOCASE columns make the joins match the file's own case-insensitive
+    # duplicate check (and uuids enrolled in lower case); users_reg is then
+    # scanned once per key against the indexed import rows
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS user_import (
+            row INTEGER PRIMARY KEY,
+            uuid TEXT COLLATE NOCASE,
+            user_id TEXT COLLATE NOCASE,
+            email TEXT COLLATE NOCASE
+        )
+    ''')
+    for field in ('uuid', 'user_id', 'email'):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS temp.idx_user_import_{field} ON user_import({field})')
+    conn.execute('DELETE FROM temp.user_import')
+    conn.executemany('INSERT INTO temp.user_import (row, uuid, user_id, email) VALUES (?, ?, ?, ?)',
+                     [(number, row['uuid'], row['user_id'], row['email']) for number, row in rows])
+    conflicts = conn.execute('''
+        SELECT i.row, 'uuid' FROM temp.user_import i
+        JOIN users_reg u ON i.uuid = u.uuid AND u.is_deleted = 0
+        UNION
+        SELECT i.row, 'user_id' FROM temp.user_import i
+        JOIN users_reg u ON i.user_id = u.user_id AND u.is_deleted = 0
+        UNION
+        SELECT i.row, 'email' FROM temp.user_import i
+        JOIN users_reg u ON i.email = u.email AND u.is_deleted = 0
+    ''').fetchall()
+    conn.execute('DELETE FROM temp.user_import')
+    return conflicts
+
+def import_users(records, dry_run=False):
+    """Validate and insert users in bulk, returning a per-row report"""
+    report = []
+    valid = []
+    first_seen = {}
+    inserted = 0
+
+    for number, record in enumerate(records, 1):
+        row = {field: str(record.get(field) or '').strip() for field in USER_IMPORT_FIELDS}
+        row['uuid'] = row['uuid'].upper()
+        row['role'] = row['role'].lower() or 'student'
+        errors = [f'{field} is required' for field in USER_IMPORT_FIELDS[:5] if not row[field]]
+        if row['email'] and ('@' not in row['email'] or '.' not in row['email']):
+            errors.append('invalid email')
+        if row['role'] not in ('student', 'admin'):
+            errors.append('invalid role')
+        for field in ('uuid', 'user_id', 'email'):
+            key = (field, row[field].lower())
+            if row[field] and key in first_seen:
+                errors.append(f'duplicate {field} (same as row {first_seen[key]})')
+            elif row[field]:
+                first_seen[key] = number
+
+        report.append({'row': number, 'uuid': row['uuid'], 'user_id': row['user_id'],
+                       'status': 'invalid' if errors else 'valid', 'errors': errors})
+        if not errors:
+            valid.append((number, row))
+
+    def reject_conflicts(rows):
+        conflicts = find_import_conflicts(conn, rows)
+        for number, field in conflicts:
+            entry = report[number - 1]
+            entry['status'] = 'invalid'
+            entry['errors'].append(f'{field} already exists')
+        rejected = {number for number, _ in conflicts}
+        return [(number, row) for number, row in rows if number not in rejected]
+
+    conn = get_db_connection()
+    try:
+        if dry_run:
+            if valid:
+                reject_conflicts(valid)
+                conn.commit()
+        else:
+            for start in range(0, len(valid), USER_IMPORT_CHUNK_SIZE):
+                # Check and insert in one write transaction, so a user added
+                # concurrently cannot slip in between
+                conn.execute('BEGIN IMMEDIATE')
+                chunk = reject_conflicts(valid[start:start + USER_IMPORT_CHUNK_SIZE])
+                conn.executemany('''
+                    INSERT INTO users_reg (uuid, user_id, first_name, last_name, name, email, role)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(row['uuid'], row['user_id'], row['first_name'], row['last_name'],
+                       f"{row['first_name']} {row['last_name']}", row['email'], row['role'])
+                      for _, row in chunk])
+                conn.commit()
+                inserted += len(chunk)
+                for number, _ in chunk:
+                    report[number - 1]['status'] = 'inserted'
+
+                # Refresh per committed chunk so a later failure leaves no
+                # committed user invisible to check_access
+                auth_index.refresh_user(*(row['uuid'] for _, row in chunk))
+                for role in {row['role'] for _, row in chunk}:
+                    stats_counters.adjust_role(role, sum(1 for _, row in chunk if row['role'] == role))
+    finally:
+        conn.close()
+
+    invalid = sum(1 for entry in report if entry['status'] == 'invalid')
+    return {
+        'dry_run': dry_run,
+        'total': len(report),
+        'valid': len(report) - invalid,
+        'invalid': invalid,
+        'inserted': inserted,
+        'rows': report
+    }
+
+@app.route('/api/admin/users/import', methods=['POST'])
+@api_login_required
+def import_users_route():
+    """Bulk-enroll users from a CSV upload (file field or text/csv body) or a JSON list.
+
+    ?dry_run=1 validates without inserting.
+    """
+    try:
+        dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+        upload = request.files.get('file')
+        if upload:
+            payload = upload.read().decode('utf-8')
+            is_csv = not upload.filename.lower().endswith('.json')
+            if not is_csv:
+                payload = json.loads(payload)
+        elif request.is_json:
+            payload, is_csv = request.get_json(), False
+        else:
+            payload, is_csv = request.get_data(as_text=True), True
+
+        report = import_users(parse_user_import(payload, is_csv), dry_run)
+        report['success'] = report['invalid'] == 0
+        return jsonify(report)
+
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': str(e), 'success': False}), 400
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 500
+
+@app.cli.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Validate only, do not insert.')
+def import_users_command(path, dry_run):
+    """Bulk-enroll users from a CSV or JSON file."""
+    init_database()
+    with open(path, encoding='utf-8') as file:
+        if path.lower().endswith('.json'):
+            records = parse_user_import(json.load(file), False)
+        else:
+            records = parse_user_import(file.read(), True)
+
+    report = import_users(records, dry_run)
+    for entry in report['rows']:
+        if entry['errors']:
+            click.echo(f"❌ row {entry['row']} ({entry['uuid'] or '-'}): {'; '.join(entry['errors'])}")
+    verb = 'would insert' if dry_run else 'inserted'
+    click.echo(f"✅ {report['total']} rows: {report['valid']} valid, {report['invalid']} invalid, "
+               f"{verb} {report['valid'] if dry_run else report['inserted']}")
+    if report['inserted']:
+        click.echo(f"ℹ️ A running server picks up the new users within {USER_SYNC_INTERVAL} seconds")
+
+
 # ================== REGISTER RFID API ENDPOINTS ==================
 
 CORS(app)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
-DB_PATH = os.path.join(os.path.dirname(__file__), 'database.db')
-DB_PATH = os.path.abspath(DB_PATH)
+# ================== DASHBOARD PUSH ==================
+
+class DashboardNotifier:
+    """Coalesced, rate-limited Socket.IO pushes to logged-in admin dashboards"""
+
+    def __init__(self, interval=DASHBOARD_PUSH_INTERVAL, max_events=DASHBOARD_MAX_EVENTS):
+        self.interval = interval
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._resync = set()
+        self._wake = threading.Event()
+        self._admins = 0
+        self._thread = None
+
+    def admin_connected(self):
+        with self._lock:
+            self._admins += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='dashboard-push', daemon=True)
+                self._thread.start()
+
+    def admin_disconnected(self):
+        with self._lock:
+            self._admins = max(0, self._admins - 1)
+
+    @property
+    def listening(self):
+        return self._admins > 0
+
+    def pending(self):
+        """Events buffered for the next push"""
+        with self._lock:
+            return sum(len(events) for events in self._pending.values())
+
+    def resync(self, kind):
+        """Tell dashboards to reload a whole table (after bulk changes)"""
+        if not self._admins:
+            return
+        with self._lock:
+            self._resync.add(kind)
+        self._wake.set()
+
+    def publish(self, kind, payload):
+        """Queue one event for the next push"""
+        if not self._admins:
+            return
+        with self._lock:
+            events = self._pending.setdefault(kind, [])
+            if len(events) < self.max_events:
+                events.append(payload)
+            else:
+                self._resync.add(kind)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # Let a burst accumulate so it goes out as a single message
+            time.sleep(self.interval)
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                resync, self._resync = self._resync, set()
+                admins = self._admins
+            if not admins:
+                continue
+
+            update = {
+                'events': {kind: events for kind, events in pending.items() if kind not in resync},
+                'resync': sorted(resync)
+            }
+            try:
+                update['stats'] = compute_admin_stats()
+            except Exception as e:
+                logger.error(f"❌ Failed to compute stats for dashboard push: {str(e)}")
+            socketio.emit('dashboard_update', update, to=DASHBOARD_ROOM)
+
+dashboard_notifier = DashboardNotifier()
+
+def publish_request_update(request_id):
+    """Push the current state of one request row to admin dashboards"""
+    if not dashboard_notifier.listening:
+        return
+    conn = get_db_connection()
+    try:
+        req = conn.execute('''
+            SELECT r.*, u.name, u.role 
+            FROM requests r
+            JOIN users_reg u ON r.uid = u.uuid
+            WHERE r.id = ?
+        ''', (request_id,)).fetchone()
+    finally:
+        conn.close()
+    if req:
+        dashboard_notifier.publish('requests', {
+            'id': req['id'],
+            'uid': req['uid'],
+            'name': req['name'],
+            'role': req['role'],
+            'start_time': req['start_time'],
+            'end_time': req['end_time'],
+            'access': bool(req['access']),
+            'room': req['room'],
+            'timestamp': req['timestamp'],
+            'approved_by': req['approved_by'],
+            'approved_at': req['approved_at']
+        })
+
+def publish_recurring_update(rule_id):
+    """Push the current state of one recurring rule to admin dashboards"""
+    if not dashboard_notifier.listening:
+        return
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM recurring_requests WHERE id = ?', (rule_id,)).fetchone()
+    finally:
+        conn.close()
+    if row:
+        dashboard_notifier.publish('recurring', recurring_request_json(row))
+
+@socketio.on('connect')
+def handle_socket_connect():
+    """Admin dashboards join the admins room; other pages are left alone"""
+    if 'admin_user' in session:
+        join_room(DASHBOARD_ROOM)
+        session['dashboard_socket'] = True
+        dashboard_notifier.admin_connected()
+
+@socketio.on('disconnect')
+def handle_socket_disconnect():
+    if session.get('dashboard_socket'):
+        dashboard_notifier.admin_disconnected()
 
 PHOTO_DIR = "photos"
 
 latest_uuid = None
 
-def get_users() :
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def get_users(limit=PAGE_SIZE_DEFAULT, cursor=None) :
+    """Return one page of active users (newest first) and the next-page cursor"""
+    conn = get_db_connection()
     try : 
-        cursor.execute('SELECT * from users_reg WHERE is_deleted = 0 ORDER BY created_at DESC')
-        users = cursor.fetchall()
-        cursor.close()
-        return users
+        return fetch_page(conn, 'SELECT * from users_reg', ['is_deleted = 0'], [],
+                          [('created_at', 'created_at'), ('id', 'id')], limit, cursor)
     except sqlite3.Error as e:
         print(f"Database error in get_users: {e}")
-        return []
+        return [], None
+    finally :
+        conn.close()
 
 def get_user_by_uuid(uuid):
     if not uuid:
         return None
         
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('''
@@ -1450,7 +5945,7 @@ def add_user(uuid , user_id, first_name, last_name, email, role='student') :
     if '@' not in email or '.' not in email:
         return {"success": False, "message": "รูปแบบ email ไม่ถูกต้อง"}
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('''
@@ -1482,16 +5977,8 @@ def add_user(uuid , user_id, first_name, last_name, email, role='student') :
 
         conn.commit()
         user_id_created = cursor.lastrowid
-        
-        csv_path = os.path.join(os.path.dirname(__file__), '..', 'database')
-        # csv_path = os.path.abspath(csv_path)
-        # file_exists = os.path.isfile(csv_path)
-
-        # with open(csv_path, mode='a', newline='', encoding='utf-8') as file:
-        #     writer = csv.writer(file)
-        #     if not file_exists:
-        #         writer.writerow(['uuid', 'user_id', 'first_name', 'last_name', 'name', 'email', 'role'])
-        #         writer.writerow([uuid, user_id, first_name, last_name, f"{first_name} {last_name}", email, role])
+        auth_index.refresh_user(uuid)
+        stats_counters.adjust_role(role, 1)
         
         return {
             "success": True, 
@@ -1503,6 +5990,8 @@ def add_user(uuid , user_id, first_name, last_name, email, role='student') :
         return {"success": False, "message": f"ข้อมูลซ้ำกัน: {str(e)}"}
     except sqlite3.Error as e:
         return {"success": False, "message": f"เกิดข้อผิดพลาดในฐานข้อมูล: {str(e)}"}
+    finally :
+        conn.close()
 
 def delete_user(id) :
     conn = get_db_connection()
@@ -1510,10 +5999,16 @@ def delete_user(id) :
 
 
     try:
-        cursor.execute('''UPDATE users_reg SET is_deleted = 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?''', (id,))
+        cursor.execute('BEGIN IMMEDIATE')
+        roles = [row['role'] for row in conn.execute(
+            'SELECT role FROM users_reg WHERE user_id = ? AND is_deleted = 0', (id,))]
+        cursor.execute('''UPDATE users_reg SET is_deleted = 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = ? AND is_deleted = 0''', (id,))
         conn.commit()
 
-        print(cursor.rowcount)
+        deleted_uuids = [row['uuid'] for row in conn.execute('SELECT uuid FROM users_reg WHERE user_id = ?', (id,))]
+        auth_index.refresh_user(*deleted_uuids)
+        for role in set(roles):
+            stats_counters.adjust_role(role, -roles.count(role))
         
         if cursor.rowcount > 0:
             return {"success": True, "message": "ลบผู้ใช้สำเร็จ"}
@@ -1527,7 +6022,7 @@ def delete_user(id) :
         
 # ✅ Use this for "create user"
 def check_is_user_id_exist(user_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT 1 FROM users_reg WHERE user_id = ? AND is_deleted  = 0 LIMIT 1', (user_id,))
@@ -1542,7 +6037,7 @@ def check_is_user_id_exist(user_id):
 
 # ✅ Use this for "update user"
 def check_is_user_id_exist_except_id(user_id, current_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
@@ -1560,8 +6055,7 @@ def check_is_user_id_exist_except_id(user_id, current_id):
         
 @app.route('/register')
 def index() :
-    users = get_users()
-    return render_template('index.html', users=users)
+    return render_template('index.html')
 
 @app.route('/api/send_uuid', methods=['POST'])
 def get_uuid() :
@@ -1679,7 +6173,7 @@ def delete_user_route(id) :
 
 @app.route('/api/edit_user/<int:id>', methods=['GET'])
 def edit_user_route(id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT id, uuid, user_id, first_name, last_name, email FROM users_reg WHERE id = ?', (id,))
     user = cursor.fetchone()
@@ -1702,8 +6196,9 @@ def update_user_route(id):
         if is_user_id_exist["success"]:
             return jsonify({'success' : False, 'message' : is_user_id_exist['message']})
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db_connection()
         cursor = conn.cursor()
+        old_user = cursor.execute('SELECT uuid FROM users_reg WHERE id = ?', (id,)).fetchone()
         cursor.execute(
             '''
             UPDATE users_reg 
@@ -1715,6 +6210,8 @@ def update_user_route(id):
         conn.commit()
         conn.close()
         
+        auth_index.refresh_user(uuid, old_user[0] if old_user else None)
+        
         return jsonify({"success": True, "message": "แก้ไขข้อมูล user สำเร็จ"})
     
     except sqlite3.Error as e:
@@ -1724,12 +6221,19 @@ def update_user_route(id):
 
 @app.route('/api/table', methods=['GET'])
 def table_route():
-    users = get_users()
-    return render_template('table.html', users=users)
+    cursor = request.args.get('cursor')
+    try:
+        users, next_cursor = get_users(page_limit(), cursor)
+    except ValueError:
+        return redirect(url_for('table_route'))
+    return render_template('table.html', users=users, next_cursor=next_cursor, is_first_page=not cursor)
     
 if __name__ == '__main__':
     # Initialize database
     init_database()
+    auth_index.build()
+    stats_counters.reconcile()
+    access_log_writer.start()
 
     print("🚀 Starting Room Access Control Server...")
     print("📊 Admin Dashboard: http://localhost:5000/admin")
@@ -1740,4 +6244,5 @@ if __name__ == '__main__':
     background_tasks()
 
     # Run the Flask application
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    # (through Socket.IO so dashboards and the register page get websockets)
+    socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,344 @@
+"""Repeatable micro-benchmarks for the server's hot data paths.
+
+Runs against a database built by synthetic_dataset.py, on a copy so the
+source file stays untouched. It times these paths through the Flask test
+client (or by calling the worker functions directly):
+- check_esp32_access: granted, denied and unknown-card swipes
+- get_admin_stats: the counter snapshot and a full reconcile
+- get_esp32_cache_updated: first page and a filtered page
+- get_all_requests: first page, pending filter, and ten pages deep by cursor
+- the expiry worker: ExpiryScheduler.expire_due over a fresh batch
+- cleanup: cleanup_expired_cache_entries against simulated doors
+- start-up: building the authorization index
+
+Results (latency percentiles and ops/s per benchmark, plus the commit and
+dataset size) are written as JSON. --compare reports the change against
+an earlier result file and exits non-zero when a p50 regressed by more
+than --threshold.
+
+Usage:
+    python benchmark_suite.py --db /tmp/campus.db
+    python benchmark_suite.py --db /tmp/campus.db --compare benchmark_results/abc1234-....json
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# ================== MEASUREMENT ==================
+
+def summarize(samples):
+    """Latency summary (milliseconds) of a list of per-operation seconds"""
+    samples = sorted(samples)
+    n = len(samples)
+
+    def pick(fraction):
+        return round(samples[min(n - 1, max(0, int(round(fraction * n + 0.5)) - 1))] * 1000, 3)
+
+    total = sum(samples)
+    return {
+        'n': n,
+        'mean_ms': round(total / n * 1000, 3),
+        'min_ms': round(samples[0] * 1000, 3),
+        'p50_ms': pick(0.50),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': round(samples[-1] * 1000, 3),
+        'ops_per_s': round(n / total, 1) if total else None
+    }
+
+
+def timed(operation, iterations, setup=None):
+    """Run operation() `iterations` times and return per-call seconds (setup is not timed)"""
+    samples = []
+    for i in range(iterations):
+        if setup:
+            setup(i)
+        started = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ================== BENCHMARKS ==================
+
+class Suite:
+    def __init__(self, app, args, report=sys.stdout):
+        self.app = app
+        self.args = args
+        self.report = report
+        self.rng = random.Random(args.seed)
+        self.client = app.app.test_client()
+        with self.client.session_transaction() as session:
+            session['admin_user'] = 'benchmark'
+            session['login_time'] = datetime.now().isoformat()
+        self.results = {}
+
+    def record(self, name, samples):
+        self.results[name] = summarize(samples)
+        summary = self.results[name]
+        print(f"  {name:<32} p50 {summary['p50_ms']:>9.3f} ms  p95 {summary['p95_ms']:>9.3f} ms  "
+              f"p99 {summary['p99_ms']:>9.3f} ms  {summary['ops_per_s']} ops/s", file=self.report, flush=True)
+
+    def query(self, sql, params=()):
+        conn = self.app.get_db_connection()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def get(self, url, **query):
+        response = self.client.get(url, query_string=query)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {url}: HTTP {response.status_code} {response.get_data(as_text=True)[:200]}')
+        return response
+
+    # ---- device API ----
+
+    def bench_check_access(self):
+        n = self.args.iterations
+        now = datetime.now().replace(microsecond=0).isoformat()
+        granted = [tuple(row) for row in self.query('''
+            SELECT r.uid, r.room FROM requests r
+            JOIN users_reg u ON u.uuid = r.uid AND u.is_deleted = 0
+            WHERE r.access = 1 AND r.start_time <= ? AND r.end_time >= ?
+            LIMIT 1000
+        ''', (now, now))]
+        users = [row[0] for row in self.query('SELECT uuid FROM users_reg WHERE is_deleted = 0 ORDER BY random() LIMIT 1000')]
+        rooms = [row[0] for row in self.query('SELECT room FROM rooms')]
+
+        def swipe(pairs):
+            def run():
+                uid, room = self.rng.choice(pairs)
+                response = self.client.post('/api/esp32/check_access', json={'rfid_uid': uid, 'room': room})
+                if response.status_code != 200:
+                    raise RuntimeError(f'check_access: HTTP {response.status_code}')
+            return run
+
+        if granted:
+            self.record('check_access.granted', timed(swipe(granted), n))
+        else:
+            print('  check_access.granted             skipped (no booking is active now)', file=self.report)
+        self.record('check_access.denied', timed(swipe([(self.rng.choice(users), self.rng.choice(rooms))
+                                                        for _ in range(200)]), n))
+        self.record('check_access.unknown_card', timed(swipe([('%08X' % self.rng.getrandbits(32), self.rng.choice(rooms))
+                                                              for _ in range(200)]), n))
+
+    # ---- admin views ----
+
+    def bench_admin_views(self):
+        n = self.args.iterations
+        busiest = self.query('SELECT room FROM requests GROUP BY room ORDER BY COUNT(*) DESC LIMIT 1')
+        room = busiest[0][0] if busiest else ''
+
+        self.record('admin_stats', timed(lambda: self.get('/api/admin/stats'), n))
+        self.record('admin_stats.reconcile', timed(self.app.stats_counters.reconcile, max(3, n // 50)))
+
+        self.record('esp32_cache.page', timed(lambda: self.get('/api/admin/esp32_cache'), n))
+        self.record('esp32_cache.filtered', timed(lambda: self.get('/api/admin/esp32_cache', status='online', room=room), n))
+
+        self.record('requests.page', timed(lambda: self.get('/api/admin/requests'), n))
+        self.record('requests.pending', timed(lambda: self.get('/api/admin/requests', status='pending'), n))
+        self.record('requests.room', timed(lambda: self.get('/api/admin/requests', room=room), n))
+
+        def deep_pages():
+            query = {}
+            for _ in range(10):
+                query['cursor'] = self.get('/api/admin/requests', **query).get_json().get('next_cursor')
+                if not query['cursor']:
+                    break
+        self.record('requests.ten_pages', timed(deep_pages, max(5, n // 10)))
+
+    # ---- background workers ----
+
+    def _insert_cache_rows(self, count, expires_at, expired_status='online'):
+        rooms = [row[0] for row in self.query("SELECT room FROM rooms WHERE status = 'online'")]
+        # expire_due skips any name an admin also has
+        users = self.query('''
+            SELECT uuid, name FROM users_reg
+            WHERE is_deleted = 0 AND name NOT IN (SELECT name FROM users_reg WHERE role = 'admin')
+            ORDER BY random() LIMIT ?
+        ''', (count,))
+        conn = self.app.get_db_connection()
+        try:
+            conn.executemany('''
+                INSERT OR REPLACE INTO esp32_cache (room, rfid_uid, name, expires_at, expired_status)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(self.rng.choice(rooms), uid, name, expires_at, expired_status) for uid, name in users])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def bench_expiry(self):
+        batch, n = self.args.batch, max(5, self.args.iterations // 20)
+        past = (datetime.now() - timedelta(minutes=1)).replace(microsecond=0).isoformat()
+        expired = []
+        self.record(f'expiry.expire_due_{batch}',
+                    timed(lambda: expired.append(self.app.expiry_scheduler.expire_due()), n,
+                          setup=lambda i: self._insert_cache_rows(batch, past)))
+        if min(expired) < batch:
+            raise RuntimeError(f'expire_due changed only {min(expired)} of {batch} rows')
+
+    def bench_cleanup(self):
+        sys.path.insert(0, HERE)
+        from esp32_fleet_sim import VirtualDoor
+
+        batch, n = self.args.batch, max(5, self.args.iterations // 20)
+        rooms = [row[0] for row in self.query("SELECT room FROM rooms WHERE status = 'online'")]
+        doors = [VirtualDoor(i + 1, room, self.args.base_port + i) for i, room in enumerate(rooms)]
+        conn = self.app.get_db_connection()
+        try:
+            for door in doors:
+                door.serve()
+                conn.execute('UPDATE rooms SET ip_address = ? WHERE room = ?', (door.ip_address, door.room))
+            conn.commit()
+        finally:
+            conn.close()
+
+        past = (datetime.now() - timedelta(minutes=1)).replace(microsecond=0).isoformat()
+        try:
+            self.record(f'cleanup.remove_{batch}',
+                        timed(self.app.cleanup_expired_cache_entries, n,
+                              setup=lambda i: self._insert_cache_rows(batch, past, 'offline')))
+        finally:
+            for door in doors:
+                door.shutdown()
+
+    def run(self):
+        print('🏁 start-up', file=self.report)
+        self.record('startup.auth_index_build', timed(self.app.auth_index.build, 3))
+        print('🚪 device API', file=self.report)
+        self.bench_check_access()
+        print('📊 admin views', file=self.report)
+        self.bench_admin_views()
+        print('⏰ background workers', file=self.report)
+        self.bench_expiry()
+        self.bench_cleanup()
+        return self.results
+
+
+# ================== COMPARISON ==================
+
+def compare(baseline, current, threshold):
+    """Print p50 changes against a baseline; return the names that regressed"""
+    regressed = []
+    print(f"\n📈 against {baseline['meta'].get('commit')} ({baseline['meta'].get('created_at')})")
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if not before:
+            print(f'  {name:<32} new')
+            continue
+        change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] if before['p50_ms'] else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  ⚠️ REGRESSION'
+            regressed.append(name)
+        elif change < -threshold:
+            flag = '  ✅ faster'
+        print(f"  {name:<32} p50 {before['p50_ms']:>9.3f} -> {result['p50_ms']:>9.3f} ms ({change:+.1%}){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server data paths')
+    parser.add_argument('--db', required=True, help='database built by synthetic_dataset.py')
+    parser.add_argument('--out', help='result file (default benchmark_results/<commit>-<time>.json)')
+    parser.add_argument('--iterations', type=int, default=300, help='operations per request-level benchmark')
+    parser.add_argument('--batch', type=int, default=500, help='cache rows per expiry/cleanup round')
+    parser.add_argument('--base-port', type=int, default=18500, help='first port for the simulated doors')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--in-place', action='store_true', help='run on --db itself instead of a copy')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.10, help='p50 slowdown counted as a regression')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.db)
+    if not os.path.exists(source):
+        sys.exit(f'❌ {source} not found (build one with synthetic_dataset.py)')
+
+    workdir = None
+    path = source
+    if not args.in_place:
+        workdir = tempfile.mkdtemp(prefix='nacs-bench-')
+        path = os.path.join(workdir, os.path.basename(source))
+        print(f'📋 copying {source} to {workdir}')
+        with contextlib.closing(sqlite3.connect(source)) as src, contextlib.closing(sqlite3.connect(path)) as dst:
+            src.backup(dst)
+
+    # The server module reads NACS_DATABASE at import time
+    os.environ['NACS_DATABASE'] = path
+    sys.path.insert(0, HERE)
+    import app
+
+    logging.getLogger('app').setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    try:
+        # The endpoints print progress; keep it off the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            app.init_database()
+            app.stats_counters.reconcile()
+            app.access_log_writer.start()
+        suite = Suite(app, args, report=sys.stdout)
+        counts = {table: suite.query(f'SELECT COUNT(*) FROM {table}')[0][0]
+                  for table in ('users_reg', 'rooms', 'requests', 'access_logs', 'esp32_cache')}
+        print(f'🗄️ dataset: {counts}')
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = suite.run()
+        app.access_log_writer.stop()
+    finally:
+        app.db_pool.close_all()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'dataset': counts,
+            'iterations': args.iterations,
+            'batch': args.batch
+        },
+        'results': results
+    }
+    out = args.out or os.path.join(HERE, 'benchmark_results',
+                                   f"{commit or 'nogit'}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'💾 results written to {out}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), report, args.threshold)
+        if regressed:
+            sys.exit(f"❌ {len(regressed)} benchmark(s) regressed: {', '.join(regressed)}")
+
+
+if __name__ == '__main__':
+    main()
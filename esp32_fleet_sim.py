@@ -0,0 +1,519 @@
+"""Simulated ESP32 door-controller fleet for load-testing the device API.
+
+Each virtual door behaves like ESP32/ESP32_RFID_Scanner.ino:
+- it registers through /api/esp32/register
+- it swipes cards through /api/esp32/check_access
+- it keeps users the server marks cache_user in a local table and serves
+  their later swipes without a server round trip
+
+It also serves the firmware's local endpoints (/api/remove_user,
+/api/add_users, /api/status, /api/clear_all) on a localhost port. The
+server's cache cleanup and pre-warm therefore talk to a real HTTP peer.
+
+Usage:
+    python esp32_fleet_sim.py --server http://127.0.0.1:5000 --devices 50 \\
+        --rate 0.5 --duration 60 --arrival poisson --db database.db
+
+Cards are read from users_reg in --db (or given with --cards); a share of
+unknown cards can be mixed in with --unknown-ratio. New SIM-xxx rooms have
+no bookings, so every known card is denied there. Use --rooms to put the
+doors in existing rooms, or --seed-bookings N to have N users per door
+booked and approved (through the admin API) before swiping starts; each
+door then swipes its booked cards. At the end a report is printed with
+swipe latency percentiles, error rate and throughput.
+"""
+
+import argparse
+import json
+import math
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+# ================== VIRTUAL DEVICE ==================
+
+class VirtualDoor:
+    """One simulated door controller with its local cache and HTTP endpoints"""
+
+    def __init__(self, index, room, port, max_users=50):
+        self.index = index
+        self.room = room
+        self.port = port
+        self.mac_address = 'SI:M0:%02X:%02X:%02X:%02X' % (
+            (index >> 24) & 0xFF, (index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        self.max_users = max_users
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._users = {}
+        self.local_calls = {'remove_user': 0, 'add_users': 0, 'status': 0, 'clear_all': 0}
+        self._httpd = None
+
+    @property
+    def ip_address(self):
+        # The server builds device URLs as http://{ip_address}/api/...
+        return f'127.0.0.1:{self.port}'
+
+    # ---- local cache ----
+
+    def add_user(self, uid, name, starts_in_ms=0):
+        with self._lock:
+            if uid not in self._users and len(self._users) >= self.max_users:
+                return False
+            active_from = time.monotonic() + starts_in_ms / 1000.0
+            if uid in self._users and starts_in_ms:
+                active_from = self._users[uid][1]
+            self._users[uid] = (name, active_from)
+            return True
+
+    def remove_user(self, uid):
+        with self._lock:
+            return self._users.pop(uid, None) is not None
+
+    def is_cached(self, uid):
+        with self._lock:
+            entry = self._users.get(uid)
+            return entry is not None and entry[1] <= time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            cleared = len(self._users)
+            self._users.clear()
+            return cleared
+
+    def cached_count(self):
+        with self._lock:
+            return len(self._users)
+
+    # ---- local HTTP server (firmware endpoints) ----
+
+    def serve(self):
+        door = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    return json.loads(self.rfile.read(length) or b'null')
+                except ValueError:
+                    return None
+
+            def do_GET(self):
+                if self.path != '/api/status':
+                    return self._send(404, {'error': 'Not found'})
+                door.local_calls['status'] += 1
+                with door._lock:
+                    users = [{'uid': uid, 'name': name, 'permanent': True}
+                             for uid, (name, _) in door._users.items()]
+                self._send(200, {
+                    'room': door.room,
+                    'ip_address': door.ip_address,
+                    'mac_address': door.mac_address,
+                    'wifi_connected': True,
+                    'server_connected': True,
+                    'door_open': False,
+                    'uptime_ms': int((time.monotonic() - door.started) * 1000),
+                    'temp_users': users,
+                    'active_temp_users': len(users),
+                    'max_temp_users': door.max_users
+                })
+
+            def do_POST(self):
+                if self.path == '/api/clear_all':
+                    door.local_calls['clear_all'] += 1
+                    cleared = door.clear()
+                    return self._send(200, {'success': True, 'message': 'All temp users cleared',
+                                            'cleared_count': cleared})
+
+                data = self._json()
+                if not isinstance(data, dict):
+                    return self._send(400, {'success': False, 'message': 'Invalid JSON'})
+
+                if self.path == '/api/remove_user':
+                    door.local_calls['remove_user'] += 1
+                    if 'rfid_uids' in data:
+                        removed, not_found = [], []
+                        for uid in data['rfid_uids']:
+                            (removed if door.remove_user(uid) else not_found).append(uid)
+                        return self._send(200, {'success': True, 'removed': removed, 'not_found': not_found})
+                    if 'rfid_uid' not in data:
+                        return self._send(400, {'success': False, 'message': 'Missing rfid_uid'})
+                    uid = data['rfid_uid']
+                    if door.remove_user(uid):
+                        return self._send(200, {'success': True, 'message': 'User removed successfully', 'rfid_uid': uid})
+                    return self._send(404, {'success': False, 'message': 'User not found in cache', 'rfid_uid': uid})
+
+                if self.path == '/api/add_users':
+                    door.local_calls['add_users'] += 1
+                    if not isinstance(data.get('users'), list):
+                        return self._send(400, {'success': False, 'message': 'Missing users'})
+                    added = [user['rfid_uid'] for user in data['users']
+                             if door.add_user(user['rfid_uid'], user.get('name', 'Unknown'), user.get('starts_in_ms', 0))]
+                    return self._send(200, {'success': True, 'added': added})
+
+                self._send(404, {'error': 'Not found'})
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+
+# ================== ARRIVAL PROCESSES ==================
+
+def arrival_gaps(kind, rate, rng, burst_size=20, burst_every=60.0):
+    """Yield seconds to wait before each swipe.
+
+    poisson: exponential gaps averaging `rate` swipes per second; uniform: a
+    fixed 1/rate gap; burst: burst_size swipes within a few seconds every
+    burst_every seconds, like a class change (`rate` is not used).
+    """
+    if kind == 'poisson':
+        while True:
+            yield rng.expovariate(rate)
+    elif kind == 'uniform':
+        while True:
+            yield 1.0 / rate
+    elif kind == 'burst':
+        yield rng.uniform(0, burst_every)
+        while True:
+            for _ in range(burst_size - 1):
+                yield rng.expovariate(1.0)
+            yield burst_every
+    else:
+        raise ValueError(f'unknown arrival process: {kind}')
+
+
+# ================== FLEET ==================
+
+class FleetStats:
+    """Thread-safe counters and latency samples for the whole fleet"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.counts = {'server_swipes': 0, 'local_hits': 0, 'granted': 0, 'denied': 0,
+                       'cached': 0, 'errors': 0, 'registrations': 0, 'registration_errors': 0}
+        self.error_samples = []
+
+    def add(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self.counts[key] += value
+
+    def swipe(self, latency, granted, cached):
+        with self._lock:
+            self.latencies.append(latency)
+            self.counts['server_swipes'] += 1
+            self.counts['granted' if granted else 'denied'] += 1
+            self.counts['cached'] += int(cached)
+
+    def error(self, message):
+        with self._lock:
+            self.counts['errors'] += 1
+            if len(self.error_samples) < 10:
+                self.error_samples.append(message)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def load_cards(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute('SELECT DISTINCT uuid FROM users_reg WHERE is_deleted = 0')]
+    finally:
+        conn.close()
+
+
+def load_bookable_users(db_path):
+    """(card uuid, user_id) of every user that can submit a request"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('''
+            SELECT uuid, user_id FROM users_reg
+            WHERE is_deleted = 0 AND user_id IS NOT NULL AND user_id != ''
+            GROUP BY uuid
+        ''').fetchall()
+    finally:
+        conn.close()
+
+
+def seed_bookings(args, rooms, users, rng):
+    """Book users into every room for the whole run and approve the bookings.
+
+    Requests go through /api/student/submit_request (so the server's indexes
+    see them); the ones left pending are approved by id, so other pending
+    requests in a reused room are not touched. Bookings start at the next
+    full minute, since a request cannot start in the past.
+    Returns ({room: [card uuid, ...]}, booking start).
+    """
+    url = args.server.rstrip('/')
+    session = requests.Session()
+    response = session.post(f'{url}/admin/login', data={
+        'username': args.admin_user,
+        'password': args.admin_password
+    }, allow_redirects=False, timeout=args.timeout)
+    if response.status_code != 302:
+        raise SystemExit('❌ Admin login failed; check --admin-user/--admin-password')
+
+    start = (datetime.now() + timedelta(minutes=1)).replace(second=0, microsecond=0)
+    end = start + timedelta(minutes=math.ceil(args.duration / 60) + 5)
+    booked = {}
+    for room in rooms:
+        for uid, user_id in rng.sample(users, min(args.seed_bookings, len(users))):
+            response = session.post(f'{url}/api/student/submit_request', json={
+                'user_id': user_id,
+                'room': room,
+                'start_date': start.strftime('%Y-%m-%d'),
+                'start_time': start.strftime('%H:%M'),
+                'end_date': end.strftime('%Y-%m-%d'),
+                'end_time': end.strftime('%H:%M')
+            }, timeout=args.timeout)
+            if response.status_code == 200:
+                booked.setdefault(room, []).append(uid)
+
+        ids = pending_booking_ids(session, url, args.timeout, room, set(booked.get(room, ())), start)
+        if ids:
+            response = session.post(f'{url}/api/admin/requests/bulk_decision', json={
+                'approve': True,
+                'admin_name': 'Fleet Simulator',
+                'ids': ids
+            }, timeout=args.timeout)
+            if response.status_code != 200:
+                print(f'⚠️ Approving bookings for {room} failed: HTTP {response.status_code}')
+    print(f'📅 Booked {sum(len(uids) for uids in booked.values())} users into {len(booked)} rooms '
+          f'from {start:%H:%M} to {end:%H:%M}')
+    return booked, start
+
+
+def pending_booking_ids(session, url, timeout, room, uids, start):
+    """Ids of the pending requests seed_bookings just made for uids in room"""
+    ids, cursor = [], None
+    while True:
+        params = {'room': room, 'status': 'pending', 'limit': 500}
+        if cursor:
+            params['cursor'] = cursor
+        body = session.get(f'{url}/api/admin/requests', params=params, timeout=timeout).json()
+        ids += [r['id'] for r in body.get('requests', [])
+                if r['uid'] in uids and r['start_time'] == start.isoformat()]
+        cursor = body.get('next_cursor')
+        if not cursor or len(ids) >= len(uids):
+            return ids
+
+
+def run_door(door, args, cards, stats, stop, seed):
+    """Register, then swipe until `stop` is set"""
+    rng = random.Random(seed)
+    session = requests.Session()
+    url = args.server.rstrip('/')
+
+    try:
+        response = session.post(f'{url}/api/esp32/register', json={
+            'room': door.room,
+            'mac_address': door.mac_address,
+            'ip_address': door.ip_address,
+            'max_users': door.max_users,
+            'active_users': door.cached_count()
+        }, timeout=args.timeout)
+        if response.status_code == 200 and response.json().get('success'):
+            stats.add(registrations=1)
+        else:
+            stats.add(registration_errors=1)
+    except requests.RequestException as e:
+        stats.add(registration_errors=1)
+        stats.error(f'{door.room} register: {e}')
+
+    for gap in arrival_gaps(args.arrival, args.rate, rng, args.burst_size, args.burst_every):
+        if stop.wait(gap):
+            return
+        if cards and rng.random() >= args.unknown_ratio:
+            uid = rng.choice(cards)
+        else:
+            uid = '%08X' % rng.getrandbits(32)
+
+        # Cached users open the door locally, exactly like the firmware
+        if door.is_cached(uid):
+            stats.add(local_hits=1)
+            continue
+
+        started = time.perf_counter()
+        try:
+            response = session.post(f'{url}/api/esp32/check_access', json={
+                'rfid_uid': uid,
+                'room': door.room,
+                'mac_address': door.mac_address
+            }, timeout=args.timeout)
+            latency = time.perf_counter() - started
+            if response.status_code != 200:
+                stats.error(f'{door.room} check_access: HTTP {response.status_code}')
+                continue
+            body = response.json()
+        except (requests.RequestException, ValueError) as e:
+            stats.error(f'{door.room} check_access: {e}')
+            continue
+
+        granted = bool(body.get('access_granted'))
+        cached = granted and bool(body.get('cache_user'))
+        if cached:
+            door.add_user(uid, body.get('user_name') or 'Unknown')
+        stats.swipe(latency, granted, cached)
+
+
+def report(stats, doors, elapsed):
+    latencies = sorted(stats.latencies)
+    counts = stats.counts
+    attempts = counts['server_swipes'] + counts['errors']
+    local_calls = {}
+    for door in doors:
+        for name, value in door.local_calls.items():
+            local_calls[name] = local_calls.get(name, 0) + value
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'devices': len(doors),
+        'elapsed_s': round(elapsed, 2),
+        'registrations': counts['registrations'],
+        'registration_errors': counts['registration_errors'],
+        'server_swipes': counts['server_swipes'],
+        'local_hits': counts['local_hits'],
+        'granted': counts['granted'],
+        'denied': counts['denied'],
+        'cached': counts['cached'],
+        'errors': counts['errors'],
+        'error_rate': round(counts['errors'] / attempts, 4) if attempts else 0.0,
+        'throughput_rps': round(counts['server_swipes'] / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 0.50)),
+            'p95': ms(percentile(latencies, 0.95)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1] if latencies else None)
+        },
+        'device_api_calls': local_calls,
+        'error_samples': stats.error_samples
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated ESP32 fleet load test')
+    parser.add_argument('--server', default='http://127.0.0.1:5000', help='Flask server base URL')
+    parser.add_argument('--devices', type=int, default=10, help='number of virtual doors')
+    parser.add_argument('--rate', type=float, default=0.5, help='average swipes per second per door')
+    parser.add_argument('--arrival', choices=('poisson', 'uniform', 'burst'), default='poisson')
+    parser.add_argument('--burst-size', type=int, default=20, help='swipes per burst (burst arrival)')
+    parser.add_argument('--burst-every', type=float, default=60.0, help='seconds between bursts')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run after start-up')
+    parser.add_argument('--room-prefix', default='SIM-', help='room name prefix for the virtual doors')
+    parser.add_argument('--rooms', help='comma separated existing rooms to put the doors in (reused round-robin)')
+    parser.add_argument('--seed-bookings', type=int, default=0, metavar='N',
+                        help='book and approve N users (from --db) per door room before swiping')
+    parser.add_argument('--admin-user', default='admin', help='admin login used by --seed-bookings')
+    parser.add_argument('--admin-password', default='admin123', help='admin password used by --seed-bookings')
+    parser.add_argument('--base-port', type=int, default=18000, help='first local port for device endpoints')
+    parser.add_argument('--db', help='read card UIDs from users_reg in this database')
+    parser.add_argument('--cards', help='comma separated card UIDs (instead of --db)')
+    parser.add_argument('--unknown-ratio', type=float, default=0.05, help='share of swipes with unknown cards')
+    parser.add_argument('--timeout', type=float, default=5.0, help='HTTP timeout in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    if args.rate <= 0 or args.devices < 1:
+        parser.error('--rate must be positive and --devices at least 1')
+    if args.seed_bookings and not args.db:
+        parser.error('--seed-bookings needs --db to find user ids')
+
+    cards = [c.strip().upper() for c in args.cards.split(',') if c.strip()] if args.cards else []
+    if args.db:
+        cards += load_cards(args.db)
+    if not cards:
+        print('⚠️ No cards given (--db or --cards); every swipe uses an unknown card')
+
+    rooms = [r.strip() for r in args.rooms.split(',') if r.strip()] if args.rooms else []
+    if rooms and len(rooms) < args.devices:
+        # The server keeps one device per room, the last one to register
+        print(f'⚠️ {args.devices} doors share {len(rooms)} rooms; the server only calls back one door per room')
+    doors = [VirtualDoor(i + 1, rooms[i % len(rooms)] if rooms else f'{args.room_prefix}{i + 1:03d}', args.base_port + i)
+             for i in range(args.devices)]
+    for door in doors:
+        door.serve()
+    print(f'🚪 {len(doors)} virtual doors listening on ports {args.base_port}-{args.base_port + len(doors) - 1}')
+
+    seeds = random.Random(args.seed)
+    booked = {}
+    if args.seed_bookings:
+        booked, booking_start = seed_bookings(args, sorted({door.room for door in doors}),
+                                              load_bookable_users(args.db), seeds)
+        wait = (booking_start - datetime.now()).total_seconds()
+        if wait > 0:
+            print(f'⏳ Waiting {wait:.0f}s for the bookings to start')
+            time.sleep(wait)
+
+    stats = FleetStats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=run_door, args=(door, args, booked.get(door.room) or cards, stats, stop,
+                                                       seeds.random()), daemon=True)
+               for door in doors]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+
+    try:
+        stop.wait(args.duration)
+    except KeyboardInterrupt:
+        print('⏹️ Interrupted, writing report')
+    stop.set()
+    for thread in threads:
+        thread.join(args.timeout + 1)
+    elapsed = time.monotonic() - started
+    for door in doors:
+        door.shutdown()
+
+    result = report(stats, doors, elapsed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    latency = result['latency_ms']
+    print(f"📊 {result['server_swipes']} server swipes in {result['elapsed_s']}s "
+          f"({result['throughput_rps']} req/s), {result['local_hits']} served from door caches")
+    print(f"⏱️ latency p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, max {latency['max']} ms")
+    print(f"✅ granted {result['granted']} ({result['cached']} cached), ❌ denied {result['denied']}")
+    print(f"⚠️ errors {result['errors']} (rate {result['error_rate']:.2%}), "
+          f"registration errors {result['registration_errors']}")
+    print(f"🔌 device API calls from server: {result['device_api_calls']}")
+    for sample in result['error_samples']:
+        print(f'   {sample}')
+
+
+if __name__ == '__main__':
+    main()
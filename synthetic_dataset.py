@@ -0,0 +1,367 @@
+"""Build a realistic, large database for performance work.
+
+Creates a fresh database with the server's own schema and migrations, then
+bulk-loads synthetic data:
+- users_reg: 90% students, 8% teachers, 2% admins; activity follows a
+  Pareto distribution, so a minority of users makes most requests and swipes
+- rooms: popularity follows a Zipf distribution (a few busy labs, a long tail)
+- requests: start times concentrated on weekdays and class hours, with
+  30/60/90/120/180/240 minute slots. Past requests are mostly decided;
+  future ones are often still pending.
+- access_logs: the same weekday/hour shape, written in time order (UTC)
+  with the hourly rollups and daily distinct-user sketches kept in step
+- esp32_cache: entries for the bookings active now, plus recently expired
+  entries still marked online, so the expiry worker and cleanup have work
+
+Usage:
+    python synthetic_dataset.py --out /tmp/campus.db --users 50000 \\
+        --requests 1000000 --access-logs 20000000 --rooms 120 --days 365
+
+Needs NumPy. The output file must not exist unless --force is given.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+FIRST_NAMES = ['Apichet', 'Somchai', 'Nattapong', 'Kittipong', 'Siriporn', 'Waraporn', 'Chanida',
+               'Thanawat', 'Pimchanok', 'Suphakit', 'Nithiroj', 'Kanokwan', 'Jirayu', 'Ratchanon',
+               'Preeyaporn', 'Wuttichai', 'Sasithorn', 'Teerapat', 'Arisa', 'Panupong']
+LAST_NAMES = ['Thamraksa', 'Srisuk', 'Chaiyaphum', 'Wongsawat', 'Boonmee', 'Saengthong', 'Kaewkla',
+              'Nuntavanoatyan', 'Phromma', 'Intharasombat', 'Rattanakorn', 'Siripan', 'Pholsri',
+              'Kongkaew', 'Jantarasri', 'Sukprasert']
+BUILDINGS = ['EN', 'SC', 'AG', 'MD', 'LB', 'AR', 'ED', 'HS']
+
+# Relative swipe/booking weight per weekday (Monday first) and hour of day
+WEEKDAY_WEIGHTS = [1.0, 1.0, 1.0, 1.0, 0.9, 0.3, 0.15]
+HOUR_WEIGHTS = [0.01, 0.005, 0.005, 0.005, 0.005, 0.01, 0.05, 0.3, 1.0, 1.0, 0.95, 0.9,
+                0.6, 0.95, 1.0, 0.9, 0.8, 0.5, 0.35, 0.25, 0.15, 0.08, 0.04, 0.02]
+DURATIONS = [30, 60, 90, 120, 180, 240]
+DURATION_WEIGHTS = [0.05, 0.3, 0.25, 0.2, 0.15, 0.05]
+
+
+# ================== DISTRIBUTIONS ==================
+
+def normalized(weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    return weights / weights.sum()
+
+
+def hour_slots(start, days):
+    """Start datetimes (as datetime64[s]) and probabilities of every hour in [start, start + days)"""
+    first = np.datetime64(start.replace(minute=0, second=0, microsecond=0), 's')
+    slots = first + np.arange(days * 24, dtype=np.int64) * np.timedelta64(3600, 's')
+    hours = slots.astype('datetime64[h]').astype(np.int64) % 24
+    # datetime64 days since 1970-01-01 (a Thursday) -> Monday = 0
+    weekdays = (slots.astype('datetime64[D]').astype(np.int64) + 3) % 7
+    return slots, normalized(np.asarray(WEEKDAY_WEIGHTS)[weekdays] * np.asarray(HOUR_WEIGHTS)[hours])
+
+
+def card_uids(count, offset=0):
+    """Unique, random-looking 8 hex digit card UIDs (a bijection of the index mod 2**32)"""
+    index = np.arange(offset, offset + count, dtype=np.uint64)
+    mixed = (index * np.uint64(2654435761) + np.uint64(0x9E3779B9)) % np.uint64(1 << 32)
+    return np.char.upper(np.char.mod('%08x', mixed))
+
+
+def as_text(moments, sep='T'):
+    text = np.datetime_as_string(moments, unit='s')
+    return text if sep == 'T' else np.char.replace(text, 'T', sep)
+
+
+# ================== GENERATOR ==================
+
+class DatasetBuilder:
+    def __init__(self, app, rng, args):
+        self.app = app
+        self.rng = rng
+        self.args = args
+        self.now = datetime.now().replace(microsecond=0)
+
+    def log(self, message):
+        print(message, flush=True)
+
+    def build_users(self):
+        rng, count = self.rng, self.args.users
+        uids = card_uids(count)
+        first = np.asarray(FIRST_NAMES)[rng.integers(0, len(FIRST_NAMES), count)]
+        last = np.asarray(LAST_NAMES)[rng.integers(0, len(LAST_NAMES), count)]
+        roles = rng.choice(['student', 'teacher', 'admin'], size=count, p=[0.9, 0.08, 0.02])
+        deleted = rng.random(count) < 0.01
+        created = np.datetime64(self.now - timedelta(days=self.args.days * 2), 's') + \
+            rng.integers(0, self.args.days * 2 * 86400, count).astype('timedelta64[s]')
+        created_text = as_text(np.sort(created), ' ')
+
+        rows = []
+        for i in range(count):
+            name = f'{first[i]} {last[i]}'
+            rows.append((str(uids[i]), str(6600000000 + i), str(first[i]), str(last[i]), name,
+                         f'{first[i].lower()}.{last[i][:2].lower()}{i}@kkumail.com', str(roles[i]),
+                         int(deleted[i]), str(created_text[i]), str(created_text[i])))
+        conn = self.app.get_db_connection()
+        try:
+            conn.executemany('''
+                INSERT INTO users_reg (uuid, user_id, first_name, last_name, name, email, role,
+                                       is_deleted, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.user_uids = uids[~deleted]
+        self.user_names = np.char.add(np.char.add(first, ' '), last)[~deleted]
+        # Pareto activity: roughly 20% of users produce 80% of the traffic
+        self.user_weights = normalized(rng.pareto(1.16, len(self.user_uids)) + 1)
+        self.log(f'👥 users_reg: {count} rows')
+
+    def build_rooms(self):
+        rng, count = self.rng, self.args.rooms
+        names = []
+        seen = set()
+        while len(names) < count:
+            name = f'{BUILDINGS[rng.integers(len(BUILDINGS))]}{rng.integers(1, 10)}{rng.integers(1, 60):02d}'
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+        rows = [(name, '24:6F:28:%02X:%02X:%02X' % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+                 f'10.0.{i // 250}.{i % 250 + 1}', 'online' if rng.random() < 0.9 else 'offline')
+                for i, name in enumerate(names)]
+        conn = self.app.get_db_connection()
+        try:
+            conn.executemany('INSERT INTO rooms (room, mac_address, ip_address, status) VALUES (?, ?, ?, ?)', rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.rooms = np.asarray(names)
+        # Zipf popularity over a random ranking of the rooms
+        self.room_weights = normalized(1.0 / np.arange(1, count + 1) ** 1.1)
+        self.log(f'🏢 rooms: {count} rows')
+
+    def build_requests(self):
+        rng, total = self.rng, self.args.requests
+        past_days, future_days = self.args.days, 14
+        slots, probabilities = hour_slots(self.now - timedelta(days=past_days), past_days + future_days)
+        now = np.datetime64(self.now, 's')
+        written = 0
+        conn = self.app.get_db_connection()
+        try:
+            while written < total:
+                n = min(self.args.batch, total - written)
+                start = slots[rng.choice(len(slots), n, p=probabilities)] + \
+                    (rng.integers(0, 2, n) * 1800).astype('timedelta64[s]')
+                end = start + (rng.choice(DURATIONS, n, p=DURATION_WEIGHTS) * 60).astype('timedelta64[s]')
+                lead = np.maximum(600, rng.exponential(3 * 86400, n)).astype(np.int64).astype('timedelta64[s]')
+                submitted = np.minimum(start - lead, now)
+                decided = submitted + rng.integers(300, 86400, n).astype('timedelta64[s]')
+                users = rng.choice(len(self.user_uids), n, p=self.user_weights)
+                rooms = rng.choice(len(self.rooms), n, p=self.room_weights)
+
+                ended = end < now
+                roll = rng.random(n)
+                approved = np.where(ended, roll < 0.8, roll < 0.55)
+                denied = np.where(ended, roll >= 0.9, roll >= 0.95)
+                auto = rng.random(n) < 0.3
+
+                order = np.argsort(submitted, kind='stable')
+                start_text, end_text = as_text(start), as_text(end)
+                submitted_text, decided_text = as_text(submitted, ' '), as_text(decided, ' ')
+                rows = []
+                for i in order:
+                    if approved[i]:
+                        access, approved_by, approved_at = 1, 'Auto Approved' if auto[i] else 'Admin', str(decided_text[i])
+                    elif denied[i]:
+                        access, approved_by, approved_at = 0, 'Admin', str(decided_text[i])
+                    else:
+                        access, approved_by, approved_at = 0, None, None
+                    rows.append((str(self.user_uids[users[i]]), str(self.user_names[users[i]]),
+                                 str(start_text[i]), str(end_text[i]), access, str(self.rooms[rooms[i]]),
+                                 str(submitted_text[i]), approved_by, approved_at))
+                conn.executemany('''
+                    INSERT INTO requests (uid, name, start_time, end_time, access, room,
+                                          timestamp, approved_by, approved_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                conn.commit()
+                written += n
+                self.log(f'📝 requests: {written}/{total}')
+        finally:
+            conn.close()
+
+    def build_access_logs(self):
+        rng, total = self.rng, self.args.access_logs
+        days = self.args.days
+        utc_now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        slots, probabilities = hour_slots(utc_now - timedelta(days=days), days)
+        per_slot = rng.multinomial(total, probabilities)
+        unknown = card_uids(max(1000, total // 1000), offset=1 << 31)
+
+        written = 0
+        pending = []
+        conn = self.app.get_db_connection()
+        try:
+            for slot, count in zip(slots, per_slot):
+                if count:
+                    pending.append(slot + np.sort(rng.integers(0, 3600, count)).astype('timedelta64[s]'))
+                    written += int(count)
+                if pending and (sum(len(p) for p in pending) >= self.args.batch or written == total):
+                    self._write_logs(conn, np.concatenate(pending), unknown)
+                    pending = []
+                    self.log(f'🚪 access_logs: {written}/{total}')
+            if pending:
+                self._write_logs(conn, np.concatenate(pending), unknown)
+        finally:
+            conn.close()
+
+    def _write_logs(self, conn, moments, unknown):
+        rng = self.rng
+        n = len(moments)
+        known = rng.random(n) >= self.args.unknown_ratio
+        users = rng.choice(len(self.user_uids), n, p=self.user_weights)
+        strangers = rng.integers(0, len(unknown), n)
+        rooms = rng.choice(len(self.rooms), n, p=self.room_weights)
+        granted = known & (rng.random(n) < 0.85)
+        local = rng.random(n) < 0.6
+        text = as_text(moments, ' ')
+        rows = [(str(self.user_uids[users[i]]) if known[i] else str(unknown[strangers[i]]),
+                 str(self.rooms[rooms[i]]), int(granted[i]),
+                 ('local' if local[i] else 'database') if granted[i] else 'denied',
+                 str(text[i]), None if known[i] else 'Unknown RFID card')
+                for i in range(n)]
+
+        # Same transaction shape as AccessLogWriter.write_batch: rows and rollups together
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM access_logs').fetchone()[0]
+            conn.executemany('''
+                INSERT INTO access_logs (rfid_uid, room, access_granted, access_type, timestamp, notes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.app.rollup_access_logs(conn, last_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def build_cache(self):
+        now = self.now.isoformat()
+        recent = (self.now - timedelta(hours=2)).isoformat()
+        conn = self.app.get_db_connection()
+        try:
+            # Doors hold the users whose booking is active now...
+            active = conn.execute('''
+                INSERT OR IGNORE INTO esp32_cache (room, rfid_uid, name, expires_at)
+                SELECT room, uid, name, MAX(end_time) FROM requests
+                WHERE access = 1 AND start_time <= ? AND end_time >= ?
+                GROUP BY room, uid
+            ''', (now, now)).rowcount
+            # ...and some whose booking just ended and still await cleanup
+            stale = conn.execute('''
+                INSERT OR IGNORE INTO esp32_cache (room, rfid_uid, name, expires_at)
+                SELECT room, uid, name, MAX(end_time) FROM requests
+                WHERE access = 1 AND end_time >= ? AND end_time < ?
+                GROUP BY room, uid
+            ''', (recent, now)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        self.log(f'💾 esp32_cache: {active} active, {stale} expired awaiting cleanup')
+
+    def drop_indexes(self, *tables):
+        """Drop the tables' secondary indexes for the bulk load; returns their SQL"""
+        conn = self.app.get_db_connection()
+        try:
+            indexes = conn.execute(f'''
+                SELECT name, sql FROM sqlite_master
+                WHERE type = 'index' AND sql IS NOT NULL
+                AND tbl_name IN ({', '.join('?' for _ in tables)})
+            ''', tables).fetchall()
+            for index in indexes:
+                conn.execute(f'DROP INDEX {index["name"]}')
+            conn.commit()
+        finally:
+            conn.close()
+        return [index['sql'] for index in indexes]
+
+    def create_indexes(self, statements):
+        started = time.perf_counter()
+        conn = self.app.get_db_connection()
+        try:
+            for sql in statements:
+                conn.execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+        self.log(f'🗂️ {len(statements)} indexes rebuilt in {time.perf_counter() - started:.1f}s')
+
+    def analyze(self):
+        conn = self.app.get_db_connection()
+        try:
+            conn.execute('ANALYZE')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic database at configurable scale')
+    parser.add_argument('--out', required=True, help='database file to create')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--rooms', type=int, default=120)
+    parser.add_argument('--requests', type=int, default=1000000)
+    parser.add_argument('--access-logs', type=int, default=20000000)
+    parser.add_argument('--days', type=int, default=365, help='history covered by requests and access logs')
+    parser.add_argument('--unknown-ratio', type=float, default=0.03, help='share of swipes by unknown cards')
+    parser.add_argument('--batch', type=int, default=200000, help='rows per insert transaction')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--force', action='store_true', help='overwrite --out if it exists')
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit('❌ NumPy is required: pip install numpy')
+    if args.users < 1 or args.rooms < 1 or args.days < 1:
+        parser.error('--users, --rooms and --days must be at least 1')
+
+    out = os.path.abspath(args.out)
+    if os.path.exists(out):
+        if not args.force:
+            sys.exit(f'❌ {out} exists (use --force to overwrite)')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(out + suffix):
+                os.remove(out + suffix)
+
+    # The server module reads NACS_DATABASE at import time
+    os.environ['NACS_DATABASE'] = out
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    started = time.perf_counter()
+    app.init_database()
+    builder = DatasetBuilder(app, np.random.default_rng(args.seed), args)
+    builder.build_users()
+    builder.build_rooms()
+    # Loading into bare tables and indexing once is far faster than
+    # maintaining every index row by row
+    indexes = builder.drop_indexes('requests', 'access_logs')
+    builder.build_requests()
+    builder.build_access_logs()
+    builder.create_indexes(indexes)
+    builder.build_cache()
+    builder.analyze()
+    app.db_pool.close_all()
+
+    size_mb = os.path.getsize(out) / 1024 / 1024
+    print(f'✅ {out}: {size_mb:.0f} MB in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
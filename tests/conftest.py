@@ -0,0 +1,41 @@
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+
+# The server module reads NACS_DATABASE at import time, so point it at a
+# scratch file before anything imports app
+_workdir = tempfile.mkdtemp(prefix='nacs-tests-')
+os.environ['NACS_DATABASE'] = os.path.join(_workdir, 'database.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as server  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    server.init_database()
+    server.access_log_writer.start()
+    yield os.environ['NACS_DATABASE']
+    server.access_log_writer.stop()
+    server.db_pool.close_all()
+
+
+@pytest.fixture
+def db(database):
+    """Plain sqlite3 connection to the test database"""
+    conn = sqlite3.connect(database)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def admin_client():
+    client = server.app.test_client()
+    with client.session_transaction() as session:
+        session['admin_user'] = 'admin'
+        session['login_time'] = datetime.now().isoformat()
+    return client
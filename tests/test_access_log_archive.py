@@ -0,0 +1,73 @@
+import gzip
+import os
+import sqlite3
+
+import app as server
+
+
+def _write_month(archive, month, rows):
+    plain = os.path.join(archive.directory, f'plain_{month}.db')
+    conn = sqlite3.connect(plain)
+    conn.execute('CREATE TABLE access_logs (id INTEGER PRIMARY KEY, rfid_uid TEXT, room TEXT)')
+    conn.executemany('INSERT INTO access_logs (rfid_uid, room) VALUES (?, ?)', rows)
+    conn.commit()
+    conn.close()
+    with open(plain, 'rb') as src, gzip.open(archive.path(month), 'wb') as dst:
+        dst.write(src.read())
+    os.remove(plain)
+
+
+def test_attached_month_survives_cache_eviction(tmp_path):
+    archive = server.AccessLogArchive(str(tmp_path), hot_months=3, cache_size=1)
+    _write_month(archive, '2024-01', [('ARCH0001', 'LAB1')])
+    _write_month(archive, '2024-02', [('ARCH0002', 'LAB2'), ('ARCH0003', 'LAB2')])
+
+    reader = server.get_db_connection()
+    other = server.get_db_connection()
+    try:
+        with archive.attached(reader, '2024-01'):
+            january = archive._cache['2024-01'][1]
+            # Decompressing February evicts January from the one-entry cache
+            with archive.attached(other, '2024-02'):
+                assert other.execute('SELECT COUNT(*) FROM part.access_logs').fetchone()[0] == 2
+            assert '2024-01' not in archive._cache
+            assert os.path.exists(january)
+            assert reader.execute('SELECT rfid_uid FROM part.access_logs').fetchall()[0][0] == 'ARCH0001'
+        assert not os.path.exists(january)
+    finally:
+        reader.close()
+        other.close()
+
+
+def test_rows_written_during_archiving_are_not_deleted(db, tmp_path, monkeypatch):
+    archive = server.AccessLogArchive(str(tmp_path), hot_months=3)
+    db.execute("INSERT INTO access_logs (rfid_uid, room, access_granted, access_type, timestamp) "
+               "VALUES ('EARLY001', 'LAB1', 1, 'database', '2020-01-10 08:00:00')")
+    db.commit()
+
+    real_replace = os.replace
+
+    def late_upload_then_replace(src, dst):
+        # A backdated device upload lands between the copy and the delete
+        db.execute("INSERT INTO access_logs (rfid_uid, room, access_granted, access_type, timestamp) "
+                   "VALUES ('LATE0001', 'LAB1', 1, 'local', '2020-01-20 08:00:00')")
+        db.commit()
+        real_replace(src, dst)
+
+    monkeypatch.setattr(server.os, 'replace', late_upload_then_replace)
+    assert archive._archive_month('2020-01') == 1
+    monkeypatch.undo()
+
+    remaining = {row[0] for row in db.execute(
+        "SELECT rfid_uid FROM access_logs WHERE timestamp LIKE '2020-01%'")}
+    assert remaining == {'LATE0001'}
+
+    conn = server.get_db_connection()
+    try:
+        with archive.attached(conn, '2020-01'):
+            archived = {row[0] for row in conn.execute('SELECT rfid_uid FROM part.access_logs')}
+    finally:
+        conn.close()
+    assert archived == {'EARLY001'}
+    db.execute("DELETE FROM access_logs WHERE timestamp LIKE '2020-01%'")
+    db.commit()
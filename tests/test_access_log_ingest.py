@@ -0,0 +1,22 @@
+import pytest
+
+import app as server
+
+
+@pytest.mark.parametrize('value', ['false', '0', 'true', 'yes', None, 2, 0.0, [], {}])
+def test_access_granted_must_be_a_boolean_or_0_1(value):
+    response = server.app.test_client().post('/api/esp32/access_log', json={
+        'rfid_uid': 'ING00001', 'room': 'LAB1', 'access_granted': value
+    })
+    assert response.status_code == 400
+    assert 'Event 0' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('value, granted', [(True, True), (False, False), (1, True), (0, False)])
+def test_access_granted_accepts_booleans_and_0_1(db, value, granted):
+    response = server.app.test_client().post('/api/esp32/access_log', json={
+        'rfid_uid': 'ING00002', 'room': 'LAB1', 'access_granted': value, 'notes': f'ingest {value!r}'
+    })
+    assert response.status_code == 200
+    row = db.execute('SELECT access_granted FROM access_logs WHERE notes = ?', (f'ingest {value!r}',)).fetchone()
+    assert bool(row[0]) is granted
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import app as server
+
+
+def _event(uid, room='LAB1', notes=None):
+    return (uid, room, False, 'denied', notes, server.utc_timestamp(), None, None)
+
+
+def _logged(db, uid):
+    return db.execute('SELECT COUNT(*) FROM access_logs WHERE rfid_uid = ?', (uid,)).fetchone()[0]
+
+
+def test_failed_batch_is_retried(db, monkeypatch):
+    monkeypatch.setattr(server.time, 'sleep', lambda seconds: None)
+    original = server.rollup_access_logs
+    failures = []
+
+    def flaky_rollup(cursor, after_id):
+        if not failures:
+            failures.append(after_id)
+            raise server.sqlite3.OperationalError('database is locked')
+        return original(cursor, after_id)
+
+    monkeypatch.setattr(server, 'rollup_access_logs', flaky_rollup)
+    server.AccessLogWriter()._write_with_retry([_event('RETRY001'), _event('RETRY002')])
+    assert failures
+    assert _logged(db, 'RETRY001') == 1 and _logged(db, 'RETRY002') == 1
+
+
+def test_poisoned_event_does_not_drop_the_batch(db, monkeypatch):
+    monkeypatch.setattr(server.time, 'sleep', lambda seconds: None)
+    server.AccessLogWriter()._write_with_retry([_event('POISON01', room=None), _event('HEALTHY1')])
+    assert _logged(db, 'POISON01') == 0
+    assert _logged(db, 'HEALTHY1') == 1
+
+
+def test_swipe_writes_go_through_the_writer(db):
+    now = datetime.now().replace(microsecond=0)
+    db.execute("INSERT OR IGNORE INTO rooms (room, mac_address, status, last_seen) "
+               "VALUES ('WRITERLAB', 'AA:BB:CC:00:00:04', 'offline', '2000-01-01 00:00:00')")
+    db.execute("INSERT INTO requests (uid, name, start_time, end_time, room, access, approved_by) "
+               "VALUES ('EA20B1CC', 'Apichet Thamraksa', ?, ?, 'WRITERLAB', 1, 'Admin')",
+               ((now - timedelta(hours=1)).isoformat(), (now + timedelta(hours=1)).isoformat()))
+    db.commit()
+    server.auth_index.build()
+
+    response = server.app.test_client().post('/api/esp32/check_access', json={
+        'rfid_uid': 'EA20B1CC', 'room': 'WRITERLAB', 'mac_address': 'AA:BB:CC:00:00:04'})
+    assert response.get_json()['access_granted'] is True
+    server.access_log_writer.flush()
+
+    status, last_seen = db.execute("SELECT status, last_seen FROM rooms WHERE room = 'WRITERLAB'").fetchone()
+    assert status == 'online' and last_seen > '2000-01-01 00:00:00'
+    assert db.execute("SELECT COUNT(*) FROM esp32_cache WHERE room = 'WRITERLAB' AND rfid_uid = 'EA20B1CC'"
+                      ).fetchone()[0] == 1
+
+
+class _Dashboard:
+    listening = True
+
+    def __init__(self):
+        self.events = []
+
+    def publish(self, kind, payload):
+        self.events.append((kind, payload))
+
+    def resync(self, kind):
+        self.events.append((kind, None))
+
+
+def test_room_coming_online_is_counted_and_published(db, monkeypatch):
+    db.execute("INSERT OR IGNORE INTO rooms (room, mac_address, status, last_seen) "
+               "VALUES ('ONLINELAB', 'AA:BB:CC:00:00:05', 'offline', '2000-01-01 00:00:00')")
+    db.commit()
+    server.stats_counters.reconcile()
+    online = server.stats_counters.snapshot()['online_rooms']
+    dashboard = _Dashboard()
+    monkeypatch.setattr(server, 'dashboard_notifier', dashboard)
+
+    writer = server.AccessLogWriter(synchronous=True)
+    writer.touch_room('ONLINELAB', 'AA:BB:CC:00:00:05')
+    writer.write_batch([_event('ONLINE01', room='ONLINELAB')])
+
+    assert server.stats_counters.snapshot()['online_rooms'] == online + 1
+    rooms = [payload for kind, payload in dashboard.events if kind == 'rooms']
+    assert rooms[0]['room'] == 'ONLINELAB' and rooms[0]['status'] == 'online'
+    access = [payload for kind, payload in dashboard.events if kind == 'access']
+    assert access[0]['rfid_uid'] == 'ONLINE01' and access[0]['room'] == 'ONLINELAB'
+
+    # Already online: seen again, but not counted twice
+    writer.touch_room('ONLINELAB', 'AA:BB:CC:00:00:05')
+    writer.write_batch([])
+    assert server.stats_counters.snapshot()['online_rooms'] == online + 1
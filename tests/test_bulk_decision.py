@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.mark.parametrize('approve', ['false', 'true', 0, 1, None])
+def test_approve_must_be_a_json_boolean(admin_client, approve):
+    body = {'ids': [1], 'admin_name': 'tester'}
+    if approve is not None:
+        body['approve'] = approve
+    response = admin_client.post('/api/admin/requests/bulk_decision', json=body)
+    assert response.status_code == 400
+    assert 'approve' in response.get_json()['error']
+
+
+def test_boolean_ids_are_rejected(admin_client):
+    response = admin_client.post('/api/admin/requests/bulk_decision',
+                                 json={'approve': False, 'ids': [True, False]})
+    assert response.status_code == 400
+    assert 'ids' in response.get_json()['error']
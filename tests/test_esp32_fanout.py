@@ -0,0 +1,47 @@
+import time
+
+import app as server
+
+
+class _OldFirmware:
+    """Rejects the batch field and takes 100 ms per single-UID request"""
+
+    def __init__(self):
+        self.timeouts = []
+
+    def post(self, url, json, timeout):
+        self.timeouts.append(timeout)
+        if 'rfid_uids' in json:
+            return _Response(400)
+        time.sleep(0.1)
+        return _Response(200)
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def json(self):
+        return {}
+
+
+def test_per_uid_fallback_stops_at_the_deadline(monkeypatch):
+    device = _OldFirmware()
+    monkeypatch.setattr(server, 'get_device_session', lambda room_ip: device)
+    uids = [f'DL{i:04d}' for i in range(20)]
+
+    started = time.monotonic()
+    removed = server.send_remove_users_to_esp32('10.0.0.9', uids, deadline=started + 0.35)
+
+    assert time.monotonic() - started < 1
+    assert 0 < len(removed) < len(uids)
+    assert removed == uids[:len(removed)]
+    assert all(max(timeout) <= 0.35 for timeout in device.timeouts)
+
+
+def test_nothing_is_sent_after_the_deadline(monkeypatch):
+    device = _OldFirmware()
+    monkeypatch.setattr(server, 'get_device_session', lambda room_ip: device)
+
+    assert server.send_remove_users_to_esp32('10.0.0.9', ['DL0001'], deadline=time.monotonic() - 1) == []
+    assert device.timeouts == []
@@ -0,0 +1,36 @@
+import app as server
+
+
+def test_metrics_needs_a_session_or_the_scrape_token(admin_client, monkeypatch):
+    client = server.app.test_client()
+    assert client.get('/metrics').status_code == 401
+
+    monkeypatch.setattr(server, 'METRICS_TOKEN', 'scrape-secret')
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+    assert response.status_code == 200
+    assert 'nacs_queue_depth{queue="esp32_fanout"} 0' in response.get_data(as_text=True)
+
+    assert admin_client.get('/metrics').status_code == 200
+
+
+def test_fanout_backlog_counts_calls_waiting_for_a_worker():
+    executor = server.DeviceCallExecutor(max_workers=1)
+    release = server.threading.Event()
+    running = server.threading.Event()
+
+    def block():
+        running.set()
+        release.wait()
+
+    try:
+        futures = [executor.submit(block) for _ in range(3)]
+        executor.submit(block).cancel()
+        running.wait(1)
+        assert executor.waiting() == 2
+        release.set()
+        server.wait(futures)
+        assert executor.waiting() == 0
+    finally:
+        release.set()
+        executor.shutdown()
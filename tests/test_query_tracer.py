@@ -0,0 +1,24 @@
+import app as server
+
+
+def test_ddl_is_not_explained_and_parameters_are_not_kept(db):
+    tracer = server.QueryTracer(slow_ms=0)
+    conn = server.get_db_connection()
+    try:
+        ddl = 'CREATE INDEX IF NOT EXISTS idx_users_reg_uuid_test ON users_reg(uuid)'
+        tracer.record(conn, ddl, (), 1.0)
+        select = 'SELECT * FROM users_reg WHERE uuid = ? AND name = ?'
+        tracer.record(conn, select, ('SECRET01', 'Secret Name'), 1.0)
+        tracer.record(conn, 'INSERT INTO esp32_cache (room, rfid_uid) VALUES (?, ?)',
+                      [('LAB1', 'SECRET02'), ('LAB2', 'SECRET03')], 1.0, many=True)
+    finally:
+        conn.close()
+        db.execute('DROP INDEX IF EXISTS idx_users_reg_uuid_test')
+        db.commit()
+
+    stats = dict(tracer.top(10))
+    assert stats[server.sql_fingerprint(ddl)]['plan'] is None
+    assert stats[server.sql_fingerprint(select)]['plan']
+    assert not any(step.startswith('(plan unavailable') for _, s in stats.items() for step in s['plan'] or [])
+    assert 'SECRET' not in repr(stats)
+    assert 'Secret Name' not in repr(stats)
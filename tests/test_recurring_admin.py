@@ -0,0 +1,38 @@
+from datetime import date, timedelta
+
+import app as server
+
+
+def test_recurring_rules_are_counted_as_pending_until_decided(db, admin_client):
+    db.execute(
+        'INSERT OR IGNORE INTO users_reg (uuid, user_id, first_name, last_name, name, email, role) '
+        "VALUES ('EC0001', 'rec-1', 'Weekly', 'Student', 'Weekly Student', 'rec1@example.com', 'student')"
+    )
+    db.commit()
+    server.auth_index.build()
+    server.policy_engine.rebuild()
+    server.stats_counters.reconcile()
+    before = admin_client.get('/api/admin/stats').get_json()
+
+    start = date.today() + timedelta(days=1)
+    response = server.app.test_client().post('/api/student/submit_recurring_request', json={
+        'user_id': 'rec-1', 'room': 'RECURRING-LAB', 'weekdays': [start.weekday()],
+        'start_time': '09:00', 'end_time': '10:00',
+        'start_date': start.isoformat(), 'end_date': (start + timedelta(days=21)).isoformat()
+    })
+    body = response.get_json()
+    assert response.status_code == 200, body
+    stats = admin_client.get('/api/admin/stats').get_json()
+    delta = 1 if body['status'] == 'pending' else 0
+    assert stats['pending_recurring_requests'] == before['pending_recurring_requests'] + delta
+    assert stats['total_recurring_requests'] == before['total_recurring_requests'] + 1
+
+    response = admin_client.put(f"/api/admin/recurring_requests/{body['id']}/approve",
+                                json={'approve': True, 'admin_name': 'tester'})
+    assert response.status_code == 200
+    stats = admin_client.get('/api/admin/stats').get_json()
+    assert stats['pending_recurring_requests'] == before['pending_recurring_requests']
+    assert stats['approved_recurring_requests'] == before['approved_recurring_requests'] + 1
+
+    server.stats_counters.reconcile()
+    assert admin_client.get('/api/admin/stats').get_json() == stats
@@ -0,0 +1,41 @@
+from datetime import date, datetime, timedelta
+
+import app as server
+
+
+def test_approved_recurring_occurrences_count_towards_max_active(db, admin_client):
+    db.execute(
+        'INSERT OR IGNORE INTO users_reg (uuid, user_id, first_name, last_name, name, email, role) '
+        "VALUES ('EC0101', 'limit-1', 'Limit', 'Student', 'Limit Student', 'limit1@example.com', 'student')"
+    )
+    db.execute(
+        "INSERT INTO approval_policies (room, action, max_active_per_user, description) "
+        "VALUES ('LIMIT-LAB', 'approve', 2, 'two active bookings')"
+    )
+    db.commit()
+    server.auth_index.build()
+    server.policy_engine.rebuild()
+    try:
+        start = date.today() + timedelta(days=1)
+        response = server.app.test_client().post('/api/student/submit_recurring_request', json={
+            'user_id': 'limit-1', 'room': 'LIMIT-LAB', 'weekdays': [start.weekday()],
+            'start_time': '09:00', 'end_time': '10:00',
+            'start_date': start.isoformat(), 'end_date': (start + timedelta(days=14)).isoformat()
+        })
+        body = response.get_json()
+        # Three weekly occurrences exceed the two-booking limit, so an admin decides
+        assert body['status'] == 'pending'
+        assert server.reservation_index.held_by('LIMIT-LAB', 'EC0101') == 0
+
+        admin_client.put(f"/api/admin/recurring_requests/{body['id']}/approve",
+                         json={'approve': True, 'admin_name': 'tester'})
+        assert server.reservation_index.held_by('LIMIT-LAB', 'EC0101') == 3
+
+        one_off = datetime.combine(start, datetime.min.time()) + timedelta(hours=13)
+        action, _ = server.policy_engine.decide('LIMIT-LAB', 'student', one_off, one_off + timedelta(hours=1),
+                                                server.reservation_index.held_by('LIMIT-LAB', 'EC0101'))
+        assert action == 'manual'
+    finally:
+        db.execute("DELETE FROM approval_policies WHERE room = 'LIMIT-LAB'")
+        db.commit()
+        server.policy_engine.rebuild()
@@ -0,0 +1,21 @@
+import app as server
+
+
+def _register(client, room, mac):
+    response = client.post('/api/esp32/register', json={'room': room, 'mac_address': mac, 'ip_address': '127.0.0.1:9'})
+    assert response.status_code == 200
+
+
+def test_reregistering_keeps_capacity_and_moving_a_device_drops_it(admin_client):
+    _register(admin_client, 'CAPLAB', 'AA:BB:CC:00:01:01')
+    assert admin_client.put('/api/admin/rooms/CAPLAB/capacity', json={'capacity': 3}).status_code == 200
+
+    # Device reboot: same room, same MAC
+    _register(admin_client, 'CAPLAB', 'AA:BB:CC:00:01:01')
+    assert server.policy_engine.capacity('CAPLAB') == 3
+    rooms = {room['room']: room for room in admin_client.get('/api/admin/rooms').get_json()['rooms']}
+    assert rooms['CAPLAB']['capacity'] == 3
+
+    # The device moves to another room: its old row (and capacity) is gone
+    _register(admin_client, 'CAPLAB2', 'AA:BB:CC:00:01:01')
+    assert server.policy_engine.capacity('CAPLAB') is None
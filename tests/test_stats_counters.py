@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+import app as server
+
+
+def test_malformed_cache_expiry_is_skipped(db, admin_client):
+    future = (datetime.now() + timedelta(hours=1)).replace(microsecond=0).isoformat()
+    db.execute('DELETE FROM esp32_cache')
+    db.executemany(
+        'INSERT INTO esp32_cache (room, rfid_uid, name, expires_at) VALUES (?, ?, ?, ?)',
+        [('LAB1', 'BADDATE1', 'Broken Row', 'not-a-date'),
+         ('LAB1', 'GOODDATE', 'Valid Row', future)]
+    )
+    db.commit()
+    try:
+        server.stats_counters.reconcile()
+        server.stats_counters.track_cache([('LAB1', 'BADDATE2', 'not-a-date')])
+
+        response = admin_client.get('/api/admin/stats')
+        assert response.status_code == 200
+        assert response.get_json()['active_cache_entries'] == 1
+    finally:
+        db.execute('DELETE FROM esp32_cache')
+        db.commit()
+        server.stats_counters.reconcile()
+
+
+def test_deleting_a_user_updates_the_role_counter(admin_client):
+    server.stats_counters.reconcile()
+    before = admin_client.get('/api/admin/stats').get_json().get('total_students', 0)
+    assert server.add_user('DE100001', 'del-1', 'Deleted', 'Student', 'del1@example.com')['success']
+    assert admin_client.get('/api/admin/stats').get_json()['total_students'] == before + 1
+
+    assert server.delete_user('del-1')['success']
+    stats = admin_client.get('/api/admin/stats').get_json()
+    assert stats.get('total_students', 0) == before
+    # Deleting again changes nothing
+    assert not server.delete_user('del-1')['success']
+    server.stats_counters.reconcile()
+    assert admin_client.get('/api/admin/stats').get_json() == stats
@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+import app as server
+
+
+def _users(prefix, count):
+    return [{'uuid': f'{prefix}{i:04X}', 'user_id': f'{prefix}-{i}', 'first_name': 'Import',
+             'last_name': f'User{i}', 'email': f'{prefix.lower()}{i}@example.com'} for i in range(count)]
+
+
+def test_users_inserted_by_another_process_are_picked_up(db):
+    server.auth_index.build()
+    db.executemany(
+        'INSERT INTO users_reg (uuid, user_id, first_name, last_name, name, email, role) '
+        "VALUES (?, ?, 'Cli', 'User', 'Cli User', ?, 'student')",
+        [('C11A0001', 'cli-1', 'cli1@example.com'), ('C11A0002', 'cli-2', 'cli2@example.com')]
+    )
+    db.commit()
+    assert server.auth_index.get_user('C11A0001') is None
+
+    new_users = server.auth_index.sync_new_users()
+    assert {user['uuid'] for user in new_users} == {'C11A0001', 'C11A0002'}
+    assert server.auth_index.get_user('C11A0002')['name'] == 'Cli User'
+    assert server.auth_index.sync_new_users() == []
+
+
+def test_committed_chunks_are_refreshed_when_a_later_chunk_fails(db, monkeypatch):
+    server.auth_index.build()
+    monkeypatch.setattr(server, 'USER_IMPORT_CHUNK_SIZE', 2)
+    db.execute("""
+        CREATE TRIGGER fail_second_chunk BEFORE INSERT ON users_reg
+        WHEN NEW.uuid = 'CA0002' BEGIN SELECT RAISE(ABORT, 'second chunk failed'); END
+    """)
+    db.commit()
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            server.import_users(_users('CA', 4))
+    finally:
+        db.execute('DROP TRIGGER fail_second_chunk')
+        db.commit()
+
+    assert server.auth_index.get_user('CA0000') is not None
+    assert server.auth_index.get_user('CA0001') is not None
+    assert server.auth_index.get_user('CA0002') is None
+
+
+def test_existing_users_are_matched_case_insensitively(db):
+    db.execute(
+        'INSERT INTO users_reg (uuid, user_id, first_name, last_name, name, email, role) '
+        "VALUES ('cb00aa01', 'Case-1', 'Case', 'User', 'Case User', 'Case1@Example.com', 'student')"
+    )
+    db.commit()
+    records = [
+        {'uuid': 'CB00AA01', 'user_id': 'cb-new-1', 'first_name': 'A', 'last_name': 'B', 'email': 'new1@example.com'},
+        {'uuid': 'CB00AA02', 'user_id': 'case-1', 'first_name': 'A', 'last_name': 'B', 'email': 'new2@example.com'},
+        {'uuid': 'CB00AA03', 'user_id': 'cb-new-3', 'first_name': 'A', 'last_name': 'B', 'email': 'case1@example.COM'},
+        {'uuid': 'CB00AA04', 'user_id': 'cb-new-4', 'first_name': 'A', 'last_name': 'B', 'email': 'new4@example.com'},
+    ]
+
+    result = server.import_users(records)
+
+    assert [row['errors'] for row in result['rows']] == [
+        ['uuid already exists'], ['user_id already exists'], ['email already exists'], []
+    ]
+    assert result['inserted'] == 1
+    assert db.execute("SELECT COUNT(*) FROM users_reg WHERE uuid LIKE 'CB00AA0%'").fetchone()[0] == 2